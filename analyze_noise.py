@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+error profile of generated `src ||| trg` pairs, side by side with a gold M2 file
+
+    python analyze_noise.py -i proc_file.po0.2 proc_file.po0.4 -g conll14st-test.m2 --workers 16
+
+Every pair is aligned token by token (a minimal Levenshtein alignment of the
+source against the target) and the alignment is counted as
+
+- token operations per target token: kept, masked (replaced by `|`),
+  substituted (replaced by another token) and deleted, and the number of
+  inserted source tokens,
+- edits, the maximal runs of changed tokens, by the operation tiers of
+  ERRANT: M (missing, the noise deleted tokens), U (unnecessary, the noise
+  inserted tokens) and R (replacement), and by their size in tokens,
+- edits per sentence, and the identical pairs whose target was padded with
+  `|` by generate_pseudo_samples.py (their padding is removed before the
+  alignment).
+
+The gold M2 file (`-g`, the edits of --annotator) is turned into
+(source, corrected) pairs that are counted in the same way, so its column
+is comparable with those of the pairs. Among the alignments of minimal
+cost, the one with the fewest substitutions is counted, but an insertion
+next to a deletion is still a substitution, so the insertion and deletion
+rates of the pairs are below the rates of the noise (the `--stats` of
+generate_pseudo_samples.py) by about the substitution rate. The kept tokens
+are those kept by the noise and those followed by an insertion.
+
+The tokens of a job are mapped to integers and the alignments of
+--batch_size pairs of similar length are computed at once with NumPy, one
+row of the edit distance matrices per step; the jobs run in --workers
+processes.
+"""
+import argparse
+import sys
+from collections import Counter, OrderedDict
+from itertools import chain, count
+
+import numpy as np
+from logzero import logger
+
+from corpus_io import iter_line_blocks, lines_of_blocks
+from decode import remove_bpe
+from line_index import add_selection_args, has_selection, iter_selected_blocks
+from parallel_utils import get_pool, ordered_imap
+from score_m2 import load_gold
+
+# operations of an alignment; NONE pads the rows of a batch
+NONE, KEEP, MASK, SUBSTITUTE, INSERT, DELETE = range(6)
+OPERATIONS = ['none', 'keep', 'mask', 'substitute', 'insert', 'delete']
+MASK_TOKEN = '|'
+# generate_pseudo_samples.py pads the target of an identical pair with 1 to 8 masks
+MAX_PAD = 8
+# edits of this size and more, and sentences with this many edits and more, are counted together
+MAX_EDIT_SIZE = 4
+MAX_EDITS = 10
+EDIT_TYPES = ['M', 'U', 'R']
+
+
+def parse_pair(line, bpe=False):
+    """(source tokens, target tokens, size of the padding of an identical pair or 0) of a `src ||| trg` line"""
+    source, sep, target = line.rstrip('\r\n').partition('||| ')
+    if not sep:
+        raise ValueError('not a `src ||| trg` pair: {!r}'.format(line))
+    source = source.split()
+    target = target.split()
+    pad = 0
+    while pad < len(target) and pad < MAX_PAD and target[pad] == MASK_TOKEN:
+        pad += 1
+    if pad and target[pad:] == source:
+        target = target[pad:]
+    else:
+        pad = 0
+    if bpe:
+        source = remove_bpe(' '.join(source)).split()
+        target = remove_bpe(' '.join(target)).split()
+    return source, target, pad
+
+
+def encode(pairs):
+    """token IDs of the source and target sides (flat, the mask is 0) and their lengths"""
+    tokens = []
+    lengths = []
+    for source, target in pairs:
+        tokens.extend(source)
+        tokens.extend(target)
+        lengths.append(len(source))
+        lengths.append(len(target))
+    vocab = dict(zip(dict.fromkeys(chain([MASK_TOKEN], tokens)), count()))
+    ids = np.fromiter(map(vocab.__getitem__, tokens), dtype=np.int32, count=len(tokens))
+    lengths = np.array(lengths, dtype=np.int64).reshape(-1, 2)
+    return ids, lengths
+
+
+def padded(ids, lengths, fill):
+    """rows of `ids` (flat) of `lengths`, padded with `fill`"""
+    rows = np.full((len(lengths), max(int(lengths.max()), 1)), fill, dtype=np.int32)
+    starts = np.cumsum(lengths) - lengths
+    row = np.repeat(np.arange(len(lengths)), lengths)
+    rows[row, np.arange(len(ids)) - np.repeat(starts, lengths)] = ids
+    return rows
+
+
+def align_batch(sources, targets, source_lengths, target_lengths, mask_id=-3):
+    """Operations of minimal alignments of padded source rows against padded target rows.
+
+    Row k of the result holds the operations of pair k from its end to its
+    start, followed by NONE. A substitution by `mask_id` is a MASK.
+    """
+    size, n = sources.shape
+    m = targets.shape[1]
+    # the pairs are the last axis, so that every operation on a row runs over contiguous pairs
+    sources = np.concatenate([np.full((size, 1), -1, dtype=np.int32), sources], axis=1).T.copy()
+    targets = np.concatenate([np.full((size, 1), -2, dtype=np.int32), targets], axis=1).T.copy()
+    columns = np.arange(m + 1, dtype=np.int32)[:, None]
+    # the cells beyond the length of a pair do not reach the cells within it
+    distance = np.empty((n + 1, m + 1, size), dtype=np.int32)
+    distance[0] = columns
+    for i in range(1, n + 1):
+        previous = distance[i - 1]
+        row = previous + 1
+        np.minimum(row[1:], previous[:-1] + (sources[i] != targets[1:]), out=row[1:])
+        row[0] = i
+        # the insertions along the row: row[j] = min over k <= j of row[k] + j - k
+        distance[i] = np.minimum.accumulate(row - columns, axis=0) + columns
+
+    # one step back along every alignment at a time, among the optimal steps a keep, a mask, an insertion,
+    # a deletion, then a substitution (which the noise never makes); cells and tokens by their flat index
+    distance = distance.ravel()
+    sources = sources.ravel()
+    targets = targets.ravel()
+    i = source_lengths.astype(np.int64)
+    j = target_lengths.astype(np.int64)
+    pair = np.arange(size)
+    cell = (i * (m + 1) + j) * size + pair
+    source = i * size + pair
+    target = j * size + pair
+    ops = np.full((size, n + m), NONE, dtype=np.int8)
+    active = np.flatnonzero((i > 0) | (j > 0))
+    step = 0
+    while len(active):
+        ca, sa, ta = cell[active], source[active], target[active]
+        ia, ja = i[active] > 0, j[active] > 0
+        here = distance[ca]
+        diagonal = distance[ca - (m + 2) * size]
+        source_tokens = sources[sa]
+        substitute = ia & ja & (diagonal + 1 == here)
+        op = np.where(substitute, SUBSTITUTE, DELETE).astype(np.int8)
+        op[ja & (distance[ca - size] + 1 == here)] = DELETE
+        op[ia & (distance[ca - (m + 1) * size] + 1 == here)] = INSERT
+        op[substitute & (source_tokens == mask_id)] = MASK
+        op[ia & ja & (diagonal == here) & (source_tokens == targets[ta])] = KEEP
+        ops[active, step] = op
+        moves_source = op != DELETE
+        moves_target = op != INSERT
+        i[active] -= moves_source
+        j[active] -= moves_target
+        source[active] = sa - moves_source * size
+        target[active] = ta - moves_target * size
+        cell[active] = ca - (moves_source * (m + 1) + moves_target) * size
+        active = active[(i[active] > 0) | (j[active] > 0)]
+        step += 1
+    return ops[:, :max(step, 1)]
+
+
+def count_alignments(ops, counts):
+    """add the token operations, edits and edits per sentence of the rows of `ops` to `counts`"""
+    for op, n in enumerate(np.bincount(ops.ravel(), minlength=len(OPERATIONS))):
+        if op != NONE:
+            counts['operations', OPERATIONS[op]] += int(n)
+    changed = ops >= MASK
+    starts = changed.copy()
+    starts[:, 1:] &= ~changed[:, :-1]
+    for n_edits, n in enumerate(np.bincount(np.minimum(starts.sum(axis=1), MAX_EDITS))):
+        counts['edits per sentence', n_edits] += int(n)
+    # the source and target tokens of every edit
+    edit = (np.cumsum(starts.ravel()) - 1)[changed.ravel()]
+    changed_ops = ops.ravel()[changed.ravel()]
+    n_source = np.bincount(edit, weights=changed_ops != DELETE).astype(np.int64)
+    n_target = np.bincount(edit, weights=changed_ops != INSERT).astype(np.int64)
+    kind = np.where(n_source == 0, 0, np.where(n_target == 0, 1, 2))
+    size = np.minimum(np.maximum(n_source, n_target), MAX_EDIT_SIZE)
+    by_type = np.bincount(kind * (MAX_EDIT_SIZE + 1) + size, minlength=len(EDIT_TYPES) * (MAX_EDIT_SIZE + 1))
+    for k, kind_name in enumerate(EDIT_TYPES):
+        for s in range(1, MAX_EDIT_SIZE + 1):
+            counts['edits', '{}:{}'.format(kind_name, s)] += int(by_type[k * (MAX_EDIT_SIZE + 1) + s])
+
+
+def profile_pairs(pairs, counts, batch_size=256):
+    """count the alignments of (source tokens, target tokens) pairs into `counts`"""
+    if not pairs:
+        return counts
+    ids, lengths = encode(pairs)
+    offsets = np.cumsum(lengths.ravel()) - lengths.ravel()
+    counts['sentences', ''] += len(pairs)
+    counts['tokens', 'source'] += int(lengths[:, 0].sum())
+    counts['tokens', 'target'] += int(lengths[:, 1].sum())
+    # batches of pairs of similar length
+    order = np.lexsort((lengths[:, 0], lengths[:, 1]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        sides = []
+        for side, fill in ((0, -1), (1, -2)):
+            side_lengths = lengths[batch, side]
+            side_offsets = offsets[2 * batch + side]
+            index = np.repeat(side_offsets - (np.cumsum(side_lengths) - side_lengths), side_lengths) \
+                + np.arange(int(side_lengths.sum()))
+            sides.append((padded(ids[index], side_lengths, fill), side_lengths))
+        (sources, source_lengths), (targets, target_lengths) = sides
+        count_alignments(align_batch(sources, targets, source_lengths, target_lengths, mask_id=0), counts)
+    return counts
+
+
+_options = None
+
+
+def _init_worker(options):
+    global _options
+    _options = options
+
+
+def _profile_block(block):
+    counts = Counter()
+    pairs = []
+    for line in lines_of_blocks([block]):
+        source, target, pad = parse_pair(line, _options['remove_bpe'])
+        if pad:
+            counts['padded', pad] += 1
+        pairs.append((source, target))
+    return profile_pairs(pairs, counts, _options['batch_size'])
+
+
+def profile_corpus(blocks, workers=0, **options):
+    """counts of the pairs in `blocks` of lines"""
+    counts = Counter()
+    if workers > 1:
+        pool = get_pool(workers, _init_worker, (options,))
+        try:
+            for result in ordered_imap(pool, _profile_block, blocks, 2 * workers):
+                counts.update(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(options)
+        for block in blocks:
+            counts.update(_profile_block(block))
+    return counts
+
+
+def corrected(source, edits):
+    """the tokens of `source` with the gold `edits` applied"""
+    tokens = source.split()
+    for start, end, _, corrections in sorted(edits, key=lambda e: (e[0], e[1]), reverse=True):
+        if start < 0:
+            # noop
+            continue
+        tokens[start:end] = corrections[0].split()
+    return tokens
+
+
+def gold_pairs(gold, annotator=0):
+    """(source tokens, corrected tokens) of the sentences of a parsed M2 file, by `annotator` where annotated"""
+    sources, gold_edits = gold
+    pairs = []
+    for source, edits in zip(sources, gold_edits):
+        annotation = edits.get(annotator, next(iter(edits.values())))
+        pairs.append((source.split(), corrected(source, annotation)))
+    return pairs
+
+
+def rate(numerator, denominator):
+    return numerator / denominator if denominator else 0.0
+
+
+def profile_rows(counts):
+    """(statistic, value) rows of the counts of a column"""
+    n_sentences = counts['sentences', '']
+    n_target = counts['tokens', 'target']
+    n_edits = sum(n for key, n in counts.items() if key[0] == 'edits')
+    rows = [('sentences', n_sentences),
+            ('target tokens per sentence', rate(n_target, n_sentences)),
+            ('source tokens per sentence', rate(counts['tokens', 'source'], n_sentences)),
+            ('padded identical pairs', rate(sum(n for key, n in counts.items() if key[0] == 'padded'), n_sentences)),
+            ('edits per sentence', rate(n_edits, n_sentences)),
+            ('edits per target token', rate(n_edits, n_target))]
+    for op in OPERATIONS[KEEP:]:
+        rows.append(('{} per target token'.format(op), rate(counts['operations', op], n_target)))
+    for kind in EDIT_TYPES:
+        for size in range(1, MAX_EDIT_SIZE + 1):
+            label = '{}:{}'.format(kind, size) + ('+' if size == MAX_EDIT_SIZE else '')
+            rows.append(('edits {}'.format(label), rate(counts['edits', '{}:{}'.format(kind, size)], n_edits)))
+    for k in range(MAX_EDITS + 1):
+        label = '{}'.format(k) + ('+' if k == MAX_EDITS else '')
+        rows.append(('sentences with {} edits'.format(label), rate(counts['edits per sentence', k], n_sentences)))
+    return rows
+
+
+def print_profiles(profiles):
+    """a table of the statistics (rows) of every column of `profiles` ({name: counts})"""
+    print('\t'.join(['statistic'] + list(profiles)))
+    columns = [profile_rows(counts) for counts in profiles.values()]
+    for cells in zip(*columns):
+        values = [value for _, value in cells]
+        print('\t'.join([cells[0][0]] + [str(v) if isinstance(v, int) else '{:.4f}'.format(v) for v in values]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='error profile of generated pairs and of a gold M2 file')
+    parser.add_argument('--input', '-i', nargs='+', default=[],
+                        help='`src ||| trg` pairs of generate_pseudo_samples.py, one column each')
+    parser.add_argument('--gold', '-g', default=None, help='gold M2 file, counted as a column of its own')
+    parser.add_argument('--annotator', type=int, default=0, help='annotator of the gold edits (default: %(default)s)')
+    parser.add_argument('--no_gold_cache', action='store_true', help='parse the gold file without its cache')
+    parser.add_argument('--remove_bpe', action='store_true',
+                        help='align the words of the pairs instead of their subwords, e.g. to compare with the gold file')
+    parser.add_argument('--workers', type=int, default=0, help='align the pairs with this many processes')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='pairs aligned at once (default: %(default)s)')
+    add_selection_args(parser)
+    args = parser.parse_args()
+    if not args.input and not args.gold:
+        parser.error('give the pairs (-i), a gold M2 file (-g) or both')
+
+    profiles = OrderedDict()
+    for path in args.input:
+        logger.info('aligning the pairs of {}'.format(path))
+        blocks = iter_selected_blocks(path, args) if has_selection(args) else iter_line_blocks(path)
+        profiles[path] = profile_corpus(blocks, args.workers, remove_bpe=args.remove_bpe, batch_size=args.batch_size)
+    if args.gold:
+        gold = load_gold(args.gold, use_cache=not args.no_gold_cache)
+        profiles[args.gold] = profile_pairs(gold_pairs(gold, args.annotator), Counter(), args.batch_size)
+    print_profiles(profiles)
+    sys.exit(0)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+apply BPE codes learned by subword-nmt without a separate subword-nmt pass
+
+    python apply_bpe.py -c bpe/bpe_code.trg.dict_bpe8000 -i test.src -o test.src.bpe
+    python apply_bpe.py -i corpus.tok -o corpus.bpe --workers 16
+
+The merge operations are loaded once into a table from symbol pair to rank,
+and each word is segmented by repeatedly merging its lowest-ranked pair, as
+`subword_nmt.apply_bpe` does, so the `@@` output is the same. Segmented words
+are kept in a bounded LRU cache; on Zipfian text almost every lookup is a hit.
+
+Other scripts use it as a stage with `--bpe_codes`, e.g.
+    python count_unigram_freq.py --bpe_codes bpe/bpe_code.trg.dict_bpe8000 < corpus.tok
+"""
+import argparse
+import io
+import os
+import re
+import sys
+from functools import lru_cache
+from itertools import islice
+
+from logzero import logger
+
+from line_index import count_input_lines
+from parallel_utils import get_pool, ordered_imap
+from run_stats import RunStats, add_stats_args
+
+DEFAULT_CODES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bpe', 'bpe_code.trg.dict_bpe8000')
+DEFAULT_CACHE_SIZE = 1 << 20
+
+
+def read_codes(path):
+    """return (version, {(first, second): rank}) of a subword-nmt codes file"""
+    with open(path, 'r', encoding='utf-8') as fi:
+        lines = fi.read().rstrip('\n').split('\n')
+    if lines[0].startswith('#version:'):
+        version = tuple(int(x) for x in re.sub(r'(\.0+)*$', '', lines[0].split()[-1]).split('.'))
+        lines = lines[1:]
+    else:
+        version = (0, 1)
+    ranks = {}
+    for rank, line in enumerate(lines):
+        pair = tuple(line.strip('\r\n ').split(' '))
+        if len(pair) != 2:
+            raise ValueError('invalid line {} in BPE codes file {}: {}'.format(rank + 1, path, line))
+        # only the first occurrence of a duplicate pair counts
+        ranks.setdefault(pair, rank)
+    return version, ranks
+
+
+class BPE(object):
+    """segment whitespace-tokenized text with a subword-nmt codes file"""
+
+    def __init__(self, codes=DEFAULT_CODES, separator='@@', cache_size=DEFAULT_CACHE_SIZE):
+        self.version, self.ranks = read_codes(codes)
+        if self.version not in [(0, 1), (0, 2)]:
+            raise ValueError('unsupported version of BPE codes: {}'.format(self.version))
+        self.separator = separator
+        self.joiner = separator + ' '
+        self.encode_word = lru_cache(maxsize=cache_size)(self._encode_word)
+
+    def _encode_word(self, word):
+        """return the segments of `word` joined by `@@ `"""
+        if len(word) == 1:
+            return word
+        if self.version == (0, 1):
+            symbols = list(word) + ['</w>']
+        else:
+            symbols = list(word[:-1]) + [word[-1] + '</w>']
+        ranks = self.ranks
+        while len(symbols) > 1:
+            best = None
+            best_rank = len(ranks)
+            for pair in zip(symbols, symbols[1:]):
+                rank = ranks.get(pair, best_rank)
+                if rank < best_rank:
+                    best, best_rank = pair, rank
+            if best is None:
+                break
+            # merge every occurrence of the best pair from left to right
+            first, second = best
+            merged = first + second
+            new_symbols = []
+            i = 0
+            n = len(symbols)
+            while i < n:
+                if i < n - 1 and symbols[i] == first and symbols[i + 1] == second:
+                    new_symbols.append(merged)
+                    i += 2
+                else:
+                    new_symbols.append(symbols[i])
+                    i += 1
+            symbols = new_symbols
+        # don't print end-of-word symbols
+        if symbols[-1] == '</w>':
+            symbols.pop()
+        elif symbols[-1].endswith('</w>'):
+            symbols[-1] = symbols[-1][:-4]
+        return self.joiner.join(symbols)
+
+    def segment(self, sentence):
+        """segment a whitespace-tokenized sentence, like `subword_nmt.apply_bpe.BPE.segment`"""
+        encode_word = self.encode_word
+        return ' '.join([encode_word(word) for word in sentence.strip('\r\n ').split(' ') if word])
+
+    def process_line(self, line):
+        """segment a line and keep its leading and trailing whitespace (e.g. the newline)"""
+        stripped = line.strip('\r\n ')
+        if not stripped:
+            return line
+        start = line.index(stripped)
+        return line[:start] + self.segment(stripped) + line[start + len(stripped):]
+
+    def segment_lines(self, lines):
+        """generator stage: yield every line of `lines` segmented"""
+        process_line = self.process_line
+        for line in lines:
+            yield process_line(line)
+
+
+_bpe = None
+
+
+def _init_worker(codes, separator, cache_size):
+    global _bpe
+    _bpe = BPE(codes, separator, cache_size)
+
+
+def segment_chunk(bpe, lines):
+    """the segmented chunk, its number of lines and of subword tokens (counted as spaces plus one per line)"""
+    out = ''.join(bpe.segment_lines(lines))
+    return out, len(lines), out.count(' ') + len(lines)
+
+
+def _segment_chunk(lines):
+    return segment_chunk(_bpe, lines)
+
+
+def iter_line_chunks(fi, chunk_size):
+    while True:
+        chunk = list(islice(fi, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def main(args, stats=None):
+    # stdin and stdout are wrapped like subword-nmt does, with universal newlines
+    fi = open(args.input, 'r', encoding='utf-8') if args.input else io.TextIOWrapper(sys.stdin.buffer, 'utf-8')
+    fo = open(args.output, 'w', encoding='utf-8') if args.output else io.TextIOWrapper(sys.stdout.buffer, 'utf-8')
+    try:
+        if args.workers > 0:
+            pool = get_pool(args.workers, _init_worker, (args.codes, args.separator, args.cache_size))
+            try:
+                for out, n_lines, n_tokens in ordered_imap(pool, _segment_chunk,
+                                                           iter_line_chunks(fi, args.chunk_size), 2 * args.workers):
+                    fo.write(out)
+                    if stats is not None:
+                        stats.update(n_lines, n_tokens)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            bpe = BPE(args.codes, args.separator, args.cache_size)
+            for chunk in iter_line_chunks(fi, args.chunk_size):
+                out, n_lines, n_tokens = segment_chunk(bpe, chunk)
+                fo.write(out)
+                if stats is not None:
+                    stats.update(n_lines, n_tokens)
+            logger.info('cache: {}'.format(bpe.encode_word.cache_info()))
+    finally:
+        fi.close()
+        fo.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='apply BPE codes of subword-nmt')
+    parser.add_argument('--codes', '-c', default=DEFAULT_CODES, help='BPE codes file (default: %(default)s)')
+    parser.add_argument('--input', '-i', default=None, help='tokenized text (default: stdin)')
+    parser.add_argument('--output', '-o', default=None, help='segmented text (default: stdout)')
+    parser.add_argument('--separator', '-s', default='@@', help='separator between subwords (default: %(default)s)')
+    parser.add_argument('--cache_size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='number of words in the LRU cache (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=0, help='segment chunks of lines with this many processes')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='number of lines segmented at once, and per job of --workers')
+    add_stats_args(parser)
+    args = parser.parse_args()
+    stats = RunStats('apply_bpe', args.progress_every, count_input_lines(args.input))
+    main(args, stats)
+    stats.finish(args.stats)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark every stage of the pseudo-data pipeline on a synthetic corpus
+
+Each stage runs as a subprocess exactly as in the README, and its wall time,
+startup time (the same command on empty input), throughput and peak RSS are
+written as JSON. With --baseline, the result is compared against a stored
+JSON file and the script exits with 1 if a stage regressed.
+
+    python benchmarks/run_benchmarks.py -n 200000 -o bench.json
+    python benchmarks/run_benchmarks.py -n 200000 --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from logzero import logger
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import synthetic_corpus  # noqa: E402
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark the pseudo-data pipeline')
+    parser.add_argument('--n_lines', '-n', type=int, default=100000, help='number of lines of the synthetic corpus')
+    parser.add_argument('--vocab_size', '-v', type=int, default=8000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='report the fastest of this many runs')
+    parser.add_argument('--stages', nargs='*', default=None, help='run only these stages')
+    parser.add_argument('--output', '-o', default=None, help='write JSON here (default: stdout)')
+    parser.add_argument('--baseline', '-b', default=None, help='JSON of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown / RSS growth against the baseline')
+    parser.add_argument('--workdir', default=None, help='keep the synthetic data and outputs here')
+    return parser.parse_args()
+
+
+def get_stages(corpus, clean, freq, norm_freq, workdir):
+    """(name, argv, stdin path, input path whose lines and tokens are counted)"""
+    py = sys.executable
+    gen = [py, str(REPO / 'generate_pseudo_samples.py'), '-uf', norm_freq, '-po', '0.2', '-pm', '0.7', '--seed', '2020']
+    return [
+        ('remove_dirty_examples',
+         [py, str(REPO / 'remove_dirty_examples.py'), '--input', corpus, '--output', str(workdir / 'clean')],
+         None, corpus),
+        ('count_unigram_freq', [py, str(REPO / 'count_unigram_freq.py')], clean, clean),
+        ('count_unigram_freq.workers', [py, str(REPO / 'count_unigram_freq.py'), '--input', clean, '--workers', '4'],
+         None, clean),
+        ('normalize_unigram_freq', [py, str(REPO / 'normalize_unigram_freq.py'), '--norm', '100'], freq, freq),
+        ('generate_vocab', [py, str(REPO / 'generate_vocab.py')], clean, clean),
+        ('generate_pseudo_samples', gen + ['--single_mistake', '0'], clean, clean),
+        ('generate_pseudo_samples.single_mistake', gen + ['--single_mistake', '1'], clean, clean),
+        ('generate_pseudo_samples.numpy', gen + ['--single_mistake', '0', '--engine', 'numpy'], clean, clean),
+    ]
+
+
+def count_lines_and_tokens(path):
+    n_lines = n_tokens = 0
+    with open(path, 'rb') as fi:
+        for line in fi:
+            n_lines += 1
+            n_tokens += len(line.split())
+    return n_lines, n_tokens
+
+
+def run_once(argv, stdin_path, stdout_path):
+    """return (seconds, peak RSS in MiB) of one run"""
+    with open(stdin_path or os.devnull, 'rb') as fi, open(stdout_path, 'wb') as fo:
+        start = time.perf_counter()
+        proc = subprocess.Popen(argv, stdin=fi, stdout=fo, stderr=subprocess.DEVNULL, cwd=str(REPO))
+        _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise RuntimeError('{} failed with status {}'.format(' '.join(argv), status))
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return seconds, rusage.ru_maxrss / scale
+
+
+def empty_input_argv(argv, empty):
+    # stages that read --input get the empty file instead
+    return [empty if prev == '--input' else a for prev, a in zip([None] + argv[:-1], argv)]
+
+
+def bench_stage(argv, stdin_path, input_path, repeat, workdir):
+    empty = str(workdir / 'empty.txt')
+    out = str(workdir / 'stage.out')
+    runs = [run_once(argv, stdin_path, out) for _ in range(repeat)]
+    startups = [run_once(empty_input_argv(argv, empty), empty if stdin_path else None, out)[0]
+                for _ in range(repeat)]
+    seconds = min(r[0] for r in runs)
+    n_lines, n_tokens = count_lines_and_tokens(input_path)
+    return {
+        'seconds': seconds,
+        'startup_seconds': min(startups),
+        'sentences_per_sec': n_lines / seconds,
+        'tokens_per_sec': n_tokens / seconds,
+        'peak_rss_mb': max(r[1] for r in runs),
+        'n_lines': n_lines,
+        'n_tokens': n_tokens,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """return a list of human-readable regressions"""
+    regressions = []
+    for name, stats in result['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if base is None:
+            continue
+        if stats['sentences_per_sec'] < base['sentences_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} sentences/s (baseline {:.0f})'.format(
+                name, stats['sentences_per_sec'], base['sentences_per_sec']))
+        if stats['startup_seconds'] > base['startup_seconds'] * (1 + tolerance) + 0.05:
+            regressions.append('{}: startup {:.2f}s (baseline {:.2f}s)'.format(
+                name, stats['startup_seconds'], base['startup_seconds']))
+        if stats['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('{}: peak RSS {:.1f}MiB (baseline {:.1f}MiB)'.format(
+                name, stats['peak_rss_mb'], base['peak_rss_mb']))
+    return regressions
+
+
+def main(args):
+    tmpdir = None
+    if args.workdir:
+        workdir = Path(args.workdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='gec-bench-')
+        workdir = Path(tmpdir)
+    try:
+        (workdir / 'clean').mkdir(exist_ok=True)
+        (workdir / 'empty.txt').write_text('')
+        corpus = str(workdir / 'corpus.txt')
+        freq = str(workdir / 'freq.txt')
+        norm_freq = str(workdir / 'norm_freq.txt')
+        synthetic_corpus.main(argparse.Namespace(
+            corpus=corpus, unigram_freq=norm_freq, n_lines=args.n_lines, vocab_size=args.vocab_size,
+            mean_length=25, dirty_ratio=0.05, norm=100, seed=args.seed))
+        clean = str(workdir / 'clean' / 'corpus.txt')
+        subprocess.check_call([sys.executable, str(REPO / 'remove_dirty_examples.py'), '--input', corpus,
+                               '--output', str(workdir / 'clean')], stderr=subprocess.DEVNULL)
+        with open(clean, 'rb') as fi, open(freq, 'wb') as fo:
+            subprocess.check_call([sys.executable, str(REPO / 'count_unigram_freq.py')], stdin=fi, stdout=fo,
+                                  stderr=subprocess.DEVNULL)
+
+        result = {
+            'meta': {
+                'n_lines': args.n_lines,
+                'vocab_size': args.vocab_size,
+                'seed': args.seed,
+                'repeat': args.repeat,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'stages': {},
+        }
+        for name, argv, stdin_path, input_path in get_stages(corpus, clean, freq, norm_freq, workdir):
+            if args.stages and name not in args.stages:
+                continue
+            logger.info('benchmarking {}'.format(name))
+            result['stages'][name] = bench_stage(argv, stdin_path, input_path, args.repeat, workdir)
+            logger.info('{}: {:.0f} sentences/s, {:.2f}s startup, {:.1f}MiB'.format(
+                name, result['stages'][name]['sentences_per_sec'], result['stages'][name]['startup_seconds'],
+                result['stages'][name]['peak_rss_mb']))
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fo:
+            fo.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as fi:
+            regressions = compare(result, json.load(fi), args.tolerance)
+        for regression in regressions:
+            logger.warning('regression: {}'.format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(get_args()))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+generate synthetic tokenized corpora and unigram frequency files for benchmarking
+
+Tokens are drawn from a Zipfian vocabulary of BPE-like subwords, and a small
+fraction of lines are made dirty (too long, non-ascii, digit tables, ...) so
+that every filter of remove_dirty_examples.py has something to do.
+"""
+import argparse
+import itertools
+import random
+import string
+from bisect import bisect_left
+
+from logzero import logger
+
+LETTERS = string.ascii_lowercase
+PUNCTS = ['.', ',', '"', '(', ')', ':', ';', '?', '!', '-']
+
+
+def make_vocab(vocab_size, rng):
+    """return `vocab_size` distinct BPE-like tokens, the most frequent first"""
+    vocab = list(PUNCTS) + ['the', 'of', 'and', 'to', 'a', 'in']
+    seen = set(vocab)
+    while len(vocab) < vocab_size:
+        length = rng.randint(1, 9)
+        token = ''.join(rng.choice(LETTERS) for _ in range(length))
+        if rng.random() < 0.3:
+            token += '@@'
+        if rng.random() < 0.1:
+            token = token.capitalize()
+        if token not in seen:
+            seen.add(token)
+            vocab.append(token)
+    return vocab[:vocab_size]
+
+
+def zipf_weights(vocab_size, exponent=1.1):
+    return [1.0 / (rank ** exponent) for rank in range(1, vocab_size + 1)]
+
+
+def dirty(tokens, rng):
+    """make the line fail one of the heuristics of remove_dirty_examples.py"""
+    kind = rng.randrange(5)
+    if kind == 0:
+        return tokens * 10
+    elif kind == 1:
+        return tokens[:2]
+    elif kind == 2:
+        return [rng.choice(PUNCTS) for _ in tokens]
+    elif kind == 3:
+        return tokens + ['café']
+    else:
+        return [str(rng.randrange(100000)) for _ in tokens]
+
+
+def generate_corpus(n_lines, vocab, rng, mean_length=25, dirty_ratio=0.05):
+    cum_weights = list(itertools.accumulate(zipf_weights(len(vocab))))
+    total = cum_weights[-1]
+    for _ in range(n_lines):
+        length = max(1, int(rng.expovariate(1.0 / mean_length)))
+        tokens = [vocab[bisect_left(cum_weights, rng.random() * total)] for _ in range(length)]
+        if rng.random() < dirty_ratio:
+            tokens = dirty(tokens, rng)
+        yield ' '.join(tokens)
+
+
+def write_unigram_freq(path, vocab, total_count):
+    weights = zipf_weights(len(vocab))
+    norm = sum(weights)
+    with open(path, 'w') as fo:
+        for token, weight in zip(vocab, weights):
+            fo.write('{}\t{}\n'.format(token, max(int(total_count * weight / norm), 1)))
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    vocab = make_vocab(args.vocab_size, rng)
+    logger.info('writing {} lines to {}'.format(args.n_lines, args.corpus))
+    n_tokens = 0
+    with open(args.corpus, 'w') as fo:
+        for line in generate_corpus(args.n_lines, vocab, rng, args.mean_length, args.dirty_ratio):
+            n_tokens += line.count(' ') + 1
+            fo.write(line + '\n')
+    if args.unigram_freq:
+        logger.info('writing unigram frequency of {} tokens to {}'.format(len(vocab), args.unigram_freq))
+        write_unigram_freq(args.unigram_freq, vocab, n_tokens // args.norm)
+    return n_tokens
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='generate a synthetic corpus for benchmarking')
+    parser.add_argument('--corpus', '-c', required=True, help='path to output corpus')
+    parser.add_argument('--unigram_freq', '-uf', default=None, help='path to output (normalized) unigram frequency')
+    parser.add_argument('--n_lines', '-n', type=int, default=100000)
+    parser.add_argument('--vocab_size', '-v', type=int, default=8000)
+    parser.add_argument('--mean_length', type=int, default=25)
+    parser.add_argument('--dirty_ratio', type=float, default=0.05)
+    parser.add_argument('--norm', type=int, default=100, help='same as --norm of normalize_unigram_freq.py')
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
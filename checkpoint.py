@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+periodic checkpoints for resumable long-running stages
+
+A checkpoint is a small JSON file next to the output that records how far the
+input was read, how many lines were processed, how far the output was written
+and (if any) the RNG state. On resume the input is seeked, the output is
+truncated back to the checkpoint, and the RNG state is restored, so the
+resumed output is byte-identical to an uninterrupted run.
+"""
+import gzip
+import json
+import os
+
+from logzero import logger
+
+
+def checkpoint_path(output):
+    return '{}.ckpt'.format(output)
+
+
+def load_checkpoint(path):
+    """return the saved state, or None if there is no checkpoint"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fi:
+        state = json.load(fi)
+    logger.info('resuming from {}: {} lines done'.format(path, state['lines']))
+    return state
+
+
+def save_checkpoint(path, **state):
+    # write to a temporary file first so that a kill never leaves a broken checkpoint
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as fo:
+        json.dump(state, fo)
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.replace(tmp, path)
+
+
+def encode_random_state(state):
+    """`random.getstate()` as JSON-serializable lists"""
+    version, internal, gauss_next = state
+    return [version, list(internal), gauss_next]
+
+
+def decode_random_state(state):
+    version, internal, gauss_next = state
+    return version, tuple(internal), gauss_next
+
+
+class ResumableOutput(object):
+    """Binary output that can be truncated back to a checkpoint.
+
+    With `compress=True` the output is gzip, and every checkpoint ends a gzip
+    member (a multi-member gzip file decompresses to the concatenation of its
+    members). Members are written with mtime=0, so the compressed bytes also
+    only depend on the content and on where the checkpoints fall.
+    """
+
+    def __init__(self, path, offset=None, compress=False):
+        self.compress = compress
+        if offset is None:
+            self.raw = open(path, 'wb')
+        else:
+            self.raw = open(path, 'r+b')
+            self.raw.seek(offset)
+            self.raw.truncate()
+        self.fo = self._open_member()
+
+    def _open_member(self):
+        if self.compress:
+            return gzip.GzipFile(fileobj=self.raw, mode='wb', mtime=0)
+        return self.raw
+
+    def write(self, data):
+        self.fo.write(data)
+
+    def sync(self):
+        """make everything written so far durable and return the output offset"""
+        if self.compress:
+            self.fo.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        offset = self.raw.tell()
+        self.fo = self._open_member()
+        return offset
+
+    def close(self):
+        if self.compress:
+            self.fo.close()
+        self.raw.close()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+compressed and buffered I/O shared by the pipeline scripts
+
+Inputs are plain text, gzip, xz or zstd; the format is detected from the
+magic bytes (so `-` reads compressed stdin too) and outputs are compressed by
+the extension of their path (.gz, .xz, .zst). Reading and decompression run
+in a background thread that hands large blocks of whole lines to the caller,
+and writing buffers many small strings, encodes them at once and compresses
+them in a background thread, so no stage pays per-line codec overhead and no
+`zcat` pipe is needed.
+
+zstd requires the `zstandard` package.
+"""
+import gzip
+import lzma
+import os
+import queue
+import sys
+import threading
+
+BLOCK_BYTES = 1 << 22
+QUEUE_BLOCKS = 4
+# number of characters buffered by TextWriter before they are encoded
+TEXT_BUFFER = 1 << 20
+
+MAGICS = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+
+def is_stdio(path):
+    return path is None or path == '-'
+
+
+def compression_of_path(path):
+    return EXTENSIONS.get(os.path.splitext(path)[1])
+
+
+def numbered_paths(path, n):
+    """`path.0` ... `path.N-1`, with the compression extension kept last: out.gz -> out.0.gz, ..."""
+    if compression_of_path(path) is not None:
+        root, ext = os.path.splitext(path)
+        return ['{}.{}{}'.format(root, k, ext) for k in range(n)]
+    return ['{}.{}'.format(path, k) for k in range(n)]
+
+
+def compression_of_head(head):
+    for magic, name in MAGICS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('reading or writing zstd requires the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+def open_input(path):
+    """Open `path` (stdin if None or '-') as a binary file that decompresses transparently."""
+    if is_stdio(path):
+        # the process's stdin, even if a script has replaced sys.stdin by its lines
+        raw = sys.__stdin__.buffer
+        head = raw.peek(8)[:8]
+    else:
+        raw = open(path, 'rb')
+        head = raw.read(8)
+        raw.seek(0)
+    compression = compression_of_head(head)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    elif compression == 'xz':
+        return lzma.LZMAFile(raw, mode='rb')
+    elif compression == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+    return raw
+
+
+def open_output(path):
+    """Open `path` (stdout if None or '-') as a binary file compressed by its extension."""
+    if is_stdio(path):
+        return sys.__stdout__.buffer
+    compression = compression_of_path(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    elif compression == 'xz':
+        return lzma.open(path, 'wb')
+    elif compression == 'zstd':
+        return _zstandard().ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+    return open(path, 'wb')
+
+
+def _close(f):
+    if f is not sys.__stdin__.buffer and f is not sys.__stdout__.buffer:
+        f.close()
+    else:
+        f.flush()
+
+
+class BackgroundReader(object):
+    """iterate over binary blocks of a file that are read (and decompressed) in a background thread"""
+
+    def __init__(self, path, block_bytes=BLOCK_BYTES):
+        self.path = path
+        self.block_bytes = block_bytes
+        self.queue = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            fi = open_input(self.path)
+            try:
+                while not self.stopped.is_set():
+                    block = fi.read(self.block_bytes)
+                    if not block:
+                        break
+                    self.queue.put(block)
+            finally:
+                _close(fi)
+            self.queue.put(None)
+        except BaseException as e:
+            self.queue.put(e)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.stopped.set()
+            # unblock the reader if the consumer stopped early
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+def _universal_newlines(block):
+    return block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+
+def iter_line_blocks(path, block_bytes=BLOCK_BYTES, universal=False):
+    """Yield large blocks of whole lines of `path` as bytes.
+
+    With `universal`, `\\r\\n` and `\\r` are translated to `\\n` as in text mode.
+    """
+    rest = b''
+    for block in BackgroundReader(path, block_bytes):
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        if end == 0:
+            rest = block
+            continue
+        rest = block[end:]
+        yield _universal_newlines(block[:end]) if universal else block[:end]
+    if rest:
+        yield _universal_newlines(rest) if universal else rest
+
+
+def byte_lines_of_blocks(blocks):
+    """yield the bytes lines (with their newline) of blocks of whole lines"""
+    for block in blocks:
+        lines = block.split(b'\n')
+        last = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+        if last:
+            yield last
+
+
+def lines_of_blocks(blocks):
+    """yield the str lines (with their newline) of blocks of whole lines, decoded block by block"""
+    for block in blocks:
+        lines = block.decode('utf-8').split('\n')
+        last = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if last:
+            yield last
+
+
+def iter_byte_lines(path, block_bytes=BLOCK_BYTES):
+    """yield the lines of `path` as bytes (with their newline)"""
+    return byte_lines_of_blocks(iter_line_blocks(path, block_bytes))
+
+
+def iter_lines(path, block_bytes=BLOCK_BYTES, universal=False):
+    """yield the lines of `path` as str (with their newline), decoded block by block"""
+    return lines_of_blocks(iter_line_blocks(path, block_bytes, universal))
+
+
+class BlockWriter(object):
+    """binary output whose blocks are written (and compressed) in a background thread"""
+
+    def __init__(self, path, block_bytes=BLOCK_BYTES):
+        self.block_bytes = block_bytes
+        self.buffer = []
+        self.buffered = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self.fo = open_output(path)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            if self.error is None:
+                try:
+                    self.fo.write(block)
+                except BaseException as e:
+                    self.error = e
+
+    def _put(self, block):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(block)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_bytes:
+            self._put(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self._put(b''.join(self.buffer))
+            self.buffer = []
+        self.queue.put(None)
+        self.thread.join()
+        _close(self.fo)
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TextWriter(object):
+    """str output that is encoded to UTF-8 in bulk and written by a BlockWriter"""
+
+    def __init__(self, path, block_bytes=BLOCK_BYTES):
+        self.writer = BlockWriter(path, block_bytes)
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= TEXT_BUFFER:
+            self.writer.write(''.join(self.buffer).encode('utf-8'))
+            self.buffer = []
+            self.buffered = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.writer.write(''.join(self.buffer).encode('utf-8'))
+            self.buffer = []
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,27 +1,271 @@
 # -*- coding: utf-8 -*-
 """
 counting unigram frequency
+
+    cat corpus | python count_unigram_freq.py > freq_file
+    python count_unigram_freq.py -i corpus.*.gz --workers 16 > freq_file
+
+Counts can also be written to shards and merged later, e.g. on several machines:
+
+    python count_unigram_freq.py -i part0.gz --workers 16 --part 0 --shard part0.shard
+    python count_unigram_freq.py -i part1.gz --workers 16 --part 1 --shard part1.shard
+    python count_unigram_freq.py --merge part0.shard part1.shard > freq_file
+
+The output is identical to counting the concatenation of all inputs (in the
+order of --part, then of -i) from stdin, including the order of ties.
+
+With --bpe_codes, the input is segmented with apply_bpe.py on the fly, so a
+tokenized corpus can be counted without writing its BPE version first.
+
+With --approx K, memory is bounded: only the K most frequent tokens are kept
+(see unigram_sketch.py), and shards written with --shard are sketches that
+--merge adds up. The other tokens are not printed, so they are never inserted.
 """
-import sys
-from collections import defaultdict
+import argparse
+import heapq
+import struct
+from collections import Counter, defaultdict, deque
 
 from logzero import logger
 
+from apply_bpe import BPE
+from corpus_io import TextWriter, iter_line_blocks, iter_lines
+from line_index import add_selection_args, count_input_lines, has_selection, iter_selected_blocks
+from parallel_utils import get_pool, ordered_imap
+from run_stats import RunStats, add_stats_args
+from unigram_sketch import SketchCounter, is_sketch, merge_sketches
+
+SHARD_MAGIC = b'GECUNI1\n'
+# byte length of the token, count, part, rank of the first occurrence within the part
+SHARD_RECORD = struct.Struct('<IQIQ')
+CHUNK_BYTES = 1 << 22
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='count unigram frequency')
+    parser.add_argument('--input', '-i', nargs='*', default=None,
+                        help='files to read (plain, gzip, xz or zstd), if empty, stdin is used')
+    parser.add_argument('--output', '-o', default=None,
+                        help='frequency file, compressed by its extension (.gz, .xz, .zst) (default: stdout)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='count chunks of the input with this many processes')
+    parser.add_argument('--shard', default=None,
+                        help='write the counts to this shard instead of printing them')
+    parser.add_argument('--part', type=int, default=0,
+                        help='position of the input within the whole corpus, used to order ties across shards')
+    parser.add_argument('--merge', nargs='+', default=None, metavar='SHARD',
+                        help='merge shards and print the frequency of the whole corpus')
+    parser.add_argument('--bpe_codes', default=None,
+                        help='count the subwords of the input segmented with these BPE codes')
+    parser.add_argument('--approx', type=int, default=0, metavar='K',
+                        help='if > 0, count approximately in bounded memory and print only the K most frequent tokens')
+    parser.add_argument('--cms_width', type=int, default=1 << 20,
+                        help='number of counters per row of the Count-Min sketch of --approx')
+    parser.add_argument('--cms_depth', type=int, default=4,
+                        help='number of rows of the Count-Min sketch of --approx')
+    add_selection_args(parser)
+    add_stats_args(parser)
+    args = parser.parse_args()
+    if has_selection(args) and (args.input is None or len(args.input) != 1):
+        parser.error('--lines, --line_shard and --sample_lines need exactly one --input')
+    return args
+
 
-def main(fi):
+def main(fi, bpe=None, output=None, stats=None):
     logger.info('start counting')
     d = defaultdict(int)
+    if bpe is not None:
+        fi = bpe.segment_lines(fi)
     for line in fi:
         tokens = line.strip().split()
         for token in tokens:
             d[token] += 1
+        if stats is not None:
+            stats.update(tokens=len(tokens))
     logger.info('finish counting')
 
-    logger.info('printing to stdout')
-    for token, freq in sorted(d.items(), key=lambda x: x[1], reverse=True):
-        print('{}\t{}'.format(token, freq))
+    logger.info('printing to {}'.format(output or 'stdout'))
+    print_freq(d.items(), output)
     logger.info('done')
 
 
+def print_freq(items, output=None):
+    # sorted is stable, so ties keep the order of the first occurrence
+    with TextWriter(output) as fo:
+        for token, freq in sorted(items, key=lambda x: x[1], reverse=True):
+            fo.write('{}\t{}\n'.format(token, freq))
+
+
+def iter_chunks(paths, chunk_bytes=CHUNK_BYTES):
+    """yield blocks of whole lines from `paths` in order"""
+    for path in paths:
+        logger.info('reading {}'.format(path))
+        for block in iter_line_blocks(path, chunk_bytes):
+            yield block
+
+
+_bpe = None
+
+
+def _init_worker(bpe_codes):
+    global _bpe
+    _bpe = BPE(bpe_codes) if bpe_codes is not None else None
+
+
+def count_chunk(chunk):
+    # the chunk ends at a newline, so splitting the whole block gives the same tokens
+    # as splitting line by line; Counter keeps the order of the first occurrence
+    text = chunk.decode('utf-8')
+    if _bpe is not None:
+        # the same lines as reading the input in text mode
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        text = ' '.join([_bpe.segment(line) for line in lines])
+    return Counter(text.split())
+
+
+def input_chunks(args):
+    """blocks of whole lines of the inputs, or of the lines selected by --lines etc."""
+    if has_selection(args):
+        return iter_selected_blocks(args.input[0], args)
+    return iter_chunks(args.input or ['-'])
+
+
+def chunk_lines(chunk):
+    return chunk.count(b'\n') + (not chunk.endswith(b'\n'))
+
+
+def iter_chunk_counts(chunks, workers, bpe_codes=None, stats=None):
+    """yield a Counter for every chunk in input order; `stats` is updated per chunk"""
+    # lines of the chunks handed out but not yet counted
+    n_lines = deque()
+
+    def counted(chunks):
+        for chunk in chunks:
+            n_lines.append(chunk_lines(chunk))
+            yield chunk
+
+    if stats is not None:
+        chunks = counted(chunks)
+    if workers > 1:
+        pool = get_pool(workers, _init_worker, (bpe_codes,))
+        counts = ordered_imap(pool, count_chunk, chunks, 2 * workers)
+    else:
+        pool = None
+        _init_worker(bpe_codes)
+        counts = map(count_chunk, chunks)
+    try:
+        for counter in counts:
+            if stats is not None:
+                stats.update(n_lines.popleft(), sum(counter.values()))
+            yield counter
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def count_parallel(chunks, workers, bpe_codes=None, stats=None):
+    """return an insertion-ordered dict of counts, ordered by first occurrence"""
+    d = {}
+    # merging chunks in input order keeps the global order of first occurrences
+    for n, counter in enumerate(iter_chunk_counts(chunks, workers, bpe_codes, stats)):
+        for token, freq in counter.items():
+            d[token] = d.get(token, 0) + freq
+        if n % 100 == 0:
+            logger.info('{} chunks, {} types'.format(n, len(d)))
+    return d
+
+
+def count_approx(chunks, workers, top_k, width, depth, bpe_codes=None, stats=None):
+    """return a SketchCounter of the input; memory only depends on `top_k`, `width` and `depth`"""
+    counter = SketchCounter(top_k, width, depth)
+    logger.info('approximate counting in about {:.1f}MiB'.format(counter.nbytes / (1 << 20)))
+    for n, chunk_counts in enumerate(iter_chunk_counts(chunks, workers, bpe_codes, stats)):
+        counter.update(chunk_counts)
+        if n % 100 == 0:
+            logger.info('{} chunks, {} tokens'.format(n, counter.total))
+    return counter
+
+
+def write_shard(path, counts, part):
+    """Write counts to a shard sorted by token.
+
+    Each record keeps the rank of the first occurrence of the token so that
+    ties can be ordered exactly as in a single pass over the whole corpus.
+    """
+    records = sorted((token.encode('utf-8'), freq, rank) for rank, (token, freq) in enumerate(counts.items()))
+    with open(path, 'wb') as fo:
+        fo.write(SHARD_MAGIC)
+        for token, freq, rank in records:
+            fo.write(SHARD_RECORD.pack(len(token), freq, part, rank))
+            fo.write(token)
+    logger.info('wrote {} types to {}'.format(len(records), path))
+
+
+def read_shard(path):
+    """yield (token, freq, part, rank) sorted by token"""
+    with open(path, 'rb') as fi:
+        if fi.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+            raise ValueError('{} is not a unigram count shard'.format(path))
+        while True:
+            header = fi.read(SHARD_RECORD.size)
+            if not header:
+                break
+            length, freq, part, rank = SHARD_RECORD.unpack(header)
+            yield fi.read(length), freq, part, rank
+
+
+def merge_shards(paths):
+    """k-way merge of shards; return [(token, freq)] ordered by first occurrence"""
+    merged = []
+    current = None
+    for token, freq, part, rank in heapq.merge(*[read_shard(path) for path in paths]):
+        if current is not None and current[0] == token:
+            current[1] += freq
+            current[2] = min(current[2], (part, rank))
+        else:
+            if current is not None:
+                merged.append(current)
+            current = [token, freq, (part, rank)]
+    if current is not None:
+        merged.append(current)
+    merged.sort(key=lambda x: x[2])
+    return [(token.decode('utf-8'), freq) for token, freq, _ in merged]
+
+
 if __name__ == "__main__":
-    main(sys.stdin)
+    args = get_args()
+    total_lines = count_input_lines(args.input[0], args) if args.input and len(args.input) == 1 else None
+    stats = RunStats('count_unigram_freq', args.progress_every, total_lines)
+    if args.merge and is_sketch(args.merge[0]):
+        logger.info('merging {} sketches'.format(len(args.merge)))
+        print_freq(merge_sketches(args.merge).items(), args.output)
+        logger.info('done')
+    elif args.merge:
+        logger.info('merging {} shards'.format(len(args.merge)))
+        print_freq(merge_shards(args.merge), args.output)
+        logger.info('done')
+    elif args.approx > 0:
+        logger.info('start counting')
+        counter = count_approx(input_chunks(args), args.workers, args.approx, args.cms_width, args.cms_depth,
+                               args.bpe_codes, stats)
+        logger.info('finish counting')
+        if args.shard:
+            counter.save(args.shard, args.part)
+        else:
+            logger.info('printing to {}'.format(args.output or 'stdout'))
+            print_freq(counter.items(), args.output)
+            logger.info('done')
+    elif args.input is None and args.workers == 0 and args.shard is None:
+        main(iter_lines('-', universal=True), BPE(args.bpe_codes) if args.bpe_codes else None, args.output, stats)
+    else:
+        logger.info('start counting')
+        counts = count_parallel(input_chunks(args), args.workers, args.bpe_codes, stats)
+        logger.info('finish counting')
+        if args.shard:
+            write_shard(args.shard, counts, args.part)
+        else:
+            logger.info('printing to {}'.format(args.output or 'stdout'))
+            print_freq(counts.items(), args.output)
+            logger.info('done')
+    stats.finish(args.stats)
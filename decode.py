@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+decoding a test set with several decoder processes, instead of decode.sh
+
+    python decode.py -i test.src -o output.txt --fairseq_dir /path/to/fairseq --checkpoint model.pt \\
+        --workers 4 --devices 0,1,2,3
+
+The source is segmented with the BPE codes (as by apply_bpe.py), sorted by
+length and cut into chunks of --buffer_size sentences. --workers decoder
+processes take the chunks longest first, each the next one as soon as it
+has read its input, so sentences of similar length meet in a batch and
+little of it is padding. Hypotheses are mapped back from each decoder's
+`H-<n>` lines to their sentences, their BPE is removed and they are
+written to the output in the order of the source, which is what the
+`grep ^H | cut | sort -n` of decode.sh did.
+
+Any command that reads one segmented sentence per line can replace
+fairseq's interactive.py with --decoder_cmd. It writes fairseq's
+`H-<n>\\t<score>\\t<hypothesis>` lines (--decoder_format fairseq) or one
+hypothesis per input line (--decoder_format lines), e.g. to test the driver:
+
+    python decode.py -i test.src -o output.txt --decoder_cmd cat --decoder_format lines --workers 4
+"""
+import argparse
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from logzero import logger
+
+from apply_bpe import BPE, DEFAULT_CODES
+from fairseq_binary import VOCAB_DIR
+
+DECODER_FORMATS = ['fairseq', 'lines']
+
+
+def fairseq_command(args):
+    """interactive.py with the options of decode.sh, except --remove-bpe (done by the driver)"""
+    return [sys.executable, '-u', os.path.join(args.fairseq_dir, 'interactive.py'), args.data_dir,
+            '--path', args.checkpoint,
+            '--source-lang', 'src_bpe8000',
+            '--target-lang', 'trg_bpe8000',
+            '--buffer-size', str(args.buffer_size),
+            '--batch-size', str(args.batch_size),
+            '--log-format', 'simple',
+            '--beam', str(args.beam)]
+
+
+def remove_bpe(sentence, separator='@@'):
+    # as fairseq's --remove-bpe
+    return (sentence + ' ').replace(separator + ' ', '').rstrip()
+
+
+def length_chunks(sentences, chunk_size):
+    """IDs of the sentences in chunks of `chunk_size`, longest sentences first"""
+    order = sorted(range(len(sentences)), key=lambda n: (-len(sentences[n].split()), n))
+    return [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+
+
+class Decoder(object):
+    """one decoder process fed with chunks from a queue shared with the other decoders"""
+
+    def __init__(self, command, decoder_format='fairseq', cwd=None, device=None):
+        self.command = command
+        self.decoder_format = decoder_format
+        self.cwd = cwd
+        self.env = dict(os.environ)
+        if device is not None:
+            self.env['CUDA_VISIBLE_DEVICES'] = device
+        # sentence ID of every line written to the decoder, in order
+        self.sent = []
+        self.errors = []
+
+    def run(self, chunks, sentences, hypotheses):
+        process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.cwd,
+                                   env=self.env, encoding='utf-8', bufsize=1)
+        feeder = threading.Thread(target=self._feed, args=(process, chunks, sentences), daemon=True)
+        feeder.start()
+        try:
+            self._read(process, hypotheses)
+        except Exception as e:
+            self.errors.append(e)
+            process.kill()
+        feeder.join()
+        if process.wait() != 0:
+            self.errors.append(RuntimeError('{} exited with {}'.format(' '.join(self.command), process.returncode)))
+
+    def _feed(self, process, chunks, sentences):
+        try:
+            while True:
+                try:
+                    chunk = chunks.get_nowait()
+                except queue.Empty:
+                    break
+                # the IDs are known before the decoder can answer for them
+                self.sent.extend(chunk)
+                process.stdin.write(''.join(sentences[n] + '\n' for n in chunk))
+                process.stdin.flush()
+            process.stdin.close()
+        except BrokenPipeError:
+            # the decoder died; its exit status is reported by `run`
+            pass
+
+    def _read(self, process, hypotheses):
+        sent = self.sent
+        if self.decoder_format == 'lines':
+            for n, line in enumerate(process.stdout):
+                hypotheses[sent[n]] = line.rstrip('\n')
+            return
+        for line in process.stdout:
+            if not line.startswith('H-'):
+                continue
+            n, _, hypothesis = line.rstrip('\n').split('\t', 2)
+            n = sent[int(n[2:])]
+            # with --nbest, the first hypothesis is the best
+            if hypotheses[n] is None:
+                hypotheses[n] = hypothesis
+
+
+def decode(sentences, command, workers=1, chunk_size=1024, decoder_format='fairseq', cwd=None, devices=None):
+    """hypotheses of the (segmented) `sentences`, in their order"""
+    chunks = queue.Queue()
+    for chunk in length_chunks(sentences, chunk_size):
+        chunks.put(chunk)
+    hypotheses = [None] * len(sentences)
+    decoders = [Decoder(command, decoder_format, cwd, devices[k % len(devices)] if devices else None)
+                for k in range(workers)]
+    threads = [threading.Thread(target=d.run, args=(chunks, sentences, hypotheses)) for d in decoders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    errors = [e for d in decoders for e in d.errors]
+    if errors:
+        raise errors[0]
+    missing = hypotheses.count(None)
+    if missing:
+        raise RuntimeError('the decoders gave no hypothesis for {} of {} sentences'.format(missing, len(sentences)))
+    return hypotheses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='decode a test set with several decoder processes')
+    parser.add_argument('--input', '-i', required=True, help='tokenized source')
+    parser.add_argument('--output', '-o', required=True, help='hypotheses, one per line of the source')
+    parser.add_argument('--bpe_codes', default=DEFAULT_CODES,
+                        help='segment the source with these codes, "none" if it is already segmented '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='number of decoder processes')
+    parser.add_argument('--devices', default=None,
+                        help='comma-separated GPUs given to the decoders in turn as CUDA_VISIBLE_DEVICES')
+    parser.add_argument('--buffer_size', type=int, default=1024,
+                        help='sentences per chunk handed to a decoder, also --buffer-size of fairseq '
+                             '(default: %(default)s)')
+    group = parser.add_argument_group('fairseq', 'the decoder of decode.sh')
+    # interactive.py runs in --fairseq_dir, so the paths are made absolute first
+    group.add_argument('--fairseq_dir', default=None, type=os.path.abspath,
+                       help='cloned fairseq (the commit of the README)')
+    group.add_argument('--checkpoint', default=None, type=os.path.abspath, help='model.pt')
+    group.add_argument('--data_dir', default=VOCAB_DIR, type=os.path.abspath,
+                       help='directory of the dictionaries (default: %(default)s)')
+    group.add_argument('--batch_size', type=int, default=12)
+    group.add_argument('--beam', type=int, default=5)
+    group = parser.add_argument_group('other decoders')
+    group.add_argument('--decoder_cmd', default=None,
+                       help='command line of a decoder that reads segmented sentences on stdin, instead of fairseq')
+    group.add_argument('--decoder_format', choices=DECODER_FORMATS, default='fairseq',
+                       help='what the decoder writes: H-<n> lines, or one hypothesis per line (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.decoder_cmd:
+        command, cwd = shlex.split(args.decoder_cmd), None
+    elif args.fairseq_dir and args.checkpoint:
+        command, cwd = fairseq_command(args), args.fairseq_dir
+    else:
+        parser.error('give --fairseq_dir and --checkpoint, or --decoder_cmd')
+
+    with open(args.input, encoding='utf-8') as fi:
+        sources = [line.rstrip('\n') for line in fi]
+    if args.bpe_codes != 'none':
+        bpe = BPE(args.bpe_codes)
+        sources = [bpe.segment(line) for line in sources]
+    logger.info('decoding {} sentences with {} decoders'.format(len(sources), args.workers))
+    start = time.monotonic()
+    hypotheses = decode(sources, command, args.workers, args.buffer_size, args.decoder_format, cwd,
+                        args.devices.split(',') if args.devices else None)
+    elapsed = time.monotonic() - start
+    logger.info('decoded {} sentences in {:.1f}s ({:.1f} sentences/s)'.format(
+        len(sources), elapsed, len(sources) / max(elapsed, 1e-9)))
+    with open(args.output, 'w', encoding='utf-8') as fo:
+        for hypothesis in hypotheses:
+            fo.write(remove_bpe(hypothesis) + '\n')
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+exact and near-duplicate line removal with bounded memory
+
+Every line is reduced to 64-bit hashes that are kept in a `HashIndex`: a set
+in RAM that is written to disk as a sorted run whenever it holds more than
+`max_memory` hashes. The runs are memory-mapped and looked up for a whole
+block of lines at once with a binary search, so memory stays bounded however
+many lines are seen.
+
+- exact: one hash per line, a line is removed if its hash was seen before.
+- near: MinHash signatures over token n-grams, split into LSH bands; a line
+  is removed if any of its bands was seen before, i.e. if it probably has a
+  Jaccard similarity above roughly (1 / bands) ** (1 / rows per band) to a
+  previous line.
+
+The index holds Python's `hash`, which is salted per process, so it is only
+valid during one run. Near-duplicate mode and lookups in the runs require NumPy.
+"""
+import os
+import shutil
+import tempfile
+from zlib import crc32
+
+from logzero import logger
+
+# Mersenne prime for the universal hash functions of MinHash
+MERSENNE_PRIME = (1 << 31) - 1
+MINHASH_BATCH = 1000
+
+
+class HashIndex(object):
+    """set of 64-bit hashes that spills to sorted runs on disk"""
+
+    def __init__(self, max_memory=10000000, tmpdir=None):
+        self.max_memory = max_memory
+        self.memory = set()
+        self.runs = []
+        self.n_disk = 0
+        self.tmpdir = tempfile.mkdtemp(prefix='gec-dedup-', dir=tmpdir)
+
+    def __len__(self):
+        return len(self.memory) + self.n_disk
+
+    def _on_disk(self, hashes):
+        if not self.runs:
+            return [False] * len(hashes)
+        import numpy as np
+        query = np.array(hashes, dtype=np.int64)
+        found = np.zeros(len(query), dtype=bool)
+        for run in self.runs:
+            idx = np.minimum(np.searchsorted(run, query), len(run) - 1)
+            found |= run[idx] == query
+        return found.tolist()
+
+    def add_groups(self, groups):
+        """Mark each group of hashes as seen unless one of them was seen before.
+
+        Groups are processed in order, so a group can also collide with an
+        earlier group of the same call. Returns a list of bools, True for new groups.
+        """
+        flat = [h for group in groups for h in group]
+        on_disk = iter(self._on_disk(flat))
+        memory = self.memory
+        is_new = []
+        for group in groups:
+            seen = False
+            for h in group:
+                # consume the disk lookups of the whole group
+                seen = next(on_disk) or h in memory or seen
+            if not seen:
+                memory.update(group)
+            is_new.append(not seen)
+        if len(memory) >= self.max_memory:
+            self.spill()
+        return is_new
+
+    def spill(self):
+        import numpy as np
+        path = os.path.join(self.tmpdir, 'run{:05d}.bin'.format(len(self.runs)))
+        run = np.array(sorted(self.memory), dtype=np.int64)
+        run.tofile(path)
+        self.runs.append(np.memmap(path, dtype=np.int64, mode='r'))
+        self.n_disk += len(run)
+        self.memory = set()
+        logger.info('spilled {} hashes to {} ({} on disk)'.format(len(run), path, self.n_disk))
+
+    def close(self):
+        self.runs = []
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class MinHashLSH(object):
+    """LSH band keys of the MinHash signature of the token n-grams of a line"""
+
+    def __init__(self, num_perm=64, bands=8, ngram=3, seed=1):
+        import numpy as np
+        if num_perm % bands != 0:
+            raise ValueError('num_perm ({}) must be a multiple of bands ({})'.format(num_perm, bands))
+        self.np = np
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.int64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.int64)
+
+    def shingles(self, line):
+        # crc32 rather than the salted `hash`, so that the signatures do not change between runs
+        tokens = line.split()
+        n = self.ngram
+        if len(tokens) <= n:
+            return [crc32(line) % MERSENNE_PRIME]
+        return [crc32(b' '.join(tokens[i:i + n])) % MERSENNE_PRIME for i in range(len(tokens) - n + 1)]
+
+    def band_keys(self, lines):
+        """return the list of `bands` 64-bit keys of every bytes line"""
+        np = self.np
+        keys = []
+        for start in range(0, len(lines), MINHASH_BATCH):
+            batch = [self.shingles(line) for line in lines[start:start + MINHASH_BATCH]]
+            offsets = np.cumsum([0] + [len(s) for s in batch[:-1]])
+            values = np.array([h for s in batch for h in s], dtype=np.int64)
+            # (num_perm, number of shingles) -> minimum over the shingles of each line
+            signatures = np.minimum.reduceat((self.a * values + self.b) % MERSENNE_PRIME, offsets, axis=1).T
+            rows = self.rows
+            for signature in signatures:
+                keys.append([hash((band, signature[band * rows:(band + 1) * rows].tobytes()))
+                             for band in range(self.bands)])
+        return keys
+
+
+class Deduplicator(object):
+    """remove exact (and optionally near) duplicates from blocks of lines"""
+
+    def __init__(self, near=False, max_memory=10000000, tmpdir=None, num_perm=64, bands=8, ngram=3):
+        self.exact = HashIndex(max_memory, tmpdir)
+        self.near = None
+        if near:
+            self.near = HashIndex(max_memory, tmpdir)
+            self.minhash = MinHashLSH(num_perm, bands, ngram)
+
+    def filter_lines(self, lines, counts):
+        """return the lines that were not seen before; count the removed ones"""
+        is_new = self.exact.add_groups([[hash(line)] for line in lines])
+        kept = [line for line, new in zip(lines, is_new) if new]
+        counts['duplicate'] += len(lines) - len(kept)
+        if self.near is not None and kept:
+            is_new = self.near.add_groups(self.minhash.band_keys(kept))
+            n_kept = len(kept)
+            kept = [line for line, new in zip(kept, is_new) if new]
+            counts['near_duplicate'] += n_kept - len(kept)
+        return kept
+
+    def filter_blocks(self, blocks, counts):
+        """the same as `filter_lines` for blocks of whole lines"""
+        for block in blocks:
+            kept = self.filter_lines(block.split(b'\n')[:-1], counts)
+            if kept:
+                kept.append(b'')
+                yield b'\n'.join(kept)
+
+    def close(self):
+        self.exact.close()
+        if self.near is not None:
+            self.near.close()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+write `src ||| trg` pairs as fairseq binary datasets without fairseq-preprocess
+
+The output directory has the same layout as
+
+    fairseq-preprocess --source-lang src_bpe8000 --target-lang trg_bpe8000 \
+        --srcdict vocab/dict.src_bpe8000.txt --tgtdict vocab/dict.trg_bpe8000.txt \
+        --trainpref proc_file --destdir DESTDIR
+
+i.e. `train.src_bpe8000-trg_bpe8000.{src_bpe8000,trg_bpe8000}.{bin,idx}` and the
+two dictionaries. The .bin file is a flat array of int32 token IDs (plus one,
+as fairseq's IndexedDataset stores them) and the .idx file holds the offset
+of every sentence, so both can be memory-mapped. Tokens are mapped exactly
+like `Dictionary.encode_line`: whitespace tokenization, `<unk>` for unknown
+tokens and `</s>` appended to every sentence.
+
+Converting an existing text file:
+    python fairseq_binary.py -i proc_file -o DESTDIR
+"""
+import argparse
+import os
+import shutil
+import struct
+import sys
+from array import array
+
+from logzero import logger
+
+VOCAB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vocab')
+DEFAULT_SRCDICT = os.path.join(VOCAB_DIR, 'dict.src_bpe8000.txt')
+DEFAULT_TGTDICT = os.path.join(VOCAB_DIR, 'dict.trg_bpe8000.txt')
+
+# header of fairseq.data.indexed_dataset.IndexedDataset
+INDEX_MAGIC = b'TNTIDX\x00\x00'
+INDEX_VERSION = 1
+# dtype code and element size of int32, the dtype of IndexedDatasetBuilder
+INT32_CODE = 4
+INT32_SIZE = 4
+
+
+class Dictionary(object):
+    """the token to ID mapping of `fairseq.data.Dictionary.load`"""
+
+    def __init__(self):
+        self.symbols = ['<s>', '<pad>', '</s>', '<unk>']
+        self.indices = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.bos_index, self.pad_index, self.eos_index, self.unk_index = range(4)
+        self.nspecial = len(self.symbols)
+
+    @classmethod
+    def load(cls, path):
+        d = cls()
+        with open(path, 'r', encoding='utf-8') as fi:
+            for line in fi:
+                idx = line.rfind(' ')
+                if idx == -1:
+                    raise ValueError('Incorrect dictionary format, expected "<token> <cnt>": {}'.format(path))
+                # a duplicate token maps to its last line, as in fairseq
+                d.indices[line[:idx]] = len(d.symbols)
+                d.symbols.append(line[:idx])
+        return d
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def encode_line(self, line):
+        """return (IDs of the tokens of `line` followed by `</s>`, number of unknown tokens)"""
+        unk = self.unk_index
+        tokens = line.split()
+        ids = [self.indices.get(token, unk) for token in tokens]
+        # fairseq does not count a literal <unk> as replaced
+        n_unk = ids.count(unk) - tokens.count('<unk>')
+        ids.append(self.eos_index)
+        return ids, n_unk
+
+
+def lang_of(dict_path):
+    """`src_bpe8000` for `dict.src_bpe8000.txt`"""
+    name = os.path.basename(dict_path)
+    if not (name.startswith('dict.') and name.endswith('.txt')):
+        raise ValueError('dictionary file name must be dict.LANG.txt: {}'.format(dict_path))
+    return name[len('dict.'):-len('.txt')]
+
+
+def dataset_prefix(destdir, split, src_lang, tgt_lang, lang):
+    return os.path.join(destdir, '{}.{}-{}.{}'.format(split, src_lang, tgt_lang, lang))
+
+
+class IndexedDatasetWriter(object):
+    """writes the .bin/.idx pair of `fairseq.data.indexed_dataset.IndexedDatasetBuilder`"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.out_file = open(prefix + '.bin', 'wb')
+        self.data_offsets = array('q', [0])
+        self.sizes = array('q')
+
+    def add_item(self, ids):
+        # IndexedDatasetBuilder stores every ID plus one
+        self.out_file.write(array('i', [i + 1 for i in ids]).tobytes())
+        self.data_offsets.append(self.data_offsets[-1] + len(ids))
+        self.sizes.append(len(ids))
+
+    def finalize(self):
+        self.out_file.close()
+        n_items = len(self.sizes)
+        with open(self.prefix + '.idx', 'wb') as fo:
+            fo.write(INDEX_MAGIC)
+            fo.write(struct.pack('<Q', INDEX_VERSION))
+            fo.write(struct.pack('<QQ', INT32_CODE, INT32_SIZE))
+            fo.write(struct.pack('<QQ', n_items, n_items))
+            # every item is a 1-d tensor, so dim_offsets is 0, 1, ..., n_items
+            fo.write(array('q', range(n_items + 1)).tobytes())
+            fo.write(self.data_offsets.tobytes())
+            fo.write(self.sizes.tobytes())
+
+
+class IndexedDataset(object):
+    """Memory-mapped reader of a dataset written by `IndexedDatasetWriter` (or fairseq-preprocess).
+
+    `dataset[n]` is the array of token IDs of sentence `n`. Requires NumPy.
+    """
+
+    def __init__(self, prefix):
+        import numpy as np
+
+        with open(prefix + '.idx', 'rb') as fi:
+            if fi.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError('{}.idx is not a fairseq IndexedDataset index'.format(prefix))
+            version, = struct.unpack('<Q', fi.read(8))
+            code, _ = struct.unpack('<QQ', fi.read(16))
+            if version != INDEX_VERSION or code != INT32_CODE:
+                raise ValueError('unsupported index version {} or dtype code {}'.format(version, code))
+            n_items, _ = struct.unpack('<QQ', fi.read(16))
+            fi.seek(8 * (n_items + 1), os.SEEK_CUR)
+            self.offsets = np.frombuffer(fi.read(8 * (n_items + 1)), dtype=np.int64)
+        if self.offsets[-1] > 0:
+            self.data = np.memmap(prefix + '.bin', dtype=np.int32, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        return self.data[self.offsets[n]:self.offsets[n + 1]] - 1
+
+
+class PairWriter(object):
+    """File-like sink for the `src ||| trg` text of generate_pseudo_samples.py.
+
+    Text can be written in arbitrary pieces; every complete line is split at
+    the first `||| ` and encoded into the source and target datasets.
+    """
+
+    def __init__(self, destdir, srcdict=DEFAULT_SRCDICT, tgtdict=DEFAULT_TGTDICT, split='train'):
+        os.makedirs(destdir, exist_ok=True)
+        self.src_lang, self.tgt_lang = lang_of(srcdict), lang_of(tgtdict)
+        self.dicts = [Dictionary.load(srcdict), Dictionary.load(tgtdict)]
+        for path in [srcdict, tgtdict]:
+            dest = os.path.join(destdir, os.path.basename(path))
+            if not (os.path.exists(dest) and os.path.samefile(path, dest)):
+                shutil.copyfile(path, dest)
+        self.writers = [IndexedDatasetWriter(dataset_prefix(destdir, split, self.src_lang, self.tgt_lang, lang))
+                        for lang in [self.src_lang, self.tgt_lang]]
+        self.n_sents = 0
+        self.n_tokens = [0, 0]
+        self.n_unk = [0, 0]
+        self.rest = ''
+
+    def write(self, text):
+        lines = (self.rest + text).split('\n')
+        self.rest = lines.pop()
+        for line in lines:
+            self.add_pair(line)
+
+    def add_pair(self, line):
+        sides = line.split('||| ', 1)
+        if len(sides) != 2:
+            raise ValueError('not a `src ||| trg` pair: {}'.format(line))
+        self.n_sents += 1
+        for n, (side, d, writer) in enumerate(zip(sides, self.dicts, self.writers)):
+            ids, n_unk = d.encode_line(side)
+            writer.add_item(ids)
+            self.n_tokens[n] += len(ids)
+            self.n_unk[n] += n_unk
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.rest:
+            self.add_pair(self.rest)
+            self.rest = ''
+        for lang, d, writer, n_tokens, n_unk in zip(
+                [self.src_lang, self.tgt_lang], self.dicts, self.writers, self.n_tokens, self.n_unk):
+            writer.finalize()
+            # the same summary as fairseq-preprocess
+            logger.info('[{}] Dictionary: {} types'.format(lang, len(d)))
+            logger.info('[{}] {}: {} sents, {} tokens, {:.3}% replaced by <unk>'.format(
+                lang, writer.prefix, self.n_sents, n_tokens, 100 * n_unk / max(n_tokens, 1)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert `src ||| trg` text into fairseq binary datasets')
+    parser.add_argument('--input', '-i', default=None, help='pseudo pairs (default: stdin)')
+    parser.add_argument('--output', '-o', required=True, help='destination directory')
+    parser.add_argument('--srcdict', default=DEFAULT_SRCDICT)
+    parser.add_argument('--tgtdict', default=DEFAULT_TGTDICT)
+    parser.add_argument('--split', default='train', help='train, valid, ...')
+    args = parser.parse_args()
+
+    writer = PairWriter(args.output, args.srcdict, args.tgtdict, args.split)
+    fi = open(args.input, 'r', encoding='utf-8') if args.input else sys.stdin
+    for line in fi:
+        writer.write(line)
+    writer.close()
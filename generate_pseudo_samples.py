@@ -11,15 +11,121 @@ import argparse
 import codecs
 import os
 import random
-import re
 import sys
-from collections import defaultdict
+from collections import deque
 # hack for python2/3 compatibility
 from io import open
 from logzero import logger
 
+from apply_bpe import BPE, DEFAULT_CODES
+from checkpoint import (ResumableOutput, checkpoint_path, decode_random_state, encode_random_state,
+                        load_checkpoint, save_checkpoint)
+from corpus_io import (TextWriter, byte_lines_of_blocks, compression_of_path, iter_line_blocks, lines_of_blocks,
+                       numbered_paths)
+from fairseq_binary import DEFAULT_SRCDICT, DEFAULT_TGTDICT, PairWriter
+from line_index import add_selection_args, count_input_lines, has_selection, iter_selected_blocks
+from noise_server import add_server_args, serve
+from parallel_utils import get_pool, ordered_imap
+from run_stats import RunStats, add_stats_args
+from unigram_sampler import SAMPLERS, load_sampler
+
 argparse.open = open
 
+# operations counted by make_mistakes; the same indices as in vectorized_noise (and spelling_noise)
+KEEP, MASK, INSERT, DELETE, PAD, MISSPELLED = range(6)
+OPERATIONS = ['keep', 'mask', 'insert', 'delete', 'pad', 'misspelled']
+
+
+def add_noise_args(parser):
+    """options of the noise and of the output, shared with pipeline.py"""
+    parser.add_argument(
+        '--prob_mask', '-pm', type=float, default=0.5,
+        help="probability to use mask")
+
+    parser.add_argument(
+        '--prob_orig', '-po', type=float, default=0.2,
+        help="probability to use original token")
+
+    parser.add_argument(
+        '--unigram_freq', '-uf', type=os.path.abspath,
+        help="verbose mode.")
+
+    parser.add_argument(
+        '--single_mistake', '-sm', type=int, choices=[0, 1],
+        help="if we want single mistake...")
+
+    parser.add_argument(
+        '--use_insertion', '-ui', type=int, choices=[0, 1], default=1,
+        help="generate error by insertion?")
+
+    parser.add_argument(
+        '--use_deletion', '-ud', type=int, choices=[0, 1], default=1,
+        help="generate error by deletion?")
+
+    parser.add_argument(
+        '--spelling_prob', type=float, default=0.0,
+        help="misspell every word of the source with this probability before the token noise (SSE, see "
+             "spelling_noise.py; requires NumPy) (default: %(default)s)")
+
+    parser.add_argument(
+        '--spelling_table', type=os.path.abspath, default=None,
+        help="`letter<TAB>replacement[<TAB>weight]` pairs added to the built-in keyboard and letter confusions")
+
+    parser.add_argument(
+        '--spelling_codes', type=os.path.abspath, default=DEFAULT_CODES,
+        help="BPE codes that segment the misspelled words again (default: %(default)s)")
+
+    parser.add_argument(
+        '--sampler', type=str, choices=sorted(SAMPLERS), default='cumsum',
+        help="how to draw inserted tokens. 'cumsum' reproduces the output of the former expanded "
+             "word_index_list byte for byte; 'alias' draws in O(1) but gives different corpora (default: %(default)s)")
+
+    parser.add_argument(
+        '--no_sampler_cache', action='store_true',
+        help="parse --unigram_freq instead of memory-mapping its compiled cache UNIGRAM_FREQ.SAMPLER.cache, "
+             "which is written on first use and rebuilt when the file changes (see unigram_sampler.py)")
+
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help="if > 0, corrupt chunks of the input with this many processes. Each chunk gets its own seed "
+             "derived from --seed, so the output is identical for any number of workers (default: %(default)s)")
+
+    parser.add_argument(
+        '--chunk_size', type=int, default=10000,
+        help="number of lines per chunk when --workers > 0 (default: %(default)s)")
+
+    parser.add_argument(
+        '--engine', type=str, choices=['python', 'numpy'], default='python',
+        help="'numpy' draws all decisions of a batch of sentences at once (see vectorized_noise.py). "
+             "It has the same noise distribution but a different random stream (default: %(default)s)")
+
+    parser.add_argument(
+        '--batch_size', type=int, default=1000,
+        help="number of sentences per batch of the numpy engine (default: %(default)s)")
+
+    parser.add_argument(
+        '--num_variants', '--num-variants', type=int, default=1, metavar='K',
+        help="write K independent corruptions of every line to OUTPUT.0 ... OUTPUT.K-1 in one pass over the "
+             "input. OUTPUT.0 is the same as the output without this option (default: %(default)s)")
+
+    parser.add_argument(
+        '--output_format', type=str, choices=['text', 'fairseq'], default='text',
+        help="'fairseq' writes the pairs to the directory OUTPUT as binary datasets that fairseq-train can read, "
+             "identical to running fairseq-preprocess on the text output (see fairseq_binary.py) "
+             "(default: %(default)s)")
+
+    parser.add_argument(
+        '--srcdict', type=os.path.abspath, default=DEFAULT_SRCDICT,
+        help="source dictionary of --output_format fairseq (default: %(default)s)")
+
+    parser.add_argument(
+        '--tgtdict', type=os.path.abspath, default=DEFAULT_TGTDICT,
+        help="target dictionary of --output_format fairseq (default: %(default)s)")
+
+    parser.add_argument(
+        '--split', type=str, default='train',
+        help="name of the split of --output_format fairseq (default: %(default)s)")
+
 
 def create_parser():
     parser = argparse.ArgumentParser(
@@ -35,9 +141,9 @@ def create_parser():
         help="If set, input file is interpreted as a dictionary where each line contains a word-count pair")
 
     parser.add_argument(
-        '--output', '-o', type=argparse.FileType('w'), default=sys.stdout,
+        '--output', '-o', type=os.path.abspath, default=None,
         metavar='PATH',
-        help="Output file for BPE codes (default: standard output)")
+        help="Output file (default: standard output)")
     parser.add_argument(
         '--threshold', '-t', type=int, default=0,
         help="Create this many new symbols (each representing a character n-gram) (default: %(default)s))")
@@ -48,29 +154,24 @@ def create_parser():
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
 
-    parser.add_argument(
-        '--prob_mask', '-pm', type=float, default=0.5,
-        help="probability to use mask")
+    add_noise_args(parser)
 
     parser.add_argument(
-        '--prob_orig', '-po', type=float, default=0.2,
-        help="probability to use original token")
+        '--checkpoint_every', type=int, default=0,
+        help="if > 0, write a checkpoint to OUTPUT.ckpt every this many lines (requires --input and --output)")
 
     parser.add_argument(
-        '--unigram_freq', '-uf', type=os.path.abspath,
-        help="verbose mode.")
-
-    parser.add_argument(
-        '--single_mistake', '-sm', type=int, choices=[0, 1],
-        help="if we want single mistake...")
+        '--resume', action='store_true',
+        help="continue from OUTPUT.ckpt. The output is byte-identical to an uninterrupted run")
 
     parser.add_argument(
-        '--use_insertion', '-ui', type=int, choices=[0, 1], default=1,
-        help="generate error by insertion?")
+        '--bpe_codes', type=os.path.abspath, default=None,
+        help="segment the input with these BPE codes (e.g. bpe/bpe_code.trg.dict_bpe8000) before making "
+             "mistakes, instead of running apply_bpe.py as a separate pass")
 
-    parser.add_argument(
-        '--use_deletion', '-ud', type=int, choices=[0, 1], default=1,
-        help="generate error by deletion?")
+    add_selection_args(parser)
+    add_stats_args(parser)
+    add_server_args(parser)
 
     return parser
 
@@ -110,323 +211,642 @@ def get_vocabulary(fobj, threshold):
     return p_dict
 
 
-def update_pair_statistics(pair, changed, stats, indices):
-    """Minimally update the indices and frequency of symbol pairs
+def make_mistakes(line, rng, index2word, sampler, prob_mask=0.3, prob_orig=0.2, use_insertion=1, use_deletion=1,
+                  wlist=None, counts=None):
+    """Corrupt every token of `line` independently and return the `src ||| trg` pair
 
-    if we merge a pair of symbols, only pairs that overlap with occurrences
-    of this pair are affected, and need to be updated.
+    `wlist` are the tokens of `line` if they were already split (e.g. for several variants)
+    `counts` (a list indexed by KEEP, MASK, INSERT, DELETE and PAD) is incremented by the
+    operations applied to the tokens and by 1 at PAD if the pair is identical
     """
-    stats[pair] = 0
-    indices[pair] = defaultdict(int)
-    first, second = pair
-    new_pair = first + second
-    for j, word, old_word, freq in changed:
-
-        # find all instances of pair, and update frequency/indices around it
-        i = 0
-        while True:
-            # find first symbol
-            try:
-                i = old_word.index(first, i)
-            except ValueError:
-                break
-            # if first symbol is followed by second symbol, we've found an occurrence of pair (old_word[i:i+2])
-            if i < len(old_word) - 1 and old_word[i + 1] == second:
-                # assuming a symbol sequence "A B C", if "B C" is merged, reduce the frequency of "A B"
-                if i:
-                    prev = old_word[i - 1:i + 1]
-                    stats[prev] -= freq
-                    indices[prev][j] -= 1
-                if i < len(old_word) - 2:
-                    # assuming a symbol sequence "A B C B", if "B C" is merged, reduce the frequency of "C B".
-                    # however, skip this if the sequence is A B C B C, because the frequency of "C B" will be reduced by the previous code block
-                    if old_word[i + 2] != first or i >= len(old_word) - 3 or old_word[i + 3] != second:
-                        nex = old_word[i + 1:i + 3]
-                        stats[nex] -= freq
-                        indices[nex][j] -= 1
-                i += 2
-            else:
-                i += 1
-
-        i = 0
-        while True:
-            try:
-                # find new pair
-                i = word.index(new_pair, i)
-            except ValueError:
-                break
-            # assuming a symbol sequence "A BC D", if "B C" is merged, increase the frequency of "A BC"
-            if i:
-                prev = word[i - 1:i + 1]
-                stats[prev] += freq
-                indices[prev][j] += 1
-            # assuming a symbol sequence "A BC B", if "B C" is merged, increase the frequency of "BC B"
-            # however, if the sequence is A BC BC, skip this step because the count of "BC BC" will be incremented by the previous code block
-            if i < len(word) - 1 and word[i + 1] != new_pair:
-                nex = word[i:i + 2]
-                stats[nex] += freq
-                indices[nex][j] += 1
-            i += 1
-
-
-def get_pair_statistics(vocab):
-    """Count frequency of all symbol pairs, and create index"""
-
-    # bpe structure of pair frequencies
-    stats = defaultdict(int)
-
-    # index from pairs to words
-    indices = defaultdict(lambda: defaultdict(int))
-
-    for i, (word, freq) in enumerate(vocab):
-        prev_char = word[0]
-        for char in word[1:]:
-            stats[prev_char, char] += freq
-            indices[prev_char, char][i] += 1
-            prev_char = char
-
-    return stats, indices
-
-
-def replace_pair(pair, vocab, indices):
-    """Replace all occurrences of a symbol pair ('A', 'B') with a new symbol 'AB'"""
-    first, second = pair
-    pair_str = ''.join(pair)
-    pair_str = pair_str.replace('\\', '\\\\')
-    changes = []
-    pattern = re.compile(r'(?<!\S)' + re.escape(first + ' ' + second) + r'(?!\S)')
-    if sys.version_info < (3, 0):
-        iterator = indices[pair].iteritems()
-    else:
-        iterator = indices[pair].items()
-    for j, freq in iterator:
-        if freq < 1:
-            continue
-        word, freq = vocab[j]
-        new_word = ' '.join(word)
-        new_word = pattern.sub(pair_str, new_word)
-        new_word = tuple(new_word.split(' '))
-
-        vocab[j] = (new_word, freq)
-        changes.append((j, new_word, word, freq))
-
-    return changes
-
-
-def prune_stats(stats, big_stats, threshold):
-    """Prune statistics dict for efficiency of max()
+    if wlist is None:
+        wlist = line.strip('\r\n ').split(' ')
 
-    The frequency of a symbol pair never increases, so pruning is generally safe
-    (until we the most frequent pair is less frequent than a pair we previously pruned)
-    big_stats keeps full statistics for when we need to access pruned items
-    """
-    for item, freq in list(stats.items()):
-        if freq < threshold:
-            del stats[item]
-            if freq < 0:
-                big_stats[item] += freq
+    output_list = []
+    for i in range(1):  # 複数の候補を作る場合はここの数を修正する
+        maxlen = len(wlist)
+        cnt = 0
+        t_out = ""
+        n_mask = n_insert = n_delete = 0
+        while cnt < maxlen:
+            rnd = rng.random()
+            if rnd < prob_orig:  # 空リストのばあいは必ずスキップ or 確率0.3以下で元の単語を選択
+                t_out += wlist[cnt] + ' '  # 出力の文字列
+                cnt += 1
+            elif rnd < prob_mask:  # 空リストのばあいは必ずスキップ or 確率0.3以下で元の単語を選択
+                t_out += '| '  # 出力の文字列
+                cnt += 1
+                n_mask += 1
             else:
-                big_stats[item] = freq
-
-
-def main(dict_file, infile, outfile, threshold, index2word, word_index_list, r_seed=1, verbose=False, is_dict=False,
-         prob_mask=0.3, prob_orig=0.2, args=None):
-    """Learn num_symbols BPE operations from vocabulary, and write to outfile.
-    """
+                rnd2 = rng.random()
+                if rnd2 < 0.5:  # insert
+                    t_out += wlist[cnt] + ' '
+                    if use_insertion:
+                        index = sampler.sample(rng)
+                        t_out += index2word[index] + ' '
+                        n_insert += 1
+                    cnt += 1
+                else:  # delete
+                    if not use_deletion:
+                        t_out += wlist[cnt] + ' '
+                    else:
+                        n_delete += 1
+                    cnt += 1
+        if counts is not None:
+            count_operations(counts, maxlen, n_mask, n_insert, n_delete)
+        output_list.append(_format_pair(t_out, line, rng, counts))
+    return rng.choice(output_list)
 
-    sys.stderr.write('random seed: {}\n'.format(r_seed))
-    random.seed(r_seed)
-    # version 0.2 changes the handling of the end-of-word token ('</w>');
-    # version numbering allows bckward compatibility
-    # outfile.write('#version: 0.2\n')
 
-    # vocab = get_vocabulary(dict_file, threshold)
-    # for z in vocab:
-    #     sys.stdout.write('vocab[{}] ||| {} ||| {}\n'.format(z, len(vocab[z]), vocab[z]))
+def make_single_mistake(line, rng, index2word, sampler, prob_mask=0.3, prob_orig=0.2, wlist=None, counts=None):
+    """Corrupt one randomly chosen token of `line` and return the `src ||| trg` pair
 
-    proceed = 0
-    skip = 0
-    # with open(infile, 'r') as fi:
-    for c, line in enumerate(sys.stdin):  # 入力分の読み込み
+    `counts` is incremented as in `make_mistakes`
+    """
+    if wlist is None:
         wlist = line.strip('\r\n ').split(' ')
-        proceed += 1
 
-        output_list = []
-        for i in range(1):  # 複数の候補を作る場合はここの数を修正する
-            maxlen = len(wlist)
-            cnt = 0
-            t_out = ""
-            # sys.stdout.write('#START {}->{}: {}\n'.format(i,maxlen, t_out))
-            # print('original: ', wlist)
-            # print()
-            while cnt < maxlen:
-                rnd = random.random()
-                # print('focus: {}'.format(wlist[cnt]))
+    output_list = []
+    for i in range(1):  # 複数の候補を作る場合はここの数を修正する
+        maxlen = len(wlist)
+        cnt = 0
+        t_out = ""
+        mistake_idx = rng.choice(list(range(maxlen)))
+        n_mask = n_insert = n_delete = 0
+        while cnt < maxlen:
+            if mistake_idx == cnt:
+                rnd = rng.random()
                 if rnd < prob_orig:  # 空リストのばあいは必ずスキップ or 確率0.3以下で元の単語を選択
-                    # t_out += '**' + wlist[cnt] + ' ' # 出力の文字列
                     t_out += wlist[cnt] + ' '  # 出力の文字列
-                    # sys.stdout.write('# {} | {}\n'.format(cnt, t_out))
-                    # print('keep orig: {}'.format(wlist[cnt]))
                     cnt += 1
                 elif rnd < prob_mask:  # 空リストのばあいは必ずスキップ or 確率0.3以下で元の単語を選択
                     t_out += '| '  # 出力の文字列
-                    # print('masking: {}'.format(wlist[cnt]))
                     cnt += 1
+                    n_mask = 1
                 else:
-                    rnd2 = random.random()
+                    rnd2 = rng.random()
                     if rnd2 < 0.5:  # insert
                         t_out += wlist[cnt] + ' '
-                        if args.use_insertion:
-                            index = random.choice(word_index_list)
-                            t_out += index2word[index] + ' '
+                        index = sampler.sample(rng)
+                        t_out += index2word[index] + ' '
                         cnt += 1
-                        # sys.stderr.write('insert: {}\n'.format(index2word[index]))
+                        n_insert = 1
                     else:  # delete
-                        # sys.stderr.write('delete: {}\n'.format(wlist[cnt]))
-                        if not args.use_deletion:
-                            t_out += wlist[cnt] + ' '
                         cnt += 1
-                # print(t_out)
-            if t_out.strip('\r\n ') == line.strip('\r\n '):
-                # sys.stdout.write('#SAME {}||| {}'.format(t_out, line))
-                padsize = random.randrange(1, 9)
-                pad = ""
-                for i in range(padsize):
-                    pad += '| '
-                output_list.append('{}||| {}{}'.format(t_out, pad, line))
+                        n_delete = 1
             else:
-                output_list.append('{}||| {}'.format(t_out, line))
-            # print(output_list[0])
-            # exit()
-        # sys.stdout.write('{}\n'.format( len(output_list)))
-        sys.stdout.write('{}'.format(random.choice(output_list)))
+                t_out += wlist[cnt] + ' '
+                cnt += 1
+        if counts is not None:
+            count_operations(counts, maxlen, n_mask, n_insert, n_delete)
+        output_list.append(_format_pair(t_out, line, rng, counts))
+    return rng.choice(output_list)
+
+
+def count_operations(counts, n_tokens, n_mask, n_insert, n_delete):
+    counts[KEEP] += n_tokens - n_mask - n_insert - n_delete
+    counts[MASK] += n_mask
+    counts[INSERT] += n_insert
+    counts[DELETE] += n_delete
+
+
+def _format_pair(t_out, line, rng, counts=None):
+    if t_out.strip('\r\n ') == line.strip('\r\n '):
+        # 元の文と同じになった場合はtarget側にpadを付ける
+        if counts is not None:
+            counts[PAD] += 1
+        padsize = rng.randrange(1, 9)
+        pad = ""
+        for i in range(padsize):
+            pad += '| '
+        return '{}||| {}{}'.format(t_out, pad, line)
+    else:
+        return '{}||| {}'.format(t_out, line)
+
+
+def main(dict_file, infile, outfile, threshold, index2word, sampler, r_seed=1, verbose=False, is_dict=False,
+         prob_mask=0.3, prob_orig=0.2, args=None, stats=None, speller=None):
+    """Make mistakes in each token of the sentences from stdin.
+    """
+
+    sys.stderr.write('random seed: {}\n'.format(r_seed))
+    random.seed(r_seed)
+
+    proceed = 0
+    skip = 0
+    counts = register_operations(stats)
+    for c, line in enumerate(sys.stdin):  # 入力分の読み込み
+        proceed += 1
+        sys.stdout.write(make_mistakes(line, random, index2word, sampler, prob_mask=prob_mask, prob_orig=prob_orig,
+                                       use_insertion=args.use_insertion, use_deletion=args.use_deletion,
+                                       wlist=misspelled_tokens(line, random, speller, counts), counts=counts))
+        if stats is not None:
+            stats.update()
     sys.stderr.write('# {} {}\n'.format(proceed, skip))
     return 0
 
 
-def single_mistake(dict_file, infile, outfile, threshold, index2word, word_index_list, r_seed=1, verbose=False, is_dict=False,
-         prob_mask=0.3, prob_orig=0.2):
-    """Learn num_symbols BPE operations from vocabulary, and write to outfile.
+def single_mistake(dict_file, infile, outfile, threshold, index2word, sampler, r_seed=1, verbose=False, is_dict=False,
+         prob_mask=0.3, prob_orig=0.2, stats=None, speller=None):
+    """Make a single mistake in each sentence from stdin.
     """
 
     sys.stderr.write('random seed: {}\n'.format(r_seed))
     random.seed(r_seed)
-    # version 0.2 changes the handling of the end-of-word token ('</w>');
-    # version numbering allows bckward compatibility
-    # outfile.write('#version: 0.2\n')
-
-    # vocab = get_vocabulary(dict_file, threshold)
-    # for z in vocab:
-    #     sys.stdout.write('vocab[{}] ||| {} ||| {}\n'.format(z, len(vocab[z]), vocab[z]))
 
     proceed = 0
     skip = 0
-    # with open(infile, 'r') as fi:
+    counts = register_operations(stats)
     for c, line in enumerate(sys.stdin):  # 入力分の読み込み
-        wlist = line.strip('\r\n ').split(' ')
         proceed += 1
+        sys.stdout.write(make_single_mistake(line, random, index2word, sampler, prob_mask=prob_mask,
+                                             prob_orig=prob_orig, wlist=misspelled_tokens(line, random, speller, counts),
+                                             counts=counts))
+        if stats is not None:
+            stats.update()
+    sys.stderr.write('# {} {}\n'.format(proceed, skip))
+    return 0
 
-        output_list = []
-        for i in range(1):  # 複数の候補を作る場合はここの数を修正する
-            maxlen = len(wlist)
-            cnt = 0
-            t_out = ""
-            # sys.stdout.write('#START {}->{}: {}\n'.format(i,maxlen, t_out))
-            # print('original: ', wlist)
-            # print()
-            mistake_idx = random.choice(list(range(maxlen)))
-            while cnt < maxlen:
-                if mistake_idx == cnt:
-                    # print('i am making mistake', cnt, mistake_idx)
-                    rnd = random.random()
-                    # print(rnd)
-                    # print('focus: {}'.format(wlist[cnt]))
-                    if rnd < prob_orig:  # 空リストのばあいは必ずスキップ or 確率0.3以下で元の単語を選択
-                        # t_out += '**' + wlist[cnt] + ' ' # 出力の文字列
-                        t_out += wlist[cnt] + ' '  # 出力の文字列
-                        # sys.stdout.write('# {} | {}\n'.format(cnt, t_out))
-                        # print('keep orig: {}'.format(wlist[cnt]))
-                        cnt += 1
-                    elif rnd < prob_mask:  # 空リストのばあいは必ずスキップ or 確率0.3以下で元の単語を選択
-                        t_out += '| '  # 出力の文字列
-                        # print('masking: {}'.format(wlist[cnt]))
-                        cnt += 1
-                    else:
-                        rnd2 = random.random()
-                        # print(rnd2)
-                        if rnd2 < 0.5:  # insert
-                            t_out += wlist[cnt] + ' '
-                            index = random.choice(word_index_list)
-                            t_out += index2word[index] + ' '
-                            cnt += 1
-                            # sys.stdout.write('insert: {}\n'.format(index2word[index]))
-                        else:  # delete
-                            # sys.stdout.write('delete: {}\n'.format(wlist[cnt]))
-                            cnt += 1
-                else:
-                    # print('keep original', wlist[cnt])
-                    # print(t_out)
-                    t_out += wlist[cnt] + ' '
-                    cnt += 1
-                # print(t_out)
-            if t_out.strip('\r\n ') == line.strip('\r\n '):
-                # sys.stdout.write('#SAME {}||| {}'.format(t_out, line))
-                padsize = random.randrange(1, 9)
-                pad = ""
-                for i in range(padsize):
-                    pad += '| '
-                output_list.append('{}||| {}{}'.format(t_out, pad, line))
-            else:
-                output_list.append('{}||| {}'.format(t_out, line))
-            # print(output_list[0])
-            # exit()
-        # sys.stdout.write('{}\n'.format( len(output_list)))
-        sys.stdout.write('{}'.format(random.choice(output_list)))
+
+def register_operations(stats):
+    """the list of operation counts of `stats`, or None without statistics"""
+    if stats is None:
+        return None
+    return stats.add_counters('operations', [0] * len(OPERATIONS), OPERATIONS, token_labels=OPERATIONS[:PAD])
+
+
+def add_counts(counts, other):
+    for op, n in enumerate(other):
+        counts[op] += n
+
+
+def expected_rates(args):
+    """rate of every operation per token implied by -po, -pm, --use_insertion and --use_deletion"""
+    keep = args.prob_orig
+    mask = max(args.prob_mask - args.prob_orig, 0.0)
+    insert = delete = (1.0 - keep - mask) / 2
+    if not args.use_insertion:
+        keep, insert = keep + insert, 0.0
+    if not args.use_deletion:
+        keep, delete = keep + delete, 0.0
+    return dict(zip(OPERATIONS, [keep, mask, insert, delete]))
+
+
+def report_operation_rates(stats, args):
+    """log and record the achieved operation rates next to the expected ones, and the rate of padded pairs"""
+    if 'operations' not in stats.groups:
+        return
+    counts = stats.counters('operations')
+    n_tokens = max(sum(counts[op] for op in OPERATIONS[:PAD]), 1)
+    # --single_mistake corrupts one token per line, so there is no fixed rate per token
+    expected = {} if args.single_mistake else expected_rates(args)
+    rates = []
+    for op in OPERATIONS[:PAD]:
+        stats.set('{}_rate'.format(op), counts[op] / n_tokens)
+        rates.append('{} {:.4f}'.format(op, counts[op] / n_tokens))
+        if op in expected:
+            stats.set('expected_{}_rate'.format(op), expected[op])
+            rates[-1] += ' (expected {:.4f})'.format(expected[op])
+    pad_rate = counts['pad'] / max(stats.lines * args.num_variants, 1)
+    stats.set('pad_rate', pad_rate)
+    logger.info('operation rates per token: {}; identical pairs padded: {:.4f}'.format(', '.join(rates), pad_rate))
+    if args.spelling_prob:
+        logger.info('misspelled words: {}'.format(counts['misspelled']))
+
+
+def chunk_seed(r_seed, chunk_index):
+    """seed of the `chunk_index`-th chunk; independent of the number of workers"""
+    return '{}-{}'.format(r_seed, chunk_index)
+
+
+def variant_seed(r_seed, variant):
+    """seed of the `variant`-th corruption of the input; variant 0 is the run without --num_variants"""
+    if variant == 0:
+        return r_seed
+    return '{}-v{}'.format(r_seed, variant)
+
+
+def variant_paths(output, num_variants):
+    if num_variants == 1:
+        return [output]
+    return numbered_paths(output, num_variants)
+
+
+def input_blocks(args):
+    """blocks of whole lines of --input (or stdin), only of the lines selected by --lines etc. if given"""
+    if has_selection(args):
+        return iter_selected_blocks(args.input, args)
+    return iter_line_blocks(args.input)
+
+
+def open_output(path, args):
+    """text file (compressed by its extension) or fairseq dataset directory, both written with str"""
+    if args.output_format == 'fairseq':
+        return PairWriter(path, args.srcdict, args.tgtdict, args.split)
+    return TextWriter(path)
+
+
+def noise_options(args):
+    """keyword arguments of `corrupt_line` and `vectorized_noise.corrupt_batch`"""
+    return {
+        'prob_mask': args.prob_mask,
+        'prob_orig': args.prob_orig,
+        'use_insertion': args.use_insertion,
+        'use_deletion': args.use_deletion,
+        'single_mistake': args.single_mistake,
+    }
+
+
+def get_speller(args):
+    """the spelling_noise.Speller of --spelling_prob, or None without spelling errors"""
+    if not args.spelling_prob:
+        return None
+    from spelling_noise import Speller
+    return Speller(args.spelling_prob, args.spelling_table, args.spelling_codes)
+
+
+def misspelled_tokens(line, rng, speller, counts=None, wlist=None):
+    """the tokens of `line` with the spelling errors of `speller`, or None (the tokens of `line`) without speller"""
+    if speller is None:
+        return wlist
+    if wlist is None:
+        wlist = line.strip('\r\n ').split(' ')
+    return speller.misspell_tokens(wlist, rng, counts)
+
+
+def corrupt_line(line, rng, index2word, sampler, prob_mask=0.3, prob_orig=0.2, use_insertion=1, use_deletion=1,
+                 single_mistake=0, wlist=None, counts=None, speller=None):
+    wlist = misspelled_tokens(line, rng, speller, counts, wlist)
+    if single_mistake:
+        return make_single_mistake(line, rng, index2word, sampler, prob_mask=prob_mask, prob_orig=prob_orig,
+                                   wlist=wlist, counts=counts)
+    return make_mistakes(line, rng, index2word, sampler, prob_mask=prob_mask, prob_orig=prob_orig,
+                         use_insertion=use_insertion, use_deletion=use_deletion, wlist=wlist, counts=counts)
+
+
+def iter_chunks(fi, chunk_size):
+    chunk = []
+    for line in fi:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_worker_state = None
+
+
+def _init_worker(state):
+    # with the fork start method the tables are inherited, not pickled
+    global _worker_state
+    _worker_state = state
+
+
+def _noise_chunk(job):
+    """return the number of lines, the output of every variant and the operation counts of one chunk"""
+    chunk_index, lines = job
+    state = _worker_state
+    variants = range(state['num_variants'])
+    counts = [0] * len(OPERATIONS)
+    if state['engine'] == 'numpy':
+        import vectorized_noise
+        rngs = [vectorized_noise.chunk_generator(state['r_seed'], chunk_index, k) for k in variants]
+        outputs = [[] for _ in variants]
+        for batch in vectorized_noise.iter_batches(lines, state['batch_size']):
+            parsed = vectorized_noise.parse_batch(batch)
+            for rng, out in zip(rngs, outputs):
+                out.append(vectorized_noise.corrupt_parsed(parsed, rng, state['vocab'], state['sampler'],
+                                                           counts=counts, speller=state['speller'],
+                                                           **state['options']))
+        return len(lines), [''.join(out) for out in outputs], counts
+    wlists = [line.strip('\r\n ').split(' ') for line in lines]
+    outputs = []
+    for k in variants:
+        rng = random.Random(chunk_seed(variant_seed(state['r_seed'], k), chunk_index))
+        outputs.append(''.join([corrupt_line(line, rng, state['index2word'], state['sampler'], wlist=wlist,
+                                             counts=counts, speller=state['speller'], **state['options'])
+                                for line, wlist in zip(lines, wlists)]))
+    return len(lines), outputs, counts
+
+
+def _sharded_state(index2word, sampler, args):
+    state = {
+        'index2word': index2word,
+        'sampler': sampler,
+        'r_seed': args.seed,
+        'options': noise_options(args),
+        'engine': args.engine,
+        'batch_size': args.batch_size,
+        'num_variants': args.num_variants,
+        'speller': get_speller(args),
+    }
+    if args.engine == 'numpy':
+        import vectorized_noise
+        state['vocab'] = vectorized_noise.as_vocab_array(index2word)
+    return state
+
+
+def sharded(index2word, sampler, args, stats=None):
+    """Process stdin in chunks with a pool of `args.workers` processes.
+
+    Each chunk is corrupted with its own seed derived from `--seed` and the chunk index,
+    so the output does not depend on the number of workers.
+    """
+    sys.stderr.write('random seed: {}\n'.format(args.seed))
+    state = _sharded_state(index2word, sampler, args)
+    proceed = 0
+    skip = 0
+    counts = register_operations(stats)
+    pool = get_pool(args.workers, _init_worker, (state,))
+    try:
+        jobs = enumerate(iter_chunks(sys.stdin, args.chunk_size))
+        for n_lines, outputs, chunk_counts in ordered_imap(pool, _noise_chunk, jobs, 2 * args.workers):
+            proceed += n_lines
+            sys.stdout.write(outputs[0])
+            if stats is not None:
+                add_counts(counts, chunk_counts)
+                stats.update(n_lines)
+    finally:
+        pool.close()
+        pool.join()
+    sys.stderr.write('# {} {}\n'.format(proceed, skip))
+    return 0
+
+
+def vectorized(index2word, sampler, args, stats=None):
+    """Corrupt stdin in batches with the numpy engine."""
+    import vectorized_noise
+
+    sys.stderr.write('random seed: {}\n'.format(args.seed))
+    rng = vectorized_noise.chunk_generator(args.seed, 0)
+    vocab = vectorized_noise.as_vocab_array(index2word)
+    proceed = vectorized_noise.generate(
+        sys.stdin, sys.stdout, rng, vocab, sampler, batch_size=args.batch_size, stats=stats,
+        counts=register_operations(stats), prob_mask=args.prob_mask, prob_orig=args.prob_orig,
+        use_insertion=args.use_insertion, use_deletion=args.use_deletion, single_mistake=args.single_mistake,
+        speller=get_speller(args))
+    skip = 0
+    sys.stderr.write('# {} {}\n'.format(proceed, skip))
+    return 0
+
+
+class SequentialCorruptor(object):
+    """the default engine: one `random` stream per variant over the whole input"""
+
+    def __init__(self, index2word, sampler, args):
+        self.index2word = index2word
+        self.sampler = sampler
+        self.options = noise_options(args)
+        # random.Random(seed) gives the same stream as random.seed(seed) in main()
+        self.rngs = [random.Random(variant_seed(args.seed, k)) for k in range(args.num_variants)]
+        self.speller = get_speller(args)
+        self.counts = [0] * len(OPERATIONS)
+
+    def state(self):
+        return [encode_random_state(rng.getstate()) for rng in self.rngs]
+
+    def restore(self, state):
+        for rng, rng_state in zip(self.rngs, state):
+            rng.setstate(decode_random_state(rng_state))
+
+    def units(self, fi):
+        """yield (number of lines, number of input bytes, output of every variant) for each line of binary `fi`"""
+        for raw in fi:
+            line = raw.decode('utf-8')
+            wlist = line.strip('\r\n ').split(' ')
+            yield 1, len(raw), [corrupt_line(line, rng, self.index2word, self.sampler, wlist=wlist,
+                                             counts=self.counts, speller=self.speller, **self.options)
+                                for rng in self.rngs]
+
+
+class BatchCorruptor(object):
+    """the numpy engine: one numpy Generator over batches of the input"""
+
+    def __init__(self, index2word, sampler, args):
+        import vectorized_noise
+        self.engine = vectorized_noise
+        self.vocab = vectorized_noise.as_vocab_array(index2word)
+        self.sampler = sampler
+        self.options = noise_options(args)
+        self.batch_size = args.batch_size
+        self.rngs = [vectorized_noise.chunk_generator(args.seed, 0, k) for k in range(args.num_variants)]
+        self.speller = get_speller(args)
+        self.counts = [0] * len(OPERATIONS)
+
+    def state(self):
+        return [rng.bit_generator.state for rng in self.rngs]
+
+    def restore(self, state):
+        for rng, rng_state in zip(self.rngs, state):
+            rng.bit_generator.state = rng_state
+
+    def units(self, fi):
+        for batch in self.engine.iter_batches(fi, self.batch_size):
+            parsed = self.engine.parse_batch([raw.decode('utf-8') for raw in batch])
+            yield len(batch), sum(len(raw) for raw in batch), [
+                self.engine.corrupt_parsed(parsed, rng, self.vocab, self.sampler, counts=self.counts,
+                                           speller=self.speller, **self.options)
+                for rng in self.rngs]
+
+
+class ShardedCorruptor(object):
+    """--workers: chunks seeded by their index, so the state is the next chunk index"""
+
+    def __init__(self, index2word, sampler, args):
+        self.worker_state = _sharded_state(index2word, sampler, args)
+        self.args = args
+        self.next_chunk = 0
+        self.counts = [0] * len(OPERATIONS)
+
+    def state(self):
+        return self.next_chunk
+
+    def restore(self, state):
+        self.next_chunk = state
+
+    def units(self, fi):
+        chunk_bytes = deque()
+        pool = get_pool(self.args.workers, _init_worker, (self.worker_state,))
+        try:
+            def jobs():
+                for n, chunk in enumerate(iter_chunks(fi, self.args.chunk_size), self.next_chunk):
+                    chunk_bytes.append(sum(len(raw) for raw in chunk))
+                    yield n, [raw.decode('utf-8') for raw in chunk]
+
+            for n_lines, outputs, counts in ordered_imap(pool, _noise_chunk, jobs(), 2 * self.args.workers):
+                self.next_chunk += 1
+                add_counts(self.counts, counts)
+                yield n_lines, chunk_bytes.popleft(), outputs
+        finally:
+            pool.close()
+            pool.join()
+
+
+def get_corruptor(index2word, sampler, args):
+    if args.workers > 0:
+        return ShardedCorruptor(index2word, sampler, args)
+    elif args.engine == 'numpy':
+        return BatchCorruptor(index2word, sampler, args)
+    return SequentialCorruptor(index2word, sampler, args)
+
+
+def resumable(index2word, sampler, args, stats=None):
+    """Corrupt --input into --output and write a checkpoint every --checkpoint_every lines."""
+    if args.input is None or args.output is None:
+        raise ValueError('--checkpoint_every and --resume require --input and --output')
+    corruptor = get_corruptor(index2word, sampler, args)
+    if stats is not None:
+        stats.add_counters('operations', corruptor.counts, OPERATIONS, token_labels=OPERATIONS[:PAD])
+    config = {key: getattr(args, key) for key in [
+        'seed', 'prob_mask', 'prob_orig', 'single_mistake', 'use_insertion', 'use_deletion', 'sampler',
+        'engine', 'batch_size', 'chunk_size', 'unigram_freq', 'num_variants']}
+    config['sharded'] = args.workers > 0
+
+    ckpt = checkpoint_path(args.output)
+    state = load_checkpoint(ckpt) if args.resume else None
+    if state is None:
+        in_offset = proceed = 0
+        out_offsets = [None] * args.num_variants
+    else:
+        if state['config'] != config:
+            raise ValueError('options differ from the checkpoint: {}'.format(state['config']))
+        in_offset, out_offsets, proceed = state['in_offset'], state['out_offsets'], state['lines']
+        corruptor.restore(state['rng_state'])
+
+    sys.stderr.write('random seed: {}\n'.format(args.seed))
+    skip = 0
+    last_checkpoint = proceed
+    fos = [ResumableOutput(path, offset=offset)
+           for path, offset in zip(variant_paths(args.output, args.num_variants), out_offsets)]
+    with open(args.input, 'rb') as fi:
+        fi.seek(in_offset)
+        for n_lines, n_bytes, outputs in corruptor.units(fi):
+            for fo, out in zip(fos, outputs):
+                fo.write(out.encode('utf-8'))
+            proceed += n_lines
+            in_offset += n_bytes
+            if stats is not None:
+                stats.update(n_lines)
+            if args.checkpoint_every > 0 and proceed - last_checkpoint >= args.checkpoint_every:
+                save_checkpoint(ckpt, in_offset=in_offset, lines=proceed, out_offsets=[fo.sync() for fo in fos],
+                                rng_state=corruptor.state(), config=config)
+                last_checkpoint = proceed
+    save_checkpoint(ckpt, in_offset=in_offset, lines=proceed, out_offsets=[fo.sync() for fo in fos],
+                    rng_state=corruptor.state(), config=config)
+    for fo in fos:
+        fo.close()
+    sys.stderr.write('# {} {}\n'.format(proceed, skip))
+    return 0
+
+
+def variants(index2word, sampler, args, stats=None):
+    """Read the input once and write --num_variants independent corruptions to OUTPUT.0, OUTPUT.1, ...
+
+    Variant k is seeded by `variant_seed(--seed, k)` (by the chunk index as well with --workers),
+    so each output is reproducible on its own and OUTPUT.0 is the output of a run without --num_variants.
+    """
+    if args.output is None:
+        raise ValueError('--num_variants requires --output')
+    corruptor = get_corruptor(index2word, sampler, args)
+    if stats is not None:
+        stats.add_counters('operations', corruptor.counts, OPERATIONS, token_labels=OPERATIONS[:PAD])
+    sys.stderr.write('random seed: {}\n'.format(args.seed))
+    proceed = 0
+    skip = 0
+    lines = byte_lines_of_blocks(input_blocks(args))
+    if args.bpe_codes is not None:
+        lines = (line.encode('utf-8') for line in BPE(args.bpe_codes).segment_lines(
+            raw.decode('utf-8') for raw in lines))
+    fos = [open_output(path, args) for path in variant_paths(args.output, args.num_variants)]
+    try:
+        for n_lines, _, outputs in corruptor.units(lines):
+            for fo, out in zip(fos, outputs):
+                fo.write(out)
+            proceed += n_lines
+            if stats is not None:
+                stats.update(n_lines)
+    finally:
+        for fo in fos:
+            fo.close()
     sys.stderr.write('# {} {}\n'.format(proceed, skip))
     return 0
 
 
-def read_unigram_freq(path_to_unigram_freq):
-    index2word = {}
-    word_index_list = []
-    with open(path_to_unigram_freq, 'r') as fi:
-        for n, line in enumerate(fi):
-            token, freq = line.strip().split('\t')
-            index2word[n] = token
-            word_index_list += [n] * int(freq)
-    return index2word, word_index_list
+def read_unigram_freq(path_to_unigram_freq, method='cumsum', use_cache=True):
+    return load_sampler(path_to_unigram_freq, method, use_cache)
 
 
 if __name__ == '__main__':
     # python 2/3 compatibility
     if sys.version_info < (3, 0):
         sys.stderr = codecs.getwriter('UTF-8')(sys.stderr)
-        sys.stdout = codecs.getwriter('UTF-8')(sys.stdout)
-        sys.stdin = codecs.getreader('UTF-8')(sys.stdin)
     else:
         sys.stderr = codecs.getwriter('UTF-8')(sys.stderr.buffer)
-        sys.stdout = codecs.getwriter('UTF-8')(sys.stdout.buffer)
-        sys.stdin = codecs.getreader('UTF-8')(sys.stdin.buffer)
 
     parser = create_parser()
     args = parser.parse_args()
 
-    # read/write files as UTF-8
-    # if args.input.name != '<stdin>':
-    #     pass
-        # args.input = codecs.open(args.input.name, encoding='utf-8')
-    if args.output.name != '<stdout>':
-        args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
-
-    # word_index_listには，単語のindexが頻度個だけ並んでいる
+    if args.output_format == 'fairseq':
+        if args.output is None:
+            parser.error('--output_format fairseq requires --output')
+        if args.checkpoint_every or args.resume:
+            parser.error('--output_format fairseq does not support --checkpoint_every and --resume')
+    if args.bpe_codes is not None and (args.checkpoint_every or args.resume):
+        parser.error('--bpe_codes does not support --checkpoint_every and --resume')
+    if (args.checkpoint_every or args.resume) and any(
+            path is not None and compression_of_path(path) for path in [args.input, args.output]):
+        parser.error('--checkpoint_every and --resume need an uncompressed --input and --output')
+    if has_selection(args) and args.input is None:
+        parser.error('--lines, --line_shard and --sample_lines need --input')
+    if has_selection(args) and (args.checkpoint_every or args.resume):
+        parser.error('--lines, --line_shard and --sample_lines do not support --checkpoint_every and --resume')
+    if args.serve is not None and (args.input is not None or args.output is not None or args.checkpoint_every
+                                   or args.resume or args.num_variants > 1 or args.bpe_codes is not None):
+        parser.error('--serve answers the requests of clients and takes no input or output options')
+    if args.serve is not None and args.spelling_prob:
+        parser.error('--serve does not support --spelling_prob')
+
+    if args.serve is not None:
+        # the tables are loaded once and shared by all clients
+        stats = RunStats('generate_pseudo_samples', args.progress_every)
+        serve(args, stats)
+        stats.finish(args.stats)
+        sys.exit(0)
+
+    # read/write (possibly compressed) files or stdin/stdout as UTF-8 in large blocks;
+    # resumable() and variants() open them themselves
+    opens_files = args.checkpoint_every or args.resume or args.num_variants > 1
+    if not opens_files:
+        sys.stdin = lines_of_blocks(input_blocks(args))
+        sys.stdout = open_output(args.output, args) if args.output is not None else TextWriter(None)
+    if args.bpe_codes is not None and not opens_files:
+        sys.stdin = BPE(args.bpe_codes).segment_lines(sys.stdin)
+
+    # samplerは単語のindexを頻度に比例して返す (語彙サイズ分のメモリしか使わない)
     logger.info('loading unigram frequency...')
-    index2word, word_index_list = read_unigram_freq(args.unigram_freq)
+    index2word, sampler = read_unigram_freq(args.unigram_freq, args.sampler, not args.no_sampler_cache)
     logger.info('index2word contains {} words'.format(len(index2word)))
-    logger.info('word_index_list sample: {}'.format(word_index_list[:1000]))
-    logger.info('word_index_list sample: {}'.format(word_index_list[323235:323335]))
+    logger.info('{} sampler over total frequency {}'.format(sampler.name, sampler.total))
+
+    stats = RunStats('generate_pseudo_samples', args.progress_every,
+                     None if args.resume else count_input_lines(args.input, args))
 
     # assert args.prob_orig < args.prob_mask
-    if args.single_mistake:
+    if args.checkpoint_every or args.resume:
+        logger.info('Making mistakes with checkpoints in {}'.format(checkpoint_path(args.output)))
+        resumable(index2word, sampler, args, stats)
+    elif args.num_variants > 1:
+        logger.info('Making {} variants of every line'.format(args.num_variants))
+        variants(index2word, sampler, args, stats)
+    elif args.workers > 0:
+        logger.info('Making mistakes with {} workers'.format(args.workers))
+        sharded(index2word, sampler, args, stats)
+    elif args.engine == 'numpy':
+        logger.info('Making mistakes with the numpy engine')
+        vectorized(index2word, sampler, args, stats)
+    elif args.single_mistake:
         logger.info('Making single mistake in single sequence')
         single_mistake(
             dict_file=args.dfile,
@@ -438,7 +858,9 @@ if __name__ == '__main__':
             prob_orig=args.prob_orig,
             prob_mask=args.prob_mask,
             index2word=index2word,
-            word_index_list=word_index_list
+            sampler=sampler,
+            stats=stats,
+            speller=get_speller(args)
         )
     else:
         logger.info('Making mistake in each token')
@@ -452,6 +874,11 @@ if __name__ == '__main__':
             prob_orig=args.prob_orig,
             prob_mask=args.prob_mask,
             index2word=index2word,
-            word_index_list=word_index_list,
-            args=args
+            sampler=sampler,
+            args=args,
+            stats=stats,
+            speller=get_speller(args)
         )
+    sys.stdout.close()
+    report_operation_rates(stats, args)
+    stats.finish(args.stats)
@@ -2,10 +2,10 @@
 """
 
 """
-import sys
-
 from logzero import logger
 
+from corpus_io import iter_lines
+
 
 def main(fi):
     vocab = set()
@@ -20,4 +20,4 @@ def main(fi):
 
 
 if __name__ == "__main__":
-    main(sys.stdin)
+    main(iter_lines('-', universal=True))
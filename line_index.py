@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+line-offset index for random access to an uncompressed corpus
+
+    python line_index.py -i corpus --build
+    python line_index.py -i corpus --line_shard 3/16 -o corpus.part3
+    python line_index.py -i corpus --sample_lines 14000000 --sample_seed 1 -o corpus.14M
+
+The index CORPUS.lidx is a small header followed by the uint64 byte offset of
+the start of every line and the end of the last one, so line `n` of the
+memory-mapped corpus is `corpus[offsets[n]:offsets[n + 1]]` and a range of
+lines is a single slice. It is built once in one pass (and rebuilt when the
+corpus changes); afterwards a shard or sample starts reading mid-file at once.
+
+generate_pseudo_samples.py and count_unigram_freq.py take the same
+`--lines`, `--line_shard`, `--sample_lines` and `--sample_seed` options for
+an uncompressed `--input`. A sample keeps the lines in corpus order. Requires
+NumPy.
+"""
+import argparse
+import mmap
+import os
+import struct
+
+from logzero import logger
+
+from corpus_io import BLOCK_BYTES, BlockWriter, compression_of_head
+
+INDEX_MAGIC = b'GECLIDX1'
+# size and mtime (ns) of the corpus when it was indexed, number of lines
+INDEX_HEADER = struct.Struct('<QQQ')
+INDEX_SUFFIX = '.lidx'
+# number of lines per block yielded by a selection
+SELECTION_BLOCK_LINES = 1 << 16
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def corpus_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def build_index(path, dest=None, block_bytes=BLOCK_BYTES):
+    """scan `path` once and write the offsets of its lines to `dest` (CORPUS.lidx)"""
+    import numpy as np
+
+    dest = dest or index_path(path)
+    size, mtime = corpus_stamp(path)
+    tmp = dest + '.tmp'
+    n_lines = 0
+    with open(path, 'rb') as fi, open(tmp, 'wb') as fo:
+        if compression_of_head(fi.read(8)) is not None:
+            raise ValueError('{} is compressed; a line index needs an uncompressed corpus'.format(path))
+        fi.seek(0)
+        fo.write(INDEX_MAGIC)
+        fo.write(INDEX_HEADER.pack(size, mtime, 0))
+        fo.write(np.zeros(1, dtype=np.uint64).tobytes())
+        position = 0
+        last = b'\n'
+        while True:
+            block = fi.read(block_bytes)
+            if not block:
+                break
+            ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')).astype(np.uint64)
+            ends += np.uint64(position + 1)
+            fo.write(ends.tobytes())
+            n_lines += len(ends)
+            position += len(block)
+            last = block[-1:]
+        if last != b'\n':
+            # the last line has no newline
+            fo.write(np.array([position], dtype=np.uint64).tobytes())
+            n_lines += 1
+        fo.seek(len(INDEX_MAGIC))
+        fo.write(INDEX_HEADER.pack(size, mtime, n_lines))
+    os.replace(tmp, dest)
+    logger.info('indexed {} lines of {} in {}'.format(n_lines, path, dest))
+    return dest
+
+
+class IndexedCorpus(object):
+    """Memory-mapped corpus with its line index.
+
+    `corpus[n]` is line `n` as bytes (with its newline) and `len(corpus)` the
+    number of lines. The index is built if it is missing or older than the corpus.
+    """
+
+    def __init__(self, path, build=True):
+        import numpy as np
+
+        self.path = path
+        self.np = np
+        lidx = index_path(path)
+        if not self._is_current(lidx):
+            if not build:
+                raise ValueError('{} is missing or stale, run `python line_index.py -i {} --build`'.format(
+                    lidx, path))
+            logger.info('building the line index of {}'.format(path))
+            build_index(path, lidx)
+        offset = len(INDEX_MAGIC) + INDEX_HEADER.size
+        self.offsets = np.memmap(lidx, dtype=np.uint64, mode='r', offset=offset)
+        self.n_lines = len(self.offsets) - 1
+        with open(path, 'rb') as fi:
+            # an empty file cannot be mapped
+            self.data = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] > 0 else b''
+
+    def _is_current(self, lidx):
+        if not os.path.exists(lidx):
+            return False
+        with open(lidx, 'rb') as fi:
+            if fi.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError('{} is not a line index'.format(lidx))
+            size, mtime, _ = INDEX_HEADER.unpack(fi.read(INDEX_HEADER.size))
+        return (size, mtime) == corpus_stamp(self.path)
+
+    def __len__(self):
+        return self.n_lines
+
+    def __getitem__(self, n):
+        return self.data[int(self.offsets[n]):int(self.offsets[n + 1])]
+
+    def block(self, start, stop):
+        """lines `start` to `stop` (exclusive) as one bytes slice"""
+        return self.data[int(self.offsets[start]):int(self.offsets[stop])]
+
+    def iter_range(self, start, stop, block_lines=SELECTION_BLOCK_LINES):
+        """yield blocks of whole lines of the range"""
+        for begin in range(start, stop, block_lines):
+            yield self.block(begin, min(begin + block_lines, stop))
+
+    def iter_ids(self, ids, block_lines=SELECTION_BLOCK_LINES):
+        """yield blocks of the lines `ids` (in the given order)"""
+        np = self.np
+        starts, ends = self.offsets[:-1], self.offsets[1:]
+        data = self.data
+        # only the last line of the corpus can lack a newline
+        open_line = self.n_lines - 1 if self.data[-1:] not in (b'', b'\n') else None
+        for begin in range(0, len(ids), block_lines):
+            chunk = np.asarray(ids[begin:begin + block_lines])
+            lines = [data[s:e] for s, e in zip(starts[chunk].tolist(), ends[chunk].tolist())]
+            if open_line is not None:
+                for i in np.flatnonzero(chunk == open_line).tolist():
+                    if begin + i + 1 < len(ids):
+                        lines[i] += b'\n'
+            yield b''.join(lines)
+
+    def sample(self, n, seed=0, start=0, stop=None):
+        """IDs of `n` distinct lines of [start, stop) drawn with `seed`, in corpus order"""
+        np = self.np
+        stop = self.n_lines if stop is None else stop
+        if n > stop - start:
+            raise ValueError('cannot sample {} of {} lines'.format(n, stop - start))
+        ids = np.random.default_rng(seed).choice(stop - start, size=n, replace=False)
+        ids.sort()
+        return ids + start
+
+
+def parse_line_range(value, n_lines):
+    """`START:STOP` (either may be empty) -> (start, stop)"""
+    start, sep, stop = value.partition(':')
+    if not sep:
+        raise ValueError('line range must be START:STOP: {}'.format(value))
+    start = min(int(start), n_lines) if start else 0
+    stop = min(int(stop), n_lines) if stop else n_lines
+    return start, max(start, stop)
+
+
+def parse_line_shard(value, n_lines):
+    """`K/N` -> the line range of the K-th (0-based) of N equal shards"""
+    k, sep, n = value.partition('/')
+    k, n = int(k), int(n)
+    if not sep or not 0 <= k < n:
+        raise ValueError('line shard must be K/N with 0 <= K < N: {}'.format(value))
+    return k * n_lines // n, (k + 1) * n_lines // n
+
+
+def add_selection_args(parser):
+    group = parser.add_argument_group('line selection', 'read only some lines of an uncompressed --input '
+                                                        'through its line index (see line_index.py)')
+    group.add_argument('--lines', default=None, metavar='START:STOP',
+                       help='read lines START (inclusive) to STOP (exclusive), counted from 0')
+    group.add_argument('--line_shard', default=None, metavar='K/N',
+                       help='read the K-th (from 0) of N shards of equal numbers of lines')
+    group.add_argument('--sample_lines', type=int, default=0, metavar='N',
+                       help='read a random subset of N lines (of the range or shard) in corpus order')
+    group.add_argument('--sample_seed', type=int, default=0, help='seed of --sample_lines')
+
+
+def has_selection(args):
+    return bool(args.lines or args.line_shard or args.sample_lines)
+
+
+def selected_range(corpus, args):
+    """(start, stop) of the lines of `corpus` selected by --lines and --line_shard"""
+    start, stop = 0, len(corpus)
+    if args.lines:
+        start, stop = parse_line_range(args.lines, len(corpus))
+    if args.line_shard:
+        # a shard of the range
+        shard_start, shard_stop = parse_line_shard(args.line_shard, stop - start)
+        start, stop = start + shard_start, start + shard_stop
+    return start, stop
+
+
+def count_input_lines(path, args=None):
+    """Number of lines that a script reads from `path` with these options, if it is known.
+
+    It is known for a selection, or if `path` has a current line index; otherwise None.
+    """
+    if path is None:
+        return None
+    if args is not None and has_selection(args):
+        corpus = IndexedCorpus(path)
+        if args.sample_lines:
+            return args.sample_lines
+        start, stop = selected_range(corpus, args)
+        return stop - start
+    # the header of the index has the number of lines, so the index is not mapped
+    try:
+        with open(index_path(path), 'rb') as fi:
+            if fi.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            size, mtime, n_lines = INDEX_HEADER.unpack(fi.read(INDEX_HEADER.size))
+        return n_lines if (size, mtime) == corpus_stamp(path) else None
+    except (OSError, struct.error):
+        return None
+
+
+def iter_selected_blocks(path, args):
+    """yield blocks of whole lines of `path` selected by the options of `add_selection_args`"""
+    corpus = IndexedCorpus(path)
+    start, stop = selected_range(corpus, args)
+    if args.sample_lines:
+        ids = corpus.sample(args.sample_lines, args.sample_seed, start, stop)
+        logger.info('reading {} sampled lines of lines {}:{} of {}'.format(len(ids), start, stop, path))
+        return corpus.iter_ids(ids)
+    logger.info('reading lines {}:{} of {}'.format(start, stop, path))
+    return corpus.iter_range(start, stop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build a line index and read lines of a corpus through it')
+    parser.add_argument('--input', '-i', required=True, nargs='+', help='uncompressed corpus')
+    parser.add_argument('--output', '-o', default=None, help='selected lines (default: stdout)')
+    parser.add_argument('--build', action='store_true', help='only (re)build the index of every input')
+    add_selection_args(parser)
+    args = parser.parse_args()
+
+    if args.build:
+        for path in args.input:
+            build_index(path)
+    else:
+        if len(args.input) != 1:
+            parser.error('select lines of one --input at a time')
+        with BlockWriter(args.output) as fo:
+            for block in iter_selected_blocks(args.input[0], args):
+                fo.write(block)
@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+local noising server: the sampler tables are loaded once per machine
+
+    python generate_pseudo_samples.py -uf norm_freq_file -po 0.2 -pm 0.7 --serve /tmp/noise.sock --workers 8
+
+Clients send one JSON request per line over the Unix socket (or HOST:PORT)
+and get one JSON response per line, in the order of their requests:
+
+    {"id": 1, "lines": ["I have a pen ."], "seed": 3}
+    {"id": 1, "pairs": ["I | a pen . ||| I have a pen ."]}
+
+A request may also set "engine" ("python" or "numpy"), "output" ("text", or
+"ids" for {"sources": [[...]], "targets": [[...]]} with the IDs of
+--srcdict/--tgtdict) and any of "prob_mask", "prob_orig", "use_insertion",
+"use_deletion" and "single_mistake"; the rest comes from the options of the
+server. A request with a seed is reproducible on its own: with the python
+engine, its pairs are those of `generate_pseudo_samples.py --seed SEED` for
+the same lines. Without a seed, fresh noise is drawn.
+
+An asyncio front end reads the requests of all connections and hands them
+to a pool of `--workers` processes (forked after the tables are loaded, so
+they share them) in batches: while all workers are busy, requests queue up
+and the next job takes all of them, up to --serve_batch_lines lines. At most
+--serve_pending_lines lines are accepted but not answered yet; beyond that
+the server stops reading, so clients block instead of the queue growing.
+
+`NoiseClient` is a small blocking client:
+
+    client = NoiseClient('/tmp/noise.sock')
+    pairs = client.corrupt(lines, seed=3)
+    sources, targets = client.corrupt(lines, seed=3, output='ids', prob_mask=0.5)
+"""
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+from collections import deque
+from concurrent.futures import BrokenExecutor
+
+from logzero import logger
+
+from parallel_utils import get_executor
+
+DEFAULT_BATCH_LINES = 4096
+DEFAULT_PENDING_LINES = 1 << 16
+# longest request line, in bytes; a connection buffers at most twice as much unread input
+MAX_REQUEST_BYTES = 1 << 22
+# requests of one connection that are accepted before their responses are written
+PIPELINE_DEPTH = 64
+# time to answer the accepted requests at shutdown
+SHUTDOWN_SECONDS = 10
+OPTIONS = ['prob_mask', 'prob_orig', 'use_insertion', 'use_deletion', 'single_mistake']
+ENGINES = ['python', 'numpy']
+OUTPUTS = ['text', 'ids']
+
+
+def parse_address(address):
+    """('tcp', (host, port)) for HOST:PORT, else ('unix', path)"""
+    host, sep, port = address.rpartition(':')
+    if sep and host and port.isdigit() and '/' not in address:
+        return 'tcp', (host, int(port))
+    return 'unix', address
+
+
+def parse_request(data, defaults):
+    """Validate a request and fill in the defaults of the server; raise ValueError if it is malformed."""
+    try:
+        request = json.loads(data)
+    except ValueError as e:
+        raise ValueError('request is not JSON: {}'.format(e))
+    if not isinstance(request, dict):
+        raise ValueError('request must be a JSON object')
+    lines = request.get('lines')
+    if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+        raise ValueError('"lines" must be a list of strings')
+    if any('\n' in line.rstrip('\n') for line in lines):
+        raise ValueError('a line of "lines" contains a newline')
+    unknown = set(request) - set(['id', 'lines', 'seed', 'engine', 'output'] + OPTIONS)
+    if unknown:
+        raise ValueError('unknown fields: {}'.format(', '.join(sorted(unknown))))
+    parsed = dict(defaults)
+    parsed.update(request)
+    if parsed['engine'] not in ENGINES:
+        raise ValueError('"engine" must be one of {}'.format(', '.join(ENGINES)))
+    if parsed['output'] not in OUTPUTS:
+        raise ValueError('"output" must be one of {}'.format(', '.join(OUTPUTS)))
+    seed = parsed.get('seed')
+    if parsed['engine'] == 'python' and not (seed is None or isinstance(seed, int)):
+        raise ValueError('the seed of the python engine must be an integer')
+    return parsed
+
+
+_noiser = None
+
+
+def _init_worker(noiser, in_process=False):
+    # with the fork start method the tables are inherited, not pickled
+    global _noiser
+    _noiser = noiser
+    if not in_process:
+        # Ctrl-C reaches the whole process group; the server shuts the workers down itself
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def corrupt_request(noiser, request):
+    """the response to one parsed request"""
+    from generate_pseudo_samples import corrupt_line
+    import numpy as np
+    import vectorized_noise
+
+    lines = [line.rstrip('\n') + '\n' for line in request['lines']]
+    options = {key: request[key] for key in OPTIONS}
+    response = {'id': request.get('id')}
+    if request['engine'] == 'numpy' and request['output'] == 'ids':
+        sources, targets = noiser.corrupt_batch([line.split() for line in lines], seed=request.get('seed'),
+                                                **options)
+        response['sources'] = [ids.tolist() for ids in sources]
+        response['targets'] = [ids.tolist() for ids in targets]
+        return response
+
+    if request['engine'] == 'numpy':
+        rng = np.random.default_rng(request.get('seed'))
+        text = vectorized_noise.corrupt_batch(lines, rng, noiser.vocab, noiser.sampler, **options) if lines else ''
+        pairs = text.split('\n')[:-1]
+    else:
+        # random.Random(seed) gives the same stream as random.seed(seed) in generate_pseudo_samples.main()
+        rng = random.Random(request.get('seed'))
+        pairs = [corrupt_line(line, rng, noiser.vocab, noiser.sampler, **options)[:-1] for line in lines]
+    if request['output'] == 'text':
+        response['pairs'] = pairs
+        return response
+    response['sources'], response['targets'] = [], []
+    for pair in pairs:
+        src, trg = pair.split('||| ', 1)
+        response['sources'].append(noiser.srcdict.encode_line(src)[0])
+        response['targets'].append(noiser.tgtdict.encode_line(trg)[0])
+    return response
+
+
+def _serve_job(requests):
+    """the responses to `requests` and the number of tokens of the lines that were corrupted"""
+    responses = []
+    n_tokens = 0
+    for request in requests:
+        try:
+            responses.append(corrupt_request(_noiser, request))
+            n_tokens += sum(len(line.split()) for line in request['lines'])
+        except Exception as e:
+            responses.append({'id': request.get('id'), 'error': '{}: {}'.format(type(e).__name__, e)})
+    return responses, n_tokens
+
+
+class LineBudget(object):
+    """at most `capacity` lines of requests that are accepted but not answered yet"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0
+        self.waiters = deque()
+
+    async def acquire(self, n_lines):
+        # a request larger than the budget waits until it is the only one
+        n_lines = min(n_lines, self.capacity)
+        while self.used + n_lines > self.capacity:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.used += n_lines
+        return n_lines
+
+    def release(self, n_lines):
+        self.used -= n_lines
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+def stop_reading(writer):
+    """shut down the reading side of a connection; its responses can still be written"""
+    try:
+        writer.get_extra_info('socket').shutdown(socket.SHUT_RD)
+    except OSError:
+        # the client is gone already
+        pass
+
+
+class NoiseServer(object):
+    """asyncio front end that batches the requests of all connections into jobs of a process pool"""
+
+    def __init__(self, noiser, defaults, workers=0, batch_lines=DEFAULT_BATCH_LINES,
+                 pending_lines=DEFAULT_PENDING_LINES, stats=None):
+        self.noiser = noiser
+        self.defaults = defaults
+        self.workers = workers
+        self.batch_lines = batch_lines
+        self.pending_lines = pending_lines
+        self.stats = stats
+        self.executor = None
+        # connection handler task -> its writer
+        self.connections = {}
+
+    async def serve(self, address):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.budget = LineBudget(self.pending_lines)
+        # two jobs per worker keep the workers busy while the next job is batched
+        self.slots = asyncio.Semaphore(2 * max(self.workers, 1))
+        if self.workers > 0:
+            self.executor = get_executor(self.workers, _init_worker, (self.noiser,))
+        else:
+            # jobs run in threads of the default executor
+            _init_worker(self.noiser, in_process=True)
+
+        kind, where = parse_address(address)
+        if kind == 'tcp':
+            server = await asyncio.start_server(self.handle, *where, limit=MAX_REQUEST_BYTES)
+        else:
+            if os.path.exists(where):
+                os.remove(where)
+            server = await asyncio.start_unix_server(self.handle, where, limit=MAX_REQUEST_BYTES)
+        self.stopped = loop.create_future()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, self.stop)
+        batcher = asyncio.ensure_future(self.batch_requests())
+        logger.info('serving on {} with {} workers'.format(address, self.workers))
+        try:
+            await self.stopped
+        finally:
+            logger.info('shutting down')
+            server.close()
+            # the handlers see the end of their input, answer the requests already accepted and close
+            for writer in list(self.connections.values()):
+                stop_reading(writer)
+            if self.connections:
+                await asyncio.wait(list(self.connections), timeout=SHUTDOWN_SECONDS)
+            for task in list(self.connections):
+                task.cancel()
+            await server.wait_closed()
+            batcher.cancel()
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            if kind == 'unix' and os.path.exists(where):
+                os.remove(where)
+
+    def stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        responses = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+        writing = asyncio.ensure_future(self.write_responses(responses, writer))
+        try:
+            while True:
+                try:
+                    data = await reader.readline()
+                except (ValueError, ConnectionError) as e:
+                    # longer than MAX_REQUEST_BYTES, or the client is gone
+                    if not self.stopped.done():
+                        logger.warning('closing a connection: {}'.format(e))
+                    break
+                if not data or self.stopped.done():
+                    # a request still buffered at shutdown is not answered
+                    break
+                future = loop.create_future()
+                try:
+                    request = parse_request(data, self.defaults)
+                except ValueError as e:
+                    future.set_result({'error': 'ValueError: {}'.format(e)})
+                    await responses.put(future)
+                    continue
+                n_lines = await self.budget.acquire(len(request['lines']))
+                future.add_done_callback(lambda _, n_lines=n_lines: self.budget.release(n_lines))
+                await self.queue.put((request, future))
+                await responses.put(future)
+            await responses.put(None)
+            await writing
+        except asyncio.CancelledError:
+            # cancelled at shutdown after SHUTDOWN_SECONDS
+            pass
+        finally:
+            # never wait here: the handler may be cancelled with a full queue of responses
+            writing.cancel()
+            writer.close()
+            del self.connections[task]
+
+    async def write_responses(self, responses, writer):
+        connected = True
+        while True:
+            future = await responses.get()
+            if future is None:
+                return
+            response = await future
+            if not connected:
+                continue
+            try:
+                writer.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                # keep awaiting the pending requests, which release their budget when they are done
+                connected = False
+
+    async def batch_requests(self):
+        """take everything queued while the workers were busy, up to `batch_lines` lines, as one job"""
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            n_lines = len(batch[0][0]['lines'])
+            while n_lines < self.batch_lines and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                n_lines += len(batch[-1][0]['lines'])
+            self.submit(batch, n_lines)
+
+    def submit(self, batch, n_lines):
+        requests = [request for request, _ in batch]
+        job = asyncio.get_running_loop().run_in_executor(self.executor, _serve_job, requests)
+        job.add_done_callback(lambda job: self.answer(batch, n_lines, job))
+
+    def answer(self, batch, n_lines, job):
+        self.slots.release()
+        e = asyncio.CancelledError() if job.cancelled() else job.exception()
+        if e is not None:
+            error = '{}: {}'.format(type(e).__name__, e)
+            responses = [{'id': request.get('id'), 'error': error} for request, _ in batch]
+            if isinstance(e, BrokenExecutor):
+                logger.error('a worker died, stopping the server: {}'.format(error))
+                self.stop()
+        else:
+            responses, n_tokens = job.result()
+            if self.stats is not None:
+                self.stats.update(n_lines, n_tokens)
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+
+def add_server_args(parser):
+    group = parser.add_argument_group('server', 'serve corruption requests instead of reading the input '
+                                                '(see noise_server.py)')
+    group.add_argument('--serve', default=None, metavar='ADDRESS',
+                       help='listen on the Unix socket ADDRESS, or on HOST:PORT')
+    group.add_argument('--serve_batch_lines', type=int, default=DEFAULT_BATCH_LINES,
+                       help='most lines of queued requests given to a worker at once (default: %(default)s)')
+    group.add_argument('--serve_pending_lines', type=int, default=DEFAULT_PENDING_LINES,
+                       help='most lines accepted but not answered yet; beyond that clients wait '
+                            '(default: %(default)s)')
+
+
+def serve(args, stats=None):
+    """load the tables once and serve requests until SIGINT or SIGTERM, with the options of generate_pseudo_samples.py"""
+    from noiser import Noiser
+
+    logger.info('loading unigram frequency...')
+    noiser = Noiser(args.unigram_freq, args.srcdict, args.tgtdict, sampler=args.sampler,
+                    use_cache=not args.no_sampler_cache)
+    logger.info('index2word contains {} words'.format(len(noiser.vocab)))
+    defaults = {key: getattr(args, key) for key in OPTIONS}
+    defaults.update(engine=args.engine, output='text')
+    server = NoiseServer(noiser, defaults, workers=args.workers, batch_lines=args.serve_batch_lines,
+                         pending_lines=args.serve_pending_lines, stats=stats)
+    asyncio.run(server.serve(args.serve))
+
+
+class NoiseClient(object):
+    """Blocking client of a noise server; the responses come in the order of the requests.
+
+    `corrupt` returns the `src ||| trg` pairs, or (sources, targets) lists of ID lists with output='ids'.
+    """
+
+    def __init__(self, address, timeout=None):
+        kind, where = parse_address(address)
+        if kind == 'tcp':
+            self.sock = socket.create_connection(where, timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(where)
+        self.fi = self.sock.makefile('rb')
+        self.next_id = 0
+
+    def request(self, lines, seed=None, **options):
+        """the request object of `corrupt`"""
+        self.next_id += 1
+        request = dict(options, id=self.next_id, lines=list(lines))
+        if seed is not None:
+            request['seed'] = seed
+        return request
+
+    def send(self, request):
+        self.sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    def receive(self):
+        data = self.fi.readline()
+        if not data:
+            raise ConnectionError('the noise server closed the connection')
+        response = json.loads(data)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        if 'pairs' in response:
+            return response['pairs']
+        return response['sources'], response['targets']
+
+    def corrupt(self, lines, seed=None, **options):
+        self.send(self.request(lines, seed, **options))
+        return self.receive()
+
+    def corrupt_many(self, batches, seeds=None, depth=8, **options):
+        """Yield the result of every batch of lines (seeded by the item of `seeds`), with up to `depth` requests in flight"""
+        seeds = iter(seeds) if seeds is not None else None
+        pending = 0
+        for lines in batches:
+            self.send(self.request(lines, None if seeds is None else next(seeds), **options))
+            pending += 1
+            if pending >= depth:
+                yield self.receive()
+                pending -= 1
+        while pending:
+            yield self.receive()
+            pending -= 1
+
+    def close(self):
+        self.fi.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+on-the-fly DirectNoise for data loaders
+
+A `Noiser` is built once from a (normalized) frequency file and corrupts
+token lists in memory, returning the source and target as arrays of token
+IDs of the fairseq dictionaries, so a training loader can draw fresh noise
+every epoch instead of reading a pseudo corpus written in advance:
+
+    noiser = Noiser('norm_freq_file', prob_mask=0.7, prob_orig=0.2)
+    src, trg = noiser.corrupt(tokens, seed=(2020, epoch, index))
+    sources, targets = noiser.corrupt_batch(token_lists, rng=rng)
+
+The noise is that of `generate_pseudo_samples.py --engine numpy`: for the
+same numpy Generator state, `corrupt_batch` returns the IDs of the pairs that
+`vectorized_noise.corrupt_batch` writes, encoded like fairseq_binary.py does.
+
+A Noiser is never modified by a call, and all random state comes from the
+`rng` or `seed` of the call, so it can be built before forking the workers
+of a data loader and shared by them (the sampler tables stay memory-mapped
+and shared). It is pickled by its options and rebuilt, e.g. for workers
+that are spawned. Requires NumPy.
+
+Running this file checks the IDs against the text output of the numpy engine:
+    python noiser.py -uf norm_freq_file < corpus
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+from logzero import logger
+
+from fairseq_binary import DEFAULT_SRCDICT, DEFAULT_TGTDICT, Dictionary
+from unigram_sampler import load_sampler
+from vectorized_noise import DELETE, INSERT, MASK, as_vocab_array, draw_line_operations
+
+MASK_TOKEN = '|'
+# number of output tokens of every operation: keep, mask, insert (the token and the inserted word), delete
+OUTPUT_TOKENS = np.array([1, 1, 2, 0], dtype=np.int64)
+
+
+class Noiser(object):
+    """DirectNoise of in-memory token lists into (source IDs, target IDs) arrays"""
+
+    def __init__(self, unigram_freq, srcdict=DEFAULT_SRCDICT, tgtdict=DEFAULT_TGTDICT, prob_mask=0.3, prob_orig=0.2,
+                 use_insertion=1, use_deletion=1, single_mistake=0, sampler='cumsum', use_cache=True):
+        self.config = dict(unigram_freq=unigram_freq, srcdict=srcdict, tgtdict=tgtdict, prob_mask=prob_mask,
+                           prob_orig=prob_orig, use_insertion=use_insertion, use_deletion=use_deletion,
+                           single_mistake=single_mistake, sampler=sampler, use_cache=use_cache)
+        self.options = dict(prob_mask=prob_mask, prob_orig=prob_orig, use_insertion=use_insertion,
+                            use_deletion=use_deletion, single_mistake=single_mistake)
+        index2word, self.sampler = load_sampler(unigram_freq, sampler, use_cache)
+        self.vocab = as_vocab_array(index2word)
+        self.srcdict = Dictionary.load(srcdict)
+        self.tgtdict = Dictionary.load(tgtdict)
+        # source ID of every word the sampler can insert
+        self.insert_ids = np.array([self.srcdict.indices.get(w, self.srcdict.unk_index) for w in self.vocab],
+                                   dtype=np.int64)
+        self.src_mask = self.srcdict.indices.get(MASK_TOKEN, self.srcdict.unk_index)
+        self.tgt_mask = self.tgtdict.indices.get(MASK_TOKEN, self.tgtdict.unk_index)
+
+    def __reduce__(self):
+        # the memory-mapped tables cannot be pickled, so a copy loads them again
+        return _rebuild, (self.config,)
+
+    @staticmethod
+    def generator(rng=None, seed=None):
+        """`rng` if given, else a Generator seeded by `seed` (an int or a tuple such as (seed, epoch, index))
+
+        Without both, the Generator is seeded from the OS, so forked workers never share a stream.
+        """
+        if rng is not None:
+            return rng
+        return np.random.default_rng(seed)
+
+    def encode(self, d, tokens):
+        unk = d.unk_index
+        return np.fromiter((d.indices.get(t, unk) for t in tokens), dtype=np.int64, count=len(tokens))
+
+    def corrupt(self, tokens, rng=None, seed=None, **options):
+        """Corrupt one sentence (a list of tokens, or a str split at whitespace).
+
+        Return (source IDs, target IDs), both ending with `</s>`.
+        """
+        sources, targets = self.corrupt_batch([tokens], rng, seed, **options)
+        return sources[0], targets[0]
+
+    def corrupt_batch(self, batch, rng=None, seed=None, **options):
+        """Corrupt a batch of sentences with one draw per operation kind for the whole batch.
+
+        `options` (prob_mask, prob_orig, ...) override those given to the constructor.
+        Return (list of source ID arrays, list of target ID arrays), every array ending with `</s>`.
+        """
+        rng = self.generator(rng, seed)
+        batch = [tokens.split() if isinstance(tokens, str) else list(tokens) for tokens in batch]
+        n_lines = len(batch)
+        if n_lines == 0:
+            return [], []
+        lengths = np.fromiter(map(len, batch), dtype=np.int64, count=n_lines)
+        offsets = np.zeros(n_lines + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = [t for tokens in batch for t in tokens]
+        line_of = np.repeat(np.arange(n_lines), lengths)
+
+        # the same draws in the same order as vectorized_noise.corrupt_parsed
+        ops = draw_line_operations(rng, lengths, offsets, **dict(self.options, **options))
+        is_insert = ops == INSERT
+        n_insert = int(is_insert.sum())
+        inserted = self.sampler.sample_array(rng, n_insert) if n_insert else np.zeros(0, dtype=np.int64)
+        pads = rng.integers(1, 9, size=n_lines)
+
+        # every token is followed by its inserted word, and every sentence by </s>
+        n_out = OUTPUT_TOKENS[ops]
+        starts = np.zeros(len(ops) + 1, dtype=np.int64)
+        np.cumsum(n_out, out=starts[1:])
+        position = starts[:-1] + line_of
+        src_lengths = np.bincount(line_of, weights=n_out, minlength=n_lines).astype(np.int64) + 1
+        src_bounds = np.cumsum(src_lengths)
+        src = np.empty(int(src_bounds[-1]), dtype=np.int64)
+        src[src_bounds - 1] = self.srcdict.eos_index
+        written = ops != DELETE
+        src_ids = self.encode(self.srcdict, flat)
+        src_ids[ops == MASK] = self.src_mask
+        src[position[written]] = src_ids[written]
+        src[position[is_insert] + 1] = self.insert_ids[inserted]
+        sources = np.split(src, src_bounds[:-1])
+
+        trg = np.empty(len(flat) + n_lines, dtype=np.int64)
+        trg_bounds = offsets[1:] + np.arange(1, n_lines + 1)
+        trg[trg_bounds - 1] = self.tgtdict.eos_index
+        trg[np.arange(len(flat)) + line_of] = self.encode(self.tgtdict, flat)
+        targets = np.split(trg, trg_bounds[:-1])
+
+        # only a sentence with as many insertions as deletions can come out unchanged
+        n_inserts = np.bincount(line_of[is_insert], minlength=n_lines)
+        n_deletes = np.bincount(line_of[ops == DELETE], minlength=n_lines)
+        words = self.vocab[inserted].tolist()
+        insert_rank = np.cumsum(is_insert) - 1
+        for n in np.flatnonzero((n_inserts == n_deletes) & (lengths > 0)).tolist():
+            if self.is_identical(batch[n], ops[offsets[n]:offsets[n + 1]].tolist(),
+                                 words, insert_rank[offsets[n]:offsets[n + 1]].tolist()):
+                # 元の文と同じになった場合はtarget側にpadを付ける
+                targets[n] = np.concatenate([np.full(int(pads[n]), self.tgt_mask, dtype=np.int64), targets[n]])
+        return sources, targets
+
+    @staticmethod
+    def is_identical(tokens, ops, words, insert_rank):
+        """whether the corrupted tokens are the original ones"""
+        out = []
+        for token, op, rank in zip(tokens, ops, insert_rank):
+            if op == MASK:
+                out.append(MASK_TOKEN)
+            elif op != DELETE:
+                out.append(token)
+                if op == INSERT:
+                    out.append(words[rank])
+        return out == tokens
+
+
+def _rebuild(config):
+    return Noiser(**config)
+
+
+def check_engine(noiser, lines, seed=1, batch_size=1000):
+    """Compare the IDs of `noiser` with the numpy engine's output for `lines` (with their newline).
+
+    Lines whose tokens are not separated by single spaces are skipped, since
+    fairseq splits them differently from the engine. Return the number of differing pairs.
+    """
+    import vectorized_noise
+
+    n_diff = n_skip = n_lines = 0
+    elapsed = 0.0
+    for n, batch in enumerate(vectorized_noise.iter_batches(lines, batch_size)):
+        text = vectorized_noise.corrupt_batch(batch, np.random.default_rng([seed, n]), noiser.vocab, noiser.sampler,
+                                              **noiser.options)
+        # tokens split as by vectorized_noise.parse_batch
+        token_lists = [line.strip('\r\n ').split(' ') for line in batch]
+        start = time.perf_counter()
+        sources, targets = noiser.corrupt_batch(token_lists, seed=[seed, n])
+        elapsed += time.perf_counter() - start
+        for line, tokens, pair, src, trg in zip(batch, token_lists, text.splitlines(), sources, targets):
+            if tokens != line.split():
+                n_skip += 1
+                continue
+            src_text, trg_text = pair.split('||| ', 1)
+            expected_src, _ = noiser.srcdict.encode_line(src_text)
+            expected_trg, _ = noiser.tgtdict.encode_line(trg_text)
+            if src.tolist() != expected_src or trg.tolist() != expected_trg:
+                n_diff += 1
+        n_lines += len(batch)
+    logger.info('{} sentences ({} skipped), {} differ from the numpy engine; {:.0f} sentences/s'.format(
+        n_lines, n_skip, n_diff, n_lines / max(elapsed, 1e-9)))
+    return n_diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check the IDs of Noiser against the numpy engine')
+    parser.add_argument('--unigram_freq', '-uf', required=True, help='normalized frequency file')
+    parser.add_argument('--srcdict', default=DEFAULT_SRCDICT)
+    parser.add_argument('--tgtdict', default=DEFAULT_TGTDICT)
+    parser.add_argument('--prob_mask', '-pm', type=float, default=0.3)
+    parser.add_argument('--prob_orig', '-po', type=float, default=0.2)
+    parser.add_argument('--single_mistake', '-sm', type=int, default=0)
+    parser.add_argument('--sampler', default='cumsum')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    noiser = Noiser(args.unigram_freq, args.srcdict, args.tgtdict, prob_mask=args.prob_mask, prob_orig=args.prob_orig,
+                    single_mistake=args.single_mistake, sampler=args.sampler)
+    sys.exit(1 if check_engine(noiser, sys.stdin, args.seed) else 0)
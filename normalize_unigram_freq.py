@@ -3,23 +3,35 @@
 一定頻度以下は同じ頻度のvocabとして扱うことにする
 """
 import argparse
-import sys
 
 from logzero import logger
 
+from corpus_io import TextWriter, iter_lines
+from line_index import count_input_lines
+from run_stats import RunStats, add_stats_args
 
-def main(fi, norm):
+
+def main(fi, norm, output=None, stats=None):
     sum_freq = 0
-    for line in fi:
-        token, freq = line.strip().split('\t')
-        normalized_freq = max(int(freq) // norm, 1)
-        sum_freq += normalized_freq
-        print('{}\t{}'.format(token, normalized_freq))
+    with TextWriter(output) as fo:
+        for line in fi:
+            token, freq = line.strip().split('\t')
+            normalized_freq = max(int(freq) // norm, 1)
+            sum_freq += normalized_freq
+            fo.write('{}\t{}\n'.format(token, normalized_freq))
+            if stats is not None:
+                stats.update()
     logger.info('sum_freq: {}'.format(sum_freq))
+    return sum_freq
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='hogehoge')
     parser.add_argument('--norm', default=300, type=int, help='write here')
+    parser.add_argument('--input', '-i', default=None, help='output of count_unigram_freq.py (default: stdin)')
+    parser.add_argument('--output', '-o', default=None, help='default: stdout')
+    add_stats_args(parser)
     args = parser.parse_args()
-    main(sys.stdin, args.norm)
+    stats = RunStats('normalize_unigram_freq', args.progress_every, count_input_lines(args.input))
+    stats.set('sum_freq', main(iter_lines(args.input, universal=True), args.norm, args.output, stats))
+    stats.finish(args.stats)
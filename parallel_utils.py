@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+helpers for running pipeline stages in a process pool
+"""
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _fork_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def get_pool(workers, initializer=None, initargs=()):
+    """Create a pool that inherits large read-only tables from the parent.
+
+    The fork start method (where available) passes `initargs` to the workers
+    without pickling them, so sampler tables are shared copy-on-write instead
+    of being copied into every worker.
+    """
+    return _fork_context().Pool(workers, initializer=initializer, initargs=initargs)
+
+
+def get_executor(workers, initializer=None, initargs=()):
+    """`get_pool` as a concurrent.futures executor, e.g. for asyncio's `run_in_executor`.
+
+    Unlike a Pool, it fails the pending futures instead of hanging if a worker is killed.
+    """
+    return ProcessPoolExecutor(workers, mp_context=_fork_context(), initializer=initializer, initargs=initargs)
+
+
+def ordered_imap(pool, func, iterable, max_pending):
+    """Like `pool.imap`, but keeps at most `max_pending` jobs in flight.
+
+    `Pool.imap` consumes its whole input eagerly, which does not work for a
+    corpus that does not fit in memory. Results are yielded in input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def prefetch(iterable, max_pending):
+    """Run a generator stage in a background thread, at most `max_pending` items ahead of the consumer.
+
+    The thread starts at the first item (after any pool of a later stage has
+    been forked), and an exception of the stage is raised in the consumer.
+    """
+    pending = queue.Queue(maxsize=max_pending)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    return
+                pending.put(item)
+            pending.put(done)
+        except BaseException as e:
+            pending.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        # unblock the producer if the consumer stopped early
+        while thread.is_alive():
+            try:
+                pending.get(timeout=0.1)
+            except queue.Empty:
+                pass
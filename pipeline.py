@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+raw corpus to noised pairs in one command, without intermediate files
+
+    python pipeline.py -i corpus.*.gz -o pairs.gz -uf norm_freq_file --norm 100 -po 0.2 -pm 0.7 --seed 2020 \\
+        --n_process 8 --bpe_workers 8 --workers 16
+
+chains the stages of the README as generators in one process:
+
+    ssplit_and_tokenize.py -> remove_dirty_examples.py -> apply_bpe.py -> generate_pseudo_samples.py
+                                                                       \\-> count_unigram_freq.py -> normalize_unigram_freq.py
+
+Tokenization (nlp.pipe with --n_process), BPE (--bpe_workers) and noise
+(--workers) run in process pools, each a bounded number of blocks ahead of
+the next stage, and reading, tokenizing and filtering run in a thread of
+their own. The output is the same as running the scripts one after the other
+with the same options.
+
+The noise needs the frequencies of the whole corpus before the first line.
+If `-uf` exists, it is used and the corpus is read once. Otherwise the
+frequencies are counted by a side branch of the pass, written to `-uf`
+(cached for the next run), and the cleaned BPE text is spooled once to
+--clean_output (or a temporary file in --tmpdir) and noised from there.
+Each stage can still be run on its own as before.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from collections import Counter
+
+from logzero import logger
+
+import normalize_unigram_freq
+from apply_bpe import BPE, DEFAULT_CODES
+from apply_bpe import _init_worker as _init_bpe_worker
+from apply_bpe import _segment_chunk
+from corpus_io import BLOCK_BYTES, BlockWriter, byte_lines_of_blocks, iter_line_blocks, lines_of_blocks
+from count_unigram_freq import print_freq
+from generate_pseudo_samples import (OPERATIONS, PAD, add_noise_args, get_corruptor, open_output,
+                                     report_operation_rates, variant_paths)
+from parallel_utils import get_pool, ordered_imap, prefetch
+from remove_dirty_examples import (DUPLICATES, FILTERS, add_dedup_args, filter_blocks, get_deduplicator, log_counts,
+                                   new_counts)
+from run_stats import RunStats, add_stats_args
+from unigram_sampler import load_sampler
+
+# blocks between the thread of the first stages and the pools
+PREFETCH_BLOCKS = 16
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='make noised pairs from a raw corpus in one pass')
+    parser.add_argument('--input', '-i', required=True, nargs='+',
+                        help='raw corpus files, one document per line (plain, gzip, xz or zstd)')
+    parser.add_argument('--output', '-o', required=True,
+                        help='noised pairs, compressed by the extension (or a directory with --output_format fairseq)')
+    parser.add_argument('--seed', '-s', type=int, default=1, help='seed of the noise (default: %(default)s)')
+    parser.add_argument('--tokenized', action='store_true',
+                        help='the input is already split into sentences and tokenized; skip ssplit_and_tokenize')
+    parser.add_argument('--batch_size_pipe', type=int, default=1000, help='batch size of nlp.pipe')
+    parser.add_argument('--n_process', type=int, default=1, help='number of processes of nlp.pipe')
+    add_dedup_args(parser)
+    parser.add_argument('--bpe_codes', default=DEFAULT_CODES,
+                        help='BPE codes, "none" if the input is already segmented (default: %(default)s)')
+    parser.add_argument('--bpe_workers', type=int, default=0, help='segment blocks with this many processes')
+    parser.add_argument('--norm', type=int, default=300,
+                        help='--norm of normalize_unigram_freq.py when -uf is counted (default: %(default)s)')
+    parser.add_argument('--freq_output', default=None,
+                        help='also write the frequencies counted in this pass (as count_unigram_freq.py) here')
+    parser.add_argument('--recount', action='store_true', help='count the frequencies even if -uf exists')
+    parser.add_argument('--clean_output', default=None,
+                        help='keep the cleaned BPE text here; it is the spool of a run that counts the frequencies')
+    parser.add_argument('--tmpdir', default=None, help='directory of the temporary spool')
+    add_noise_args(parser)
+    add_stats_args(parser)
+    args = parser.parse_args()
+    if args.unigram_freq is None:
+        parser.error('give -uf: the normalized frequency file to read, or to write if it does not exist')
+    return args
+
+
+def regroup(pieces, block_bytes=BLOCK_BYTES):
+    """join small byte strings of whole lines into blocks of about `block_bytes`"""
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= block_bytes:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def read_stage(paths):
+    for path in paths:
+        logger.info('reading {}'.format(path))
+        for block in iter_line_blocks(path, universal=True):
+            yield block
+
+
+def tokenize_stage(blocks, batch_size=1000, n_process=1):
+    """ssplit_and_tokenize.py --pipe: the sentences of every line, one per line"""
+    from ssplit_and_tokenize import load_tokenizer, pipe_lines
+
+    nlp = load_tokenizer()
+    lines = ((line, 0) for line in lines_of_blocks(blocks))
+    return regroup(out for out, _ in pipe_lines(lines, nlp, batch_size=batch_size, n_process=n_process))
+
+
+def bpe_stage(blocks, codes, pool=None, workers=0):
+    """apply_bpe.py on blocks of lines"""
+    chunks = (block.decode('utf-8').splitlines(True) for block in blocks)
+    if pool is not None:
+        segmented = (out for out, _, _ in ordered_imap(pool, _segment_chunk, chunks, 2 * workers))
+    else:
+        bpe = BPE(codes)
+        segmented = (''.join(bpe.segment_lines(lines)) for lines in chunks)
+    for text in segmented:
+        yield text.encode('utf-8')
+
+
+def count_branch(blocks, counter):
+    """count_unigram_freq.py as a side branch: count the tokens of the blocks that pass through"""
+    for block in blocks:
+        counter.update(block.decode('utf-8').split())
+        yield block
+
+
+def write_branch(blocks, fo):
+    """keep a copy of the blocks that pass through in `fo`"""
+    for block in blocks:
+        fo.write(block)
+        yield block
+
+
+def clean_blocks(args, counts, dedup=None, bpe_pool=None):
+    """blocks of the tokenized, filtered and segmented corpus"""
+    blocks = read_stage(args.input)
+    if not args.tokenized:
+        blocks = tokenize_stage(blocks, args.batch_size_pipe, args.n_process)
+    blocks = filter_blocks(blocks, counts)
+    if dedup is not None:
+        blocks = dedup.filter_blocks(blocks, counts)
+    blocks = prefetch(blocks, PREFETCH_BLOCKS)
+    if args.bpe_codes != 'none':
+        blocks = bpe_stage(blocks, args.bpe_codes, bpe_pool, args.bpe_workers)
+    return blocks
+
+
+def write_frequencies(counter, args):
+    """print the counts like count_unigram_freq.py and normalize them into -uf"""
+    items = sorted(counter.items(), key=lambda x: x[1], reverse=True)
+    if args.freq_output:
+        print_freq(items, args.freq_output)
+    logger.info('normalizing {} tokens into {}'.format(len(items), args.unigram_freq))
+    normalize_unigram_freq.main(('{}\t{}\n'.format(token, freq) for token, freq in items), args.norm,
+                                args.unigram_freq)
+
+
+def noise(lines, args, stats=None):
+    """generate_pseudo_samples.py on bytes lines"""
+    index2word, sampler = load_sampler(args.unigram_freq, args.sampler, not args.no_sampler_cache)
+    logger.info('index2word contains {} words'.format(len(index2word)))
+    corruptor = get_corruptor(index2word, sampler, args)
+    if stats is not None:
+        stats.add_counters('operations', corruptor.counts, OPERATIONS, token_labels=OPERATIONS[:PAD])
+    fos = [open_output(path, args) for path in variant_paths(args.output, args.num_variants)]
+    try:
+        for n_lines, _, outputs in corruptor.units(lines):
+            for fo, out in zip(fos, outputs):
+                fo.write(out)
+            if stats is not None:
+                stats.update(n_lines)
+    finally:
+        for fo in fos:
+            fo.close()
+
+
+def main(args, stats=None):
+    counts = new_counts()
+    if stats is not None:
+        stats.add_counters('filters', counts)
+    dedup = get_deduplicator(args)
+    bpe_pool = None
+    if args.bpe_codes != 'none' and args.bpe_workers > 0:
+        # forked before any stage starts a thread
+        bpe_pool = get_pool(args.bpe_workers, _init_bpe_worker, (args.bpe_codes, '@@', 1 << 20))
+    counter = Counter()
+    try:
+        blocks = clean_blocks(args, counts, dedup, bpe_pool)
+        if args.freq_output or args.recount or not os.path.exists(args.unigram_freq):
+            blocks = count_branch(blocks, counter)
+        if os.path.exists(args.unigram_freq) and not args.recount:
+            logger.info('noising with the frequencies of {}'.format(args.unigram_freq))
+            if args.clean_output:
+                with BlockWriter(args.clean_output) as fo:
+                    noise(byte_lines_of_blocks(write_branch(blocks, fo)), args, stats)
+            else:
+                noise(byte_lines_of_blocks(blocks), args, stats)
+            if args.freq_output:
+                print_freq(sorted(counter.items(), key=lambda x: x[1], reverse=True), args.freq_output)
+        else:
+            spool = args.clean_output
+            if spool is None:
+                fd, spool = tempfile.mkstemp(suffix='.bpe', dir=args.tmpdir)
+                os.close(fd)
+            try:
+                logger.info('counting the frequencies and spooling the cleaned corpus to {}'.format(spool))
+                with BlockWriter(spool) as fo:
+                    for block in blocks:
+                        fo.write(block)
+                write_frequencies(counter, args)
+                noise(byte_lines_of_blocks(iter_line_blocks(spool)), args, stats)
+            finally:
+                if args.clean_output is None:
+                    os.remove(spool)
+    finally:
+        if bpe_pool is not None:
+            bpe_pool.close()
+            bpe_pool.join()
+        if dedup is not None:
+            dedup.close()
+    log_counts(counts)
+    if stats is not None:
+        stats.set('kept', counts['total'] - sum(counts[name] for name in FILTERS + DUPLICATES))
+    return counts
+
+
+if __name__ == '__main__':
+    args = get_args()
+    stats = RunStats('pipeline', args.progress_every)
+    main(args, stats)
+    report_operation_rates(stats, args)
+    stats.finish(args.stats)
+    sys.exit(0)
@@ -1,28 +1,82 @@
 # -*- coding: utf-8 -*-
 """
 pre-processing large monolingual corpus with several heuristics
+
+With `--dedup exact`, lines that passed the heuristics are also removed if
+the same line was kept before; `--dedup near` additionally removes lines that
+are near-duplicates of a kept line (see dedup.py).
+
+The input may be plain, gzip, xz or zstd and the output file is compressed
+like the input; without --input and --output, stdin is filtered to stdout:
+
+    zcat corpus.gz | python remove_dirty_examples.py --dedup exact | gzip > clean.gz
 """
 import argparse
 import os
 import re
 import string
+from collections import OrderedDict
 from pathlib import Path
 
 from logzero import logger
 
+from corpus_io import BlockWriter, iter_line_blocks
+from dedup import Deduplicator
+from line_index import count_input_lines
+from run_stats import RunStats, add_stats_args
+
 SYMBOLS = set(string.punctuation)
 ASCII_CHARS = set(string.printable)
 
+# the same heuristics, precompiled for the single-pass engine on bytes
+SYMBOLS_BYTES = set(s.encode('ascii') for s in SYMBOLS)
+ASCII_BYTES = string.printable.encode('ascii')
+# characters removed by str.strip() that are ASCII
+STRIP_BYTES = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+CONSECUTIVE_WHITESPACE = re.compile(r'\s{3,}')
+CONSECUTIVE_WHITESPACE_BYTES = re.compile(rb'\s{3,}')
+OTHER_WHITESPACE_BYTES = b'\t\n\r\x0b\x0c'
+DIGIT_BYTES = string.digits.encode('ascii')
+DIGIT_TOKEN = re.compile(r'\s\d[\d,\/]*\s')
+DIGIT_TOKEN_BYTES = re.compile(rb'\s\d[\d,\/]*\s')
+FILTERS = ['long', 'short', 'puncts', 'nonascii', 'whitespace', 'digits']
+DUPLICATES = ['duplicate', 'near_duplicate']
+BLOCK_BYTES = 1 << 22
+
 
 def get_args():
     parser = argparse.ArgumentParser(description='my script')
     parser.add_argument('--input', '-i', default=None, help='files to read, if empty, stdin is used')
-    parser.add_argument('--output', '-o', required=True, type=os.path.abspath,
-                        help='path to output dir')
+    parser.add_argument('--output', '-o', default=None, type=os.path.abspath,
+                        help='path to output dir, if empty, stdout is used')
+    add_dedup_args(parser)
+    add_stats_args(parser)
     args = parser.parse_args()
+    if args.output and not args.input:
+        parser.error('--output needs --input, the output file is named after it')
     return args
 
 
+def add_dedup_args(parser):
+    """options of the duplicate removal, shared with pipeline.py"""
+    parser.add_argument('--dedup', choices=['exact', 'near'], default=None,
+                        help='also remove exact duplicates, or exact and near duplicates (MinHash/LSH)')
+    parser.add_argument('--dedup_memory', type=int, default=10000000,
+                        help='number of hashes kept in RAM before they are spilled to a sorted run on disk')
+    parser.add_argument('--dedup_tmpdir', default=None, help='directory of the spilled runs')
+    parser.add_argument('--num_perm', type=int, default=64, help='number of MinHash permutations of --dedup near')
+    parser.add_argument('--bands', type=int, default=8, help='number of LSH bands of --dedup near')
+    parser.add_argument('--ngram', type=int, default=3, help='token n-grams hashed by --dedup near')
+
+
+def get_deduplicator(args):
+    """the Deduplicator of the options of `add_dedup_args`, or None without --dedup"""
+    if not args.dedup:
+        return None
+    return Deduplicator(near=args.dedup == 'near', max_memory=args.dedup_memory, tmpdir=args.dedup_tmpdir,
+                        num_perm=args.num_perm, bands=args.bands, ngram=args.ngram)
+
+
 def remove_long_sent(line, threshold=80):
     tokens = line.split(' ')
     if len(tokens) > threshold:
@@ -59,7 +113,7 @@ def remove_nonascii_chars(line):
 
 
 def remove_consecutive_whitespace(line):
-    if re.search(r'\s{3,}', line):
+    if CONSECUTIVE_WHITESPACE.search(line):
         return None
     else:
         return line
@@ -67,7 +121,7 @@ def remove_consecutive_whitespace(line):
 
 def remove_too_many_digits_sentence(line):
     total_tokens = len(line.split())
-    match = re.findall(r'\s\d[\d,\/]*\s', line)
+    match = DIGIT_TOKEN.findall(line)
     if not match:
         return line
     else:
@@ -78,44 +132,138 @@ def remove_too_many_digits_sentence(line):
             return line
 
 
-def main(args):
-    dest = Path(args.output, *Path(args.input).parts[-1:])
-    logger.info('Processing: {}'.format(args.input))
+def check_line(line):
+    """Apply the filters to a stripped str line in order.
+
+    Return the name of the first filter that rejects the line, or None. This is
+    the reference of `check_line_bytes` and `filter_blocks`, which tests/ compare with it.
+    """
+    if remove_long_sent(line) is None:
+        return 'long'
+    if remove_short_sent(line) is None:
+        return 'short'
+    if remove_too_many_puncts(line) is None:
+        return 'puncts'
+    if remove_nonascii_chars(line) is None:
+        return 'nonascii'
+    if remove_consecutive_whitespace(line) is None:
+        return 'whitespace'
+    if remove_too_many_digits_sentence(line) is None:
+        return 'digits'
+    return None
+
+
+def check_tokens(tokens, symbols):
+    """the length and punctuation filters on the tokens of a line split by ' '"""
+    n_total = len(tokens)
+    if n_total > 80:
+        return 'long'
+    if n_total <= 2:
+        return 'short'
+    if n_total >= 10 and sum(map(symbols.__contains__, tokens)) / n_total >= 0.20:
+        return 'puncts'
+    return None
+
+
+def check_line_bytes(line):
+    """Single-pass version of `check_line` for a stripped ASCII bytes line.
+
+    The line is split once and every filter works on the shared token list.
+    """
+    reason = check_tokens(line.split(b' '), SYMBOLS_BYTES)
+    if reason is not None:
+        return reason
+    if line.translate(None, ASCII_BYTES):
+        return 'nonascii'
+    # the regexes are only needed if the cheap substring checks cannot decide
+    if b'   ' in line or (len(line.translate(None, OTHER_WHITESPACE_BYTES)) != len(line)
+                          and CONSECUTIVE_WHITESPACE_BYTES.search(line)):
+        return 'whitespace'
+    if len(line.translate(None, DIGIT_BYTES)) == len(line):
+        return None
+    n_digit_tokens = len(DIGIT_TOKEN_BYTES.findall(line))
+    if n_digit_tokens and n_digit_tokens / len(line.split()) > 0.10:
+        return 'digits'
+    return None
+
+
+def filter_blocks(blocks, counts):
+    """Yield blocks of the lines that pass all filters; count rejections per filter."""
+    for block in blocks:
+        kept = []
+        for line in block.split(b'\n'):
+            if line.isascii():
+                line = line.strip(STRIP_BYTES)
+                if not line:
+                    continue
+                reason = check_line_bytes(line)
+            else:
+                # str.strip() also removes non-ascii whitespace
+                text = line.decode('utf-8', errors='surrogateescape').strip()
+                if not text:
+                    continue
+                line = text.encode('utf-8', errors='surrogateescape')
+                if text.isascii():
+                    reason = check_line_bytes(line)
+                else:
+                    # a non-ascii character is never printable
+                    reason = check_tokens(text.split(' '), SYMBOLS) or 'nonascii'
 
-    with open(args.input, 'r') as fi, open(dest, 'w') as fo:
-        for line in fi:
-            line = line.strip()
+            counts['total'] += 1
+            if reason is None:
+                kept.append(line)
+            else:
+                counts[reason] += 1
+        if kept:
+            kept.append(b'')
+            yield b'\n'.join(kept)
 
-            # remove if line is too long
-            if line:
-                line = remove_long_sent(line)
 
-            # remove if line is too short
-            if line:
-                line = remove_short_sent(line)
+def new_counts():
+    counts = OrderedDict([('total', 0)])
+    for name in FILTERS + DUPLICATES:
+        counts[name] = 0
+    return counts
 
-            # remove if certain ratio of tokens are symbols
-            if line:
-                line = remove_too_many_puncts(line)
 
-            # remove if line contains non-ascii characters
-            if line:
-                line = remove_nonascii_chars(line)
+def log_counts(counts):
+    kept = counts['total'] - sum(counts[name] for name in FILTERS + DUPLICATES)
+    logger.info('{} non-empty lines, {} kept'.format(counts['total'], kept))
+    for name in FILTERS + DUPLICATES:
+        logger.info('rejected by {}: {}'.format(name, counts[name]))
 
-            # remove if consecutive spaces exist (probably the numerical table)
-            if line:
-                line = remove_consecutive_whitespace(line)
 
-            # remove if too many digits exist
-            if line:
-                line = remove_too_many_digits_sentence(line)
+def main(args, stats=None):
+    dest = str(Path(args.output, *Path(args.input).parts[-1:])) if args.output else '-'
+    logger.info('Processing: {}'.format(args.input or 'stdin'))
 
-            if line:
-                line = line + '\n'
-                # fo.write(line.encode('utf-8'))
-                fo.write(line)
+    counts = new_counts()
+    if stats is not None:
+        stats.add_counters('filters', counts)
+    dedup = get_deduplicator(args)
+    try:
+        with BlockWriter(dest) as fo:
+            # universal newlines, like text mode
+            blocks = filter_blocks(iter_line_blocks(args.input, BLOCK_BYTES, universal=True), counts)
+            if dedup is not None:
+                blocks = dedup.filter_blocks(blocks, counts)
+            for block in blocks:
+                fo.write(block)
+                if stats is not None:
+                    # every non-empty line read so far
+                    stats.update(counts['total'] - stats.lines)
+    finally:
+        if dedup is not None:
+            dedup.close()
+    log_counts(counts)
+    if stats is not None:
+        stats.update(counts['total'] - stats.lines)
+    return counts
 
 
 if __name__ == "__main__":
     args = get_args()
-    main(args)
+    stats = RunStats('remove_dirty_examples', args.progress_every, count_input_lines(args.input))
+    counts = main(args, stats)
+    stats.set('kept', counts['total'] - sum(counts[name] for name in FILTERS + DUPLICATES))
+    stats.finish(args.stats)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+progress reports and machine-readable statistics of a pipeline run
+
+A script creates one `RunStats`, registers the counters its hot loop
+already keeps (a list indexed by operation, or a dict such as the
+rejections per filter) and calls `update` once per line or chunk. Every
+`--progress_every` seconds a line with the throughput, the ETA if the
+number of input lines is known, and the RSS is logged. At the end,
+`--stats PATH` receives every counter as JSON, or as a Prometheus textfile
+if PATH ends with .prom (for node_exporter's textfile collector):
+
+    python generate_pseudo_samples.py ... --stats run.json
+    python remove_dirty_examples.py ... --stats /var/lib/node_exporter/dirty.prom
+"""
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+
+from logzero import logger
+
+DEFAULT_PROGRESS_EVERY = 30.0
+
+
+def add_stats_args(parser):
+    group = parser.add_argument_group('statistics', 'progress reports and run statistics (see run_stats.py)')
+    group.add_argument('--stats', default=None, metavar='PATH',
+                       help='write the statistics of the run to PATH as JSON, or as a Prometheus textfile '
+                            'if PATH ends with .prom')
+    group.add_argument('--progress_every', type=float, default=DEFAULT_PROGRESS_EVERY, metavar='SECONDS',
+                       help='log the progress every this many seconds, 0 to disable (default: %(default)s)')
+
+
+def rss_bytes():
+    """current resident set size, or the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as fi:
+            return int(fi.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return max_rss_bytes()
+
+
+def max_rss_bytes():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RunStats(object):
+    """throughput, registered counters and derived values of one run"""
+
+    def __init__(self, name, progress_every=DEFAULT_PROGRESS_EVERY, total_lines=None):
+        self.name = name
+        self.progress_every = progress_every
+        self.total_lines = total_lines
+        self.lines = 0
+        self.tokens = 0
+        self.token_counters = None
+        self.token_labels = None
+        self.groups = OrderedDict()
+        self.values = OrderedDict()
+        self.start = time.monotonic()
+        self.next_report = self.start + progress_every if progress_every > 0 else float('inf')
+
+    def add_counters(self, group, counters, labels=None, token_labels=None):
+        """Register live counters: a dict, or a list named by `labels`.
+
+        The caller keeps incrementing them; they are only read when reporting.
+        If given, the sum of the counters `token_labels` is the number of tokens processed.
+        """
+        self.groups[group] = (counters, labels)
+        if token_labels is not None:
+            self.token_counters = group
+            self.token_labels = token_labels
+        return counters
+
+    def live(self, group):
+        """the registered counters of `group` themselves"""
+        return self.groups[group][0]
+
+    def set(self, key, value):
+        """a derived value reported at the end, e.g. a rate"""
+        self.values[key] = value
+
+    def counters(self, group):
+        counters, labels = self.groups[group]
+        if labels is None:
+            return OrderedDict(counters)
+        return OrderedDict(zip(labels, counters))
+
+    def n_tokens(self):
+        if self.token_counters is None:
+            return self.tokens
+        counters = self.counters(self.token_counters)
+        return self.tokens + sum(counters[label] for label in self.token_labels)
+
+    def update(self, lines=1, tokens=0):
+        self.lines += lines
+        self.tokens += tokens
+        if time.monotonic() >= self.next_report:
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        elapsed = max(now - self.start, 1e-9)
+        message = '{}: {} lines ({:.0f} lines/s), {} tokens ({:.0f} tokens/s), RSS {:.0f}MiB'.format(
+            self.name, self.lines, self.lines / elapsed, self.n_tokens(), self.n_tokens() / elapsed,
+            rss_bytes() / (1 << 20))
+        if self.total_lines and self.lines:
+            remaining = max(self.total_lines - self.lines, 0) * elapsed / self.lines
+            message += ', {:.1f}% ETA {}'.format(100.0 * self.lines / self.total_lines, format_seconds(remaining))
+        logger.info(message)
+        if self.progress_every > 0:
+            self.next_report = now + self.progress_every
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        summary = OrderedDict([
+            ('script', self.name),
+            ('elapsed_seconds', elapsed),
+            ('lines', self.lines),
+            ('tokens', self.n_tokens()),
+            ('lines_per_second', self.lines / max(elapsed, 1e-9)),
+            ('tokens_per_second', self.n_tokens() / max(elapsed, 1e-9)),
+            ('max_rss_bytes', max_rss_bytes()),
+        ])
+        for group in self.groups:
+            summary[group] = self.counters(group)
+        summary.update(self.values)
+        return summary
+
+    def write(self, path):
+        summary = self.summary()
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as fo:
+            if path.endswith('.prom'):
+                fo.write(prometheus_text(summary))
+            else:
+                json.dump(summary, fo, indent=2)
+                fo.write('\n')
+        # atomic, so a collector never reads a partial file
+        os.replace(tmp, path)
+        logger.info('wrote the statistics of the run to {}'.format(path))
+
+    def finish(self, path=None):
+        """log the final progress and write the statistics to `path` if given"""
+        self.report()
+        if path:
+            self.write(path)
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def prometheus_text(summary):
+    """Prometheus exposition format: gec_<key>{script="..."} for numbers, one label per counter of a group"""
+    script = summary['script']
+    lines = []
+    for key, value in summary.items():
+        if key == 'script':
+            continue
+        if isinstance(value, dict):
+            metric = 'gec_{}_total'.format(key)
+            lines.append('# TYPE {} counter'.format(metric))
+            for label, count in value.items():
+                lines.append('{}{{script="{}",{}="{}"}} {}'.format(metric, script, key, label, count))
+        elif isinstance(value, (int, float)):
+            metric = 'gec_{}'.format(key)
+            lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{}{{script="{}"}} {}'.format(metric, script, value))
+    return '\n'.join(lines) + '\n'
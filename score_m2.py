@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+"""
+M2 scores (P/R/F0.5) of many system outputs against one gold M2 file
+
+    python score_m2.py -g conll14st-test.m2 -s outputs/pretlarge/seed_*/conll14.test.out --workers 8
+
+The scores are those of the reference M2 scorer (m2scorer 3.2, with its
+default --max_unchanged_words 2 and --beta 0.5): the hypothesis edits are
+read off the same merged edit lattice with the same tie-breaking, and the
+annotator of every sentence is chosen in the order of the annotator IDs with
+the reference's F formula. It is faster because
+
+- the gold file is parsed once into GOLD.cache (rebuilt when the gold file
+  changes) instead of by every run,
+- only the cells on an optimal alignment get backpointers, the transitive
+  closure of the lattice only visits existing arcs, and the shortest path
+  search stops as soon as it converges,
+- a (sentence, hypothesis) pair is scored once for all systems, e.g. the
+  many sentences that every seed decodes alike, and the pairs are scored in
+  `--workers` processes.
+
+Outputs whose paths differ only in a `seed_NN` directory are also reported
+as mean and standard deviation over the seeds.
+"""
+import argparse
+import os
+import pickle
+import re
+import statistics
+import struct
+from collections import OrderedDict, defaultdict
+
+from logzero import logger
+
+from parallel_utils import get_pool
+
+CACHE_MAGIC = b'GECM2C1\n'
+CACHE_VERSION = 1
+# version, size and mtime (ns) of the gold file
+CACHE_HEADER = struct.Struct('<QQQ')
+EPSILON = 0.001
+INF = float('inf')
+SEED_PATTERN = re.compile(r'seed_\d+')
+# (sentence, hypothesis) pairs per job of a worker
+JOB_PAIRS = 64
+
+
+# ---- gold M2 files ----
+
+def paragraphs(lines):
+    paragraph = []
+    for line in lines:
+        if line == '\n':
+            if paragraph:
+                yield ''.join(paragraph)
+                paragraph = []
+        else:
+            paragraph.append(line)
+    if paragraph:
+        yield ''.join(paragraph)
+
+
+def parse_m2(text):
+    """(source sentences, gold edits) of an M2 file, as read by the reference scorer.
+
+    The gold edits of a sentence are a dict of annotator -> [(start, end, original, corrections)].
+    """
+    sources = []
+    gold_edits = []
+    for item in paragraphs(text.splitlines(True)):
+        item = item.splitlines(False)
+        sentence = [line[2:].strip() for line in item if line.startswith('S ')]
+        if not sentence:
+            raise ValueError('M2 paragraph without a sentence: {!r}'.format(item[0]))
+        annotations = OrderedDict()
+        for line in item[1:]:
+            if line.startswith('I ') or line.startswith('S '):
+                continue
+            if not line.startswith('A '):
+                raise ValueError('unexpected line in M2 file: {!r}'.format(line))
+            fields = line[2:].split('|||')
+            start, end = map(int, fields[0].split()[:2])
+            if fields[1] == 'noop':
+                start = end = -1
+            corrections = [c.strip() if c != '-NONE-' else '' for c in fields[2].split('||')]
+            original = ' '.join(' '.join(sentence).split()[start:end])
+            annotations.setdefault(int(fields[5]), []).append((start, end, original, corrections))
+        n_tokens = 0
+        for this_sentence in sentence:
+            n_tokens += len(this_sentence.split())
+            sources.append(this_sentence)
+            edits = OrderedDict()
+            for annotator, annotation in annotations.items():
+                edits[annotator] = [e for e in annotation if 0 <= e[0] <= n_tokens and 0 <= e[1] <= n_tokens]
+            if not edits:
+                edits[0] = []
+            gold_edits.append(edits)
+    return sources, gold_edits
+
+
+def cache_path(path):
+    return path + '.cache'
+
+
+def source_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def compile_gold(path, dest=None):
+    """parse a gold M2 file and write it to its cache; return (sources, gold edits)"""
+    dest = dest or cache_path(path)
+    size, mtime = source_stamp(path)
+    with open(path, encoding='utf-8', newline='') as fi:
+        gold = parse_m2(fi.read())
+    tmp = '{}.{}.tmp'.format(dest, os.getpid())
+    with open(tmp, 'wb') as fo:
+        fo.write(CACHE_MAGIC)
+        fo.write(CACHE_HEADER.pack(CACHE_VERSION, size, mtime))
+        pickle.dump(gold, fo, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, dest)
+    logger.info('compiled {} sentences of {} into {}'.format(len(gold[0]), path, dest))
+    return gold
+
+
+def load_gold(path, use_cache=True):
+    """(sources, gold edits) of a gold M2 file, through its cache if `use_cache`"""
+    if not use_cache:
+        with open(path, encoding='utf-8', newline='') as fi:
+            return parse_m2(fi.read())
+    dest = cache_path(path)
+    if os.path.exists(dest):
+        with open(dest, 'rb') as fi:
+            if fi.read(len(CACHE_MAGIC)) == CACHE_MAGIC:
+                version, size, mtime = CACHE_HEADER.unpack(fi.read(CACHE_HEADER.size))
+                if version == CACHE_VERSION and (size, mtime) == source_stamp(path):
+                    logger.info('loaded the parsed gold edits {}'.format(dest))
+                    return pickle.load(fi)
+    try:
+        return compile_gold(path, dest)
+    except OSError as e:
+        logger.warning('cannot write the gold cache {}: {}'.format(dest, e))
+        return load_gold(path, use_cache=False)
+
+
+# ---- edit lattice ----
+# An edit is (kind, start, end, original, correction, number of unchanged tokens), an arc
+# is (vertex, vertex) with vertices (source position, hypothesis position).
+
+def levenshtein_matrix(first, second, cost_ins=1, cost_del=1, cost_sub=2):
+    """edit distances between all prefixes of the two token lists"""
+    matrix = [list(range(len(second) + 1))]
+    for i in range(1, len(first) + 1):
+        previous = matrix[-1]
+        token = first[i - 1]
+        row = [i]
+        left = i
+        for j in range(1, len(second) + 1):
+            diagonal = previous[j - 1] if token == second[j - 1] else previous[j - 1] + cost_sub
+            left = min(diagonal, previous[j] + cost_del, left + cost_ins)
+            row.append(left)
+        matrix.append(row)
+    return matrix
+
+
+def backpointers(matrix, first, second, i, j, cost_ins=1, cost_del=1, cost_sub=2):
+    """the optimal predecessors of cell (i, j) with their edits, in the reference's order"""
+    if i == 0:
+        return [((0, j - 1), ('ins', 0, 0, '', second[j - 1], 0))] if j > 0 else []
+    if j == 0:
+        return [((i - 1, 0), ('del', i - 1, i, first[i - 1], '', 0))]
+    same = first[i - 1] == second[j - 1]
+    substitution = matrix[i - 1][j - 1] + (0 if same else cost_sub)
+    deletion = matrix[i - 1][j] + cost_del
+    insertion = matrix[i][j - 1] + cost_ins
+    best = matrix[i][j]
+    pointers = []
+    if substitution == best:
+        if same:
+            pointers.append(((i - 1, j - 1), ('noop', i - 1, i, first[i - 1], second[j - 1], 1)))
+        else:
+            pointers.append(((i - 1, j - 1), ('sub', i - 1, i, first[i - 1], second[j - 1], 0)))
+    if deletion == best:
+        pointers.append(((i - 1, j), ('del', i - 1, i, first[i - 1], '', 0)))
+    if insertion == best:
+        pointers.append(((i, j - 1), ('ins', i, i, '', second[j - 1], 0)))
+    return pointers
+
+
+def edit_graph(first, second, cost_sub):
+    """Arcs of the optimal alignments, found breadth-first from the last cell.
+
+    Only the backpointers of the cells on an optimal alignment are computed.
+    """
+    matrix = levenshtein_matrix(first, second, 1, 1, cost_sub)
+    vertices = []
+    arcs = []
+    dist = {}
+    edits = {}
+    visited = set()
+    queue = [(len(first), len(second))]
+    queued = set(queue)
+    head = 0
+    while head < len(queue):
+        v = queue[head]
+        head += 1
+        queued.discard(v)
+        if v in visited:
+            continue
+        visited.add(v)
+        vertices.append(v)
+        for previous, edit in backpointers(matrix, first, second, v[0], v[1], 1, 1, cost_sub):
+            arcs.append((previous, v))
+            dist[(previous, v)] = edit[-1]
+            edits[(previous, v)] = edit
+            if previous not in queued:
+                queue.append(previous)
+                queued.add(previous)
+    return vertices, arcs, dist, edits
+
+
+def merge_graphs(graph1, graph2):
+    vertices1, arcs1, dist1, edits1 = graph1
+    vertices2, arcs2, dist2, edits2 = graph2
+    vertices = sorted(set(vertices1) | set(vertices2))
+    # the reference keeps the arcs that are in both graphs twice
+    arcs = sorted(arcs1 + arcs2)
+    dist = dict(dist1)
+    for arc, d in dist2.items():
+        dist[arc] = min(dist[arc], d) if arc in dist else d
+    edits = dict(edits1)
+    for arc, edit in edits2.items():
+        edits.setdefault(arc, edit)
+    return vertices, arcs, dist, edits
+
+
+def merge_edits(e1, e2, joiner=' '):
+    kind1, kind2 = e1[0], e2[0]
+    count = e1[5] + e2[5]
+    if kind1 == 'ins':
+        if kind2 == 'ins':
+            return 'ins', e1[1], e2[2], '', e1[4] + joiner + e2[4], count
+        if kind2 == 'del':
+            return 'sub', e1[1], e2[2], e2[3], e1[4], count
+        return 'sub', e1[1], e2[2], e2[3], e1[4] + joiner + e2[4], count
+    if kind1 == 'del':
+        if kind2 == 'ins':
+            return 'sub', e1[1], e2[2], e1[3], e2[4], count
+        if kind2 == 'del':
+            return 'del', e1[1], e2[2], e1[3] + joiner + e2[3], '', count
+        return 'sub', e1[1], e2[2], e1[3] + joiner + e2[3], e2[4], count
+    if kind2 == 'ins':
+        return 'sub', e1[1], e2[2], e1[3], e1[4] + joiner + e2[4], count
+    if kind2 == 'del':
+        return 'sub', e1[1], e2[2], e1[3] + joiner + e2[3], e1[4], count
+    kind = 'noop' if kind1 == 'noop' and kind2 == 'noop' else 'sub'
+    return kind, e1[1], e2[2], e1[3] + joiner + e2[3], e1[4] + joiner + e2[4], count
+
+
+def transitive_arcs(vertices, arcs, dist, edits, max_unchanged_words=2):
+    """Add an arc for every shorter path of two arcs through each vertex, in the reference's order.
+
+    The reference tries every pair of vertices for every vertex; only the
+    predecessors and successors of the vertex can form a path, and no arc
+    added while visiting a vertex starts or ends at it.
+    """
+    successors = defaultdict(set)
+    predecessors = defaultdict(set)
+    for v, w in edits:
+        successors[v].add(w)
+        predecessors[w].add(v)
+    for vk in vertices:
+        following = sorted(successors[vk])
+        for vi in sorted(predecessors[vk]):
+            eik = edits[(vi, vk)]
+            dik = dist[(vi, vk)]
+            for vj in following:
+                d = dik + dist[(vk, vj)]
+                if d < dist.get((vi, vj), INF):
+                    eij = merge_edits(eik, edits[(vk, vj)])
+                    if eij[-1] <= max_unchanged_words:
+                        arcs.append((vi, vj))
+                        dist[(vi, vj)] = d
+                        edits[(vi, vj)] = eij
+                        successors[vi].add(vj)
+                        predecessors[vj].add(vi)
+    # remove the transitive arcs of unchanged words; like the reference, an arc that
+    # follows a removed one in the list is not looked at
+    for arc in arcs:
+        edit = edits[arc]
+        if edit[0] == 'noop' and dist[arc] > 1:
+            arcs.remove(arc)
+            dist[arc] = INF
+            del edits[arc]
+    return vertices, arcs, dist, edits
+
+
+def hypothesis_lattice(source, hypothesis, max_unchanged_words=2):
+    source_tokens = source.split()
+    hypothesis_tokens = hypothesis.split()
+    graph1 = edit_graph(source_tokens, hypothesis_tokens, 1)
+    graph2 = edit_graph(source_tokens, hypothesis_tokens, 2)
+    return transitive_arcs(*merge_graphs(graph1, graph2), max_unchanged_words)
+
+
+def is_gold_edit(edit, gold):
+    return edit[1] == gold[0] and edit[2] == gold[1] and edit[3] == gold[2] and edit[4] in gold[3]
+
+
+def set_weights(arcs, dist, edits, gold_edits):
+    """arc weights that make the shortest path take as many gold edits as possible"""
+    weights = dict(dist)
+    by_span = OrderedDict()
+    gold_by_span = {}
+    for arc in arcs:
+        span = edits[arc][1:3]
+        by_span.setdefault(span, []).append(arc)
+        gold_by_span.setdefault(span, [])
+    for gold in gold_edits:
+        gold_by_span.setdefault((gold[0], gold[1]), []).append(gold)
+    bonus = -len(arcs)
+    for span in sorted(by_span):
+        span_arcs = sorted(by_span[span])
+        golds = gold_by_span[span]
+        if span[0] != span[1]:
+            # deletions and substitutions
+            for arc in span_arcs:
+                edit = edits[arc]
+                if any(is_gold_edit(edit, gold) for gold in golds):
+                    weights[arc] = bonus
+                elif edit[0] != 'noop':
+                    weights[arc] += EPSILON
+            continue
+        # insertions at one position are matched to the gold insertions in order, from both ends alternately
+        left, right = 0, len(span_arcs) - 1
+        current = left
+        gold_left, gold_right = 0, len(golds) - 1
+        while left <= right:
+            arc = span_arcs[current]
+            edit = edits[arc]
+            if current == left:
+                candidates = range(gold_left, gold_right + 1)
+            else:
+                candidates = reversed(range(gold_left, gold_right + 1))
+            matched = False
+            for i in candidates:
+                if is_gold_edit(edit, golds[i]):
+                    matched = True
+                    weights[arc] = bonus
+                    if current == left:
+                        gold_left = i + 1
+                    else:
+                        gold_right = i - 1
+                    break
+            if not matched and edit[0] != 'noop':
+                weights[arc] += EPSILON
+            if matched:
+                if current == left:
+                    left += 1
+                    while left < len(span_arcs) and span_arcs[left][0] != arc[1]:
+                        weights[span_arcs[left]] += EPSILON
+                        left += 1
+                    current = left
+                else:
+                    right -= 1
+                    while right >= 0 and span_arcs[right][1] != arc[0]:
+                        weights[span_arcs[right]] += EPSILON
+                        right -= 1
+                    current = right
+            elif current == left:
+                left += 1
+                current = right
+            else:
+                right -= 1
+                current = left
+    return weights
+
+
+def best_edit_sequence(vertices, arcs, weights, edits):
+    """Edits of the shortest path, last edit first.
+
+    Bellman-Ford over the arcs in the reference's order, which decides between
+    paths of equal weight; it stops at the first round without an update
+    instead of running len(vertices) - 1 rounds.
+    """
+    distance = dict.fromkeys(vertices, INF)
+    distance[(0, 0)] = 0
+    path = {}
+    for _ in range(len(vertices) - 1):
+        updated = False
+        for arc in arcs:
+            v, w = arc
+            d = distance[v] + weights[arc]
+            if d < distance[w]:
+                distance[w] = d
+                path[w] = v
+                updated = True
+        if not updated:
+            break
+    sequence = []
+    v = vertices[-1]
+    while v in path:
+        w = path[v]
+        edit = edits[(w, v)]
+        if edit[0] != 'noop':
+            sequence.append(edit[1:5])
+        v = w
+    return sequence
+
+
+def match_sequence(sequence, gold_edits):
+    """hypothesis edits that match the gold edits in order (an edit may match several)"""
+    matched = []
+    last = 0
+    for edit in reversed(sequence):
+        for i in range(last, len(gold_edits)):
+            gold = gold_edits[i]
+            if edit[0] == gold[0] and edit[1] == gold[1] and edit[2] == gold[2] and edit[3] in gold[3]:
+                matched.append(edit)
+                last = i + 1
+    return matched
+
+
+def equals_ignore_whitespace_casing(a, b):
+    return a.replace(' ', '').lower() == b.replace(' ', '').lower()
+
+
+def sentence_counts(source, hypothesis, gold, max_unchanged_words=2, ignore_whitespace_casing=False):
+    """[(correct, proposed, gold)] of the hypothesis for every annotator of `gold`, in the order of their IDs"""
+    vertices, arcs, dist, edits = hypothesis_lattice(source, hypothesis, max_unchanged_words)
+    counts = []
+    # the reference iterates a dict with int keys, i.e. in the order of the IDs
+    for _, gold_edits in sorted(gold.items()):
+        weights = set_weights(arcs, dist, edits, gold_edits)
+        sequence = best_edit_sequence(vertices, arcs, weights, edits)
+        if ignore_whitespace_casing:
+            sequence = [e for e in sequence if not equals_ignore_whitespace_casing(e[2], e[3])]
+        counts.append((len(match_sequence(sequence, gold_edits)), len(sequence), len(gold_edits)))
+    return counts
+
+
+# ---- scores ----
+
+def precision(correct, proposed):
+    return correct / proposed if proposed else 1.0
+
+
+def recall(correct, gold):
+    return correct / gold if gold else 1.0
+
+
+def f_score(correct, proposed, gold, beta=0.5):
+    p, r = precision(correct, proposed), recall(correct, gold)
+    denominator = beta * beta * p + r
+    return (1.0 + beta * beta) * p * r / denominator if denominator else 0.0
+
+
+def counts_f_score(correct, proposed, gold, beta=0.5):
+    """F score as the reference computes it from the counts to choose an annotator
+
+    It is the same number as `f_score`, but rounded differently, so it has the exact ties of the reference.
+    """
+    denominator = beta * beta * gold + proposed
+    if not denominator:
+        return 1.0 if correct == 0 else 0.0
+    return (1.0 + beta * beta) * correct / denominator
+
+
+def corpus_counts(sentence_counts, beta=0.5):
+    """Sum the counts over sentences, choosing for every sentence the annotator
+    that maximizes the F score so far (then the most correct edits, then the fewest proposed and gold edits)."""
+    correct = proposed = gold = 0
+    for counts in sentence_counts:
+        best = None
+        for c, p, g in counts:
+            key = (counts_f_score(correct + c, proposed + p, gold + g, beta), correct + c,
+                   -(proposed + p + gold + g))
+            if best is None or key > best[0]:
+                best = key, (c, p, g)
+        c, p, g = best[1]
+        correct, proposed, gold = correct + c, proposed + p, gold + g
+    return correct, proposed, gold
+
+
+_gold = None
+_options = None
+
+
+def _init_worker(gold, options):
+    global _gold, _options
+    _gold = gold
+    _options = options
+
+
+def _score_pairs(pairs):
+    sources, gold_edits = _gold
+    return [sentence_counts(sources[n], hypothesis, gold_edits[n], **_options) for n, hypothesis in pairs]
+
+
+def read_system(path):
+    with open(path, encoding='utf-8') as fi:
+        return [line.strip() for line in fi]
+
+
+def score_systems(gold, systems, workers=0, beta=0.5, **options):
+    """{path: (correct, proposed, gold)} of every system output against the parsed gold file"""
+    sources, gold_edits = gold
+    hypotheses = {}
+    for path in systems:
+        hypotheses[path] = read_system(path)
+        if len(hypotheses[path]) != len(sources):
+            raise ValueError('{} has {} lines, but the gold file has {} sentences'.format(
+                path, len(hypotheses[path]), len(sources)))
+    # each distinct hypothesis of a sentence is aligned once for all systems
+    pairs = sorted({(n, lines[n]) for lines in hypotheses.values() for n in range(len(sources))})
+    logger.info('scoring {} distinct hypotheses of {} systems'.format(len(pairs), len(systems)))
+    jobs = [pairs[i:i + JOB_PAIRS] for i in range(0, len(pairs), JOB_PAIRS)]
+    if workers > 1:
+        pool = get_pool(workers, _init_worker, (gold, options))
+        try:
+            results = pool.map(_score_pairs, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(gold, options)
+        results = map(_score_pairs, jobs)
+    counts = {}
+    for job, result in zip(jobs, results):
+        counts.update(zip(job, result))
+    return {path: corpus_counts((counts[(n, line)] for n, line in enumerate(lines)), beta)
+            for path, lines in hypotheses.items()}
+
+
+def seed_groups(paths):
+    """{path with seed_* for seed_NN: its paths} for the paths that differ only in their seed"""
+    groups = OrderedDict()
+    for path in paths:
+        key = SEED_PATTERN.sub('seed_*', path)
+        if key != path:
+            groups.setdefault(key, []).append(path)
+    return OrderedDict((key, group) for key, group in groups.items() if len(group) > 1)
+
+
+def mean_std(values):
+    return statistics.mean(values), statistics.stdev(values) if len(values) > 1 else 0.0
+
+
+def print_scores(results, beta=0.5):
+    f_name = 'F{}'.format(beta)
+    print('\t'.join(['system', 'P', 'R', f_name, 'correct', 'proposed', 'gold']))
+    scores = {}
+    for path, (correct, proposed, gold) in results.items():
+        scores[path] = (precision(correct, proposed), recall(correct, gold), f_score(correct, proposed, gold, beta))
+        print('{}\t{:.4f}\t{:.4f}\t{:.4f}\t{}\t{}\t{}'.format(path, *scores[path], correct, proposed, gold))
+    groups = seed_groups(list(results))
+    if groups:
+        print()
+        print('\t'.join(['seeds', 'n', 'P mean', 'P std', 'R mean', 'R std', f_name + ' mean', f_name + ' std']))
+        for key, paths in groups.items():
+            columns = [mean_std([scores[path][k] for path in paths]) for k in range(3)]
+            print('{}\t{}\t{}'.format(key, len(paths), '\t'.join('{:.4f}\t{:.4f}'.format(*c) for c in columns)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='M2 scores of system outputs, as computed by the reference M2 scorer')
+    parser.add_argument('--gold', '-g', required=True, help='gold M2 file')
+    parser.add_argument('--system', '-s', required=True, nargs='+',
+                        help='tokenized system outputs, one sentence per line of the gold file')
+    parser.add_argument('--workers', type=int, default=0, help='align hypotheses with this many processes')
+    parser.add_argument('--beta', type=float, default=0.5)
+    parser.add_argument('--max_unchanged_words', type=int, default=2)
+    parser.add_argument('--ignore_whitespace_casing', action='store_true')
+    parser.add_argument('--no_gold_cache', action='store_true', help='parse the gold file without its cache')
+    args = parser.parse_args()
+
+    gold = load_gold(args.gold, use_cache=not args.no_gold_cache)
+    results = score_systems(gold, args.system, args.workers, args.beta, max_unchanged_words=args.max_unchanged_words,
+                            ignore_whitespace_casing=args.ignore_whitespace_casing)
+    print_scores(results, args.beta)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+external-memory shuffle of pseudo pairs, optionally split into length-bucketed shards
+
+    python shuffle_pairs.py -i proc_file -o proc_file.shuf --seed 1
+    python shuffle_pairs.py -i proc_file.gz -o train.gz --seed 1 --shards 16 --by_length
+
+The input is read once and every line is sent to one of `--buckets`
+temporary files chosen at random; every bucket is then loaded, shuffled in
+RAM and written out. A uniformly random bucket per line followed by a
+uniform shuffle of every bucket is a uniform shuffle of the whole input,
+and only one bucket has to fit in memory (by default the number of buckets
+is chosen from the input size and `--memory`). The same input, seed and
+number of buckets give the same output.
+
+With `--shards N` the shuffled lines are split into N shards of (almost)
+the same number of lines, OUTPUT.0 ... OUTPUT.N-1. With `--by_length` they
+are ranked by the length in tokens of the longer side of the pair instead
+(then by source and target length), so the sources and the targets of a
+shard are both bounded by its longest pairs and need less padding per batch;
+the lines of a shard are still in shuffled order. Requires NumPy.
+"""
+import argparse
+import math
+import os
+import shutil
+import tempfile
+from collections import Counter
+
+from logzero import logger
+
+from corpus_io import BlockWriter, compression_of_path, is_stdio, iter_line_blocks, numbered_paths
+
+DEFAULT_MEMORY = 1 << 30
+# buckets if the input size is unknown (stdin)
+DEFAULT_BUCKETS = 256
+# compressed inputs are assumed to expand by this factor
+COMPRESSION_RATIO = 4
+WRITE_BUFFER = 1 << 20
+
+
+def pair_lengths(line):
+    """(source tokens, target tokens) of a `src ||| trg` bytes line; a line without `||| ` is all source"""
+    src, sep, trg = line.partition(b'||| ')
+    return len(src.split()), len(trg.split())
+
+
+def length_key(line):
+    """(longer side, source, target) lengths of a pair; ranking by it bounds both sides of a shard"""
+    src_len, trg_len = pair_lengths(line)
+    return max(src_len, trg_len), src_len, trg_len
+
+
+def auto_buckets(path, memory):
+    if is_stdio(path):
+        return DEFAULT_BUCKETS
+    size = os.path.getsize(path)
+    if compression_of_path(path) is not None:
+        size *= COMPRESSION_RATIO
+    # a bucket is held as a list of lines, about twice its size on disk
+    return max(1, math.ceil(2 * size / memory))
+
+
+def split_lines(block):
+    lines = block.split(b'\n')
+    last = lines.pop()
+    if last:
+        lines.append(last)
+    return lines
+
+
+def partition(path, tmpdir, n_buckets, rng, by_length=False):
+    """Send every line of `path` to a random bucket file.
+
+    Returns (paths of the buckets, number of lines, Counter of `length_key`s if `by_length`).
+    """
+    import numpy as np
+
+    paths = [os.path.join(tmpdir, 'bucket{:05d}'.format(b)) for b in range(n_buckets)]
+    files = [open(p, 'wb', buffering=WRITE_BUFFER) for p in paths]
+    n_lines = 0
+    lengths = Counter() if by_length else None
+    try:
+        for block in iter_line_blocks(path):
+            lines = split_lines(block)
+            if not lines:
+                continue
+            buckets = rng.integers(0, n_buckets, size=len(lines))
+            order = np.argsort(buckets, kind='stable').tolist()
+            bounds = np.cumsum(np.bincount(buckets, minlength=n_buckets)).tolist()
+            start = 0
+            for b, stop in enumerate(bounds):
+                if stop > start:
+                    files[b].write(b'\n'.join([lines[i] for i in order[start:stop]]) + b'\n')
+                start = stop
+            if by_length:
+                lengths.update(map(length_key, lines))
+            n_lines += len(lines)
+    finally:
+        for fo in files:
+            fo.close()
+    return paths, n_lines, lengths
+
+
+def length_ranks(lengths):
+    """{length key: number of lines with a smaller key}"""
+    ranks = {}
+    total = 0
+    for key in sorted(lengths):
+        ranks[key] = total
+        total += lengths[key]
+    return ranks
+
+
+def iter_shuffled_buckets(paths, seed):
+    """yield the lines of every bucket in a random order"""
+    import numpy as np
+
+    for b, path in enumerate(paths):
+        with open(path, 'rb') as fi:
+            lines = fi.read().split(b'\n')[:-1]
+        os.remove(path)
+        if lines:
+            rng = np.random.default_rng([seed, b])
+            yield [lines[i] for i in rng.permutation(len(lines)).tolist()]
+
+
+def shuffle(path, output, seed=0, shards=1, by_length=False, memory=DEFAULT_MEMORY, buckets=0, tmpdir=None):
+    """shuffle the lines of `path` into `output` (or `shards` numbered files); return the number of lines"""
+    import numpy as np
+
+    n_buckets = buckets or auto_buckets(path, memory)
+    workdir = tempfile.mkdtemp(prefix='gec-shuffle-', dir=tmpdir)
+    try:
+        logger.info('partitioning {} into {} buckets in {}'.format(path or 'stdin', n_buckets, workdir))
+        paths, n_lines, lengths = partition(path, workdir, n_buckets, np.random.default_rng(seed), by_length)
+        logger.info('{} lines'.format(n_lines))
+
+        outputs = numbered_paths(output, shards) if shards > 1 else [output]
+        writers = [BlockWriter(p) for p in outputs]
+        ranks = length_ranks(lengths) if by_length else None
+        seen = Counter()
+        # smallest and largest source and target length of every shard
+        shard_lengths = [[None, None, None, None] for _ in writers]
+        position = 0
+        try:
+            for lines in iter_shuffled_buckets(paths, seed):
+                if shards == 1:
+                    writers[0].write(b'\n'.join(lines) + b'\n')
+                    continue
+                for line in lines:
+                    if by_length:
+                        key = length_key(line)
+                        rank = ranks[key] + seen[key]
+                        seen[key] += 1
+                    else:
+                        key = None
+                        rank = position
+                        position += 1
+                    shard = rank * shards // n_lines
+                    writers[shard].write(line + b'\n')
+                    if by_length:
+                        bounds = shard_lengths[shard]
+                        for side, length in enumerate(key[1:]):
+                            if bounds[2 * side] is None or length < bounds[2 * side]:
+                                bounds[2 * side] = length
+                            if bounds[2 * side + 1] is None or length > bounds[2 * side + 1]:
+                                bounds[2 * side + 1] = length
+        finally:
+            for writer in writers:
+                writer.close()
+        if by_length:
+            for p, bounds in zip(outputs, shard_lengths):
+                logger.info('{}: source lengths {} to {}, target lengths {} to {}'.format(p, *bounds))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return n_lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='shuffle pseudo pairs that do not fit in memory')
+    parser.add_argument('--input', '-i', default=None, help='pairs, plain or compressed (default: stdin)')
+    parser.add_argument('--output', '-o', default=None,
+                        help='shuffled pairs, compressed by the extension (default: stdout, not with --shards)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='write N shards of the same number of lines, OUTPUT.0 ... OUTPUT.N-1')
+    parser.add_argument('--by_length', action='store_true',
+                        help='group the lines of the shards by the length of the longer side of the pair')
+    parser.add_argument('--memory', type=int, default=DEFAULT_MEMORY,
+                        help='bytes of RAM for one bucket, decides the number of buckets (default: %(default)s)')
+    parser.add_argument('--buckets', type=int, default=0,
+                        help='number of temporary buckets (default: from the input size and --memory, '
+                             '{} for stdin)'.format(DEFAULT_BUCKETS))
+    parser.add_argument('--tmpdir', default=None, help='directory of the temporary buckets')
+    args = parser.parse_args()
+    if args.shards > 1 and args.output is None:
+        parser.error('--shards needs --output')
+    if args.by_length and args.shards < 2:
+        parser.error('--by_length needs --shards N with N > 1')
+
+    shuffle(args.input, args.output, seed=args.seed, shards=args.shards, by_length=args.by_length,
+            memory=args.memory, buckets=args.buckets, tmpdir=args.tmpdir)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+synthetic spelling errors (SSE) in whole words of BPE-segmented sentences
+
+    python generate_pseudo_samples.py -uf norm_freq_file --spelling_prob 0.1 < corpus.bpe > proc_file
+
+Before the token noise, every word of the source is misspelled with
+probability --spelling_prob by one character edit, chosen uniformly among
+
+- substitution of a letter by a neighbour on the keyboard or a confusable letter,
+- transposition of two adjacent letters,
+- insertion of a neighbour of a letter next to it,
+- deletion of a letter.
+
+The pieces of a word are joined before the edit, and the misspelled word is
+segmented again with --spelling_codes, so that its pieces are those of
+vocab/dict.src_bpe8000.txt. Only words of two or more ASCII letters are
+misspelled, and the case of an edited letter is kept.
+
+The replacements of every letter (the keyboard neighbours and CONFUSIONS,
+plus the weighted pairs of --spelling_table) are compiled into one row of
+replacement letters and cumulative weights per letter. The numpy engine draws
+the misspelled words, edits, positions and replacements of a whole batch with
+a few calls; the default engine draws them word by word from its `random`
+stream. The misspelling of a word is the same function of the draws in both.
+
+Running this file prints the replacement table:
+    python spelling_noise.py --spelling_table confusions.tsv
+"""
+import argparse
+import bisect
+import string
+import sys
+from itertools import repeat
+
+import numpy as np
+
+from apply_bpe import BPE, DEFAULT_CODES
+
+LETTERS = string.ascii_lowercase
+KEYBOARD_ROWS = ['qwertyuiop', 'asdfghjkl', 'zxcvbnm']
+# pairs of letters that learners confuse (in both directions), besides the keyboard neighbours
+CONFUSIONS = ['ae', 'ai', 'ao', 'au', 'ei', 'eo', 'eu', 'io', 'iu', 'ou', 'iy',
+              'bp', 'ck', 'cs', 'dt', 'fv', 'gj', 'lr', 'mn', 'sz', 'vw']
+SUBSTITUTE, TRANSPOSE, INSERT, DELETE = range(4)
+EDITS = ['substitute', 'transpose', 'insert', 'delete']
+# index of the number of misspelled words in the `counts` of the engines; the same as in generate_pseudo_samples
+MISSPELLED = 5
+
+
+def keyboard_neighbours():
+    """{letter: letters around it} on a QWERTY keyboard, whose rows are shifted right by half a key"""
+    neighbours = {letter: [] for letter in LETTERS}
+    for r, row in enumerate(KEYBOARD_ROWS):
+        for c, letter in enumerate(row):
+            around = [(r, c - 1), (r, c + 1), (r - 1, c), (r - 1, c + 1), (r + 1, c - 1), (r + 1, c)]
+            for rr, cc in around:
+                if 0 <= rr < len(KEYBOARD_ROWS) and 0 <= cc < len(KEYBOARD_ROWS[rr]):
+                    neighbours[letter].append(KEYBOARD_ROWS[rr][cc])
+    return neighbours
+
+
+def read_table(path):
+    """[(letter, replacement, weight)] of a file of `letter<TAB>replacement[<TAB>weight]` lines"""
+    pairs = []
+    with open(path, encoding='utf-8') as fi:
+        for n, line in enumerate(fi, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) not in (2, 3) or fields[0] not in LETTERS or fields[1] not in LETTERS:
+                raise ValueError('{}:{}: expected two lowercase ASCII letters and a weight: {!r}'.format(
+                    path, n, line))
+            pairs.append((fields[0], fields[1], float(fields[2]) if len(fields) == 3 else 1.0))
+    return pairs
+
+
+class ConfusionTable(object):
+    """replacement letters of every letter, as rows of letters and cumulative weights padded to the same width"""
+
+    def __init__(self, extra=()):
+        weights = {letter: {} for letter in LETTERS}
+        for letter, around in keyboard_neighbours().items():
+            for other in around:
+                weights[letter][other] = weights[letter].get(other, 0.0) + 1.0
+        for a, b in CONFUSIONS:
+            weights[a][b] = weights[a].get(b, 0.0) + 1.0
+            weights[b][a] = weights[b].get(a, 0.0) + 1.0
+        for letter, other, weight in extra:
+            if other != letter:
+                weights[letter][other] = weights[letter].get(other, 0.0) + weight
+        width = max(len(row) for row in weights.values())
+        self.replacements = np.zeros((len(LETTERS), width), dtype='<U1')
+        self.cumulative = np.ones((len(LETTERS), width))
+        for i, letter in enumerate(LETTERS):
+            others = sorted(weights[letter])
+            cumulative = np.cumsum([weights[letter][other] for other in others])
+            self.replacements[i, :len(others)] = others
+            self.replacements[i, len(others):] = others[-1]
+            self.cumulative[i, :len(others)] = cumulative / cumulative[-1]
+            # the last weight is exactly 1, so a draw in [0, 1) never reaches the padding
+            self.cumulative[i, len(others) - 1:] = 1.0
+        self.row = {letter: i for i, letter in enumerate(LETTERS)}
+        # the same tables as lists, for the draws of one letter at a time
+        self.replacement_lists = self.replacements.tolist()
+        self.cumulative_lists = self.cumulative.tolist()
+
+    def draw(self, letter, u):
+        """the replacement of lowercase `letter` for the uniform draw `u`"""
+        row = self.row[letter]
+        return self.replacement_lists[row][bisect.bisect_right(self.cumulative_lists[row], u)]
+
+    def draw_array(self, letters, u):
+        """`draw` of every lowercase letter of `letters` with the draws of array `u`"""
+        rows = np.fromiter((self.row[letter] for letter in letters), dtype=np.int64, count=len(letters))
+        columns = (self.cumulative[rows] <= u[:, None]).sum(axis=1)
+        return self.replacements[rows, columns].tolist()
+
+
+def can_misspell(word):
+    return len(word) >= 2 and word.isascii() and word.isalpha()
+
+
+def edit_position(word, edit, u):
+    """the letter edited by `edit` for the uniform draw `u`, and the letter whose replacements are drawn"""
+    n = len(word)
+    if edit == TRANSPOSE:
+        position = int(u * (n - 1))
+    elif edit == INSERT:
+        position = int(u * (n + 1))
+        # a key next to the letter before or at the position slips in
+        return position, word[min(position, n - 1)].lower()
+    else:
+        position = int(u * n)
+    return position, word[position].lower()
+
+
+def apply_edit(word, edit, position, replacement):
+    """`word` with one edit at `position`; `replacement` (lowercase) is the letter substituted or inserted"""
+    if edit == SUBSTITUTE:
+        if word[position].isupper():
+            replacement = replacement.upper()
+        return word[:position] + replacement + word[position + 1:]
+    if edit == TRANSPOSE:
+        return word[:position] + word[position + 1] + word[position] + word[position + 2:]
+    if edit == INSERT:
+        if word[min(position, len(word) - 1)].isupper():
+            replacement = replacement.upper()
+        return word[:position] + replacement + word[position:]
+    return word[:position] + word[position + 1:]
+
+
+def word_spans(tokens, separator='@@'):
+    """(start, end) of the pieces of every word of BPE `tokens`"""
+    spans = []
+    start = 0
+    for i, token in enumerate(tokens):
+        if not token.endswith(separator):
+            spans.append((start, i + 1))
+            start = i + 1
+    if start < len(tokens):
+        spans.append((start, len(tokens)))
+    return spans
+
+
+class Speller(object):
+    """misspell whole words of BPE-segmented token lists and segment them again"""
+
+    def __init__(self, prob, table=None, codes=DEFAULT_CODES, separator='@@'):
+        self.prob = prob
+        self.table = ConfusionTable(read_table(table) if table else ())
+        self.bpe = BPE(codes, separator)
+        self.separator = separator
+
+    def join(self, pieces):
+        n = len(self.separator)
+        return ''.join([piece[:-n] for piece in pieces[:-1]]) + pieces[-1]
+
+    def segment(self, word):
+        return self.bpe.encode_word(word).split(' ')
+
+    def misspell_tokens(self, tokens, rng, counts=None):
+        """`tokens` (pieces) with misspelled words, drawn from `random.Random` `rng`"""
+        output = []
+        n_misspelled = 0
+        for start, end in word_spans(tokens, self.separator):
+            pieces = tokens[start:end]
+            if rng.random() < self.prob:
+                word = self.join(pieces)
+                if can_misspell(word):
+                    edit = int(rng.random() * len(EDITS))
+                    position, letter = edit_position(word, edit, rng.random())
+                    misspelled = apply_edit(word, edit, position, self.table.draw(letter, rng.random()))
+                    if misspelled != word:
+                        output.extend(self.segment(misspelled))
+                        n_misspelled += 1
+                        continue
+            output.extend(pieces)
+        if counts is not None:
+            counts[MISSPELLED] += n_misspelled
+        return output
+
+    def misspell_parsed(self, batch, rng, counts=None):
+        """a vectorized_noise.Batch whose tokens have misspelled words, drawn from numpy Generator `rng`
+
+        The lines (the targets) of the batch are not changed.
+        """
+        lines, lengths, offsets, tokens = batch
+        tokens = tokens.tolist()
+        # a line ends a word even after a piece with a separator
+        ends = ~np.fromiter(map(str.endswith, tokens, repeat(self.separator)), dtype=bool, count=len(tokens))
+        ends[offsets[1:][lengths > 0] - 1] = True
+        word_ends = np.flatnonzero(ends) + 1
+        word_starts = np.concatenate([[0], word_ends[:-1]])
+        chosen = np.flatnonzero(rng.random(len(word_ends)) < self.prob)
+        edits = rng.integers(0, len(EDITS), size=len(chosen)).tolist()
+        u_position = rng.random(len(chosen)).tolist()
+        u_replacement = rng.random(len(chosen))
+
+        candidates = []
+        for k, (start, end) in enumerate(zip(word_starts[chosen].tolist(), word_ends[chosen].tolist())):
+            word = self.join(tokens[start:end])
+            if can_misspell(word):
+                candidates.append((k, start, end, word) + edit_position(word, edits[k], u_position[k]))
+        if not candidates:
+            return batch
+        replacements = self.table.draw_array([c[5] for c in candidates],
+                                             u_replacement[[c[0] for c in candidates]])
+        output = []
+        previous = 0
+        n_misspelled = 0
+        changed_at = []
+        length_change = []
+        for (k, start, end, word, position, _), replacement in zip(candidates, replacements):
+            misspelled = apply_edit(word, edits[k], position, replacement)
+            if misspelled == word:
+                continue
+            pieces = self.segment(misspelled)
+            output.extend(tokens[previous:start])
+            output.extend(pieces)
+            previous = end
+            changed_at.append(start)
+            length_change.append(len(pieces) - (end - start))
+            n_misspelled += 1
+        if counts is not None:
+            counts[MISSPELLED] += n_misspelled
+        if not n_misspelled:
+            return batch
+        output.extend(tokens[previous:])
+        line_of = np.searchsorted(offsets, changed_at, side='right') - 1
+        lengths = lengths + np.bincount(line_of, weights=length_change, minlength=len(lines)).astype(np.int64)
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.empty(len(output), dtype=object)
+        flat[:] = output
+        return type(batch)(lines, lengths, offsets, flat)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print the replacement table of the spelling errors')
+    parser.add_argument('--spelling_table', default=None,
+                        help='extra `letter<TAB>replacement[<TAB>weight]` pairs added to the built-in table')
+    args = parser.parse_args()
+
+    table = ConfusionTable(read_table(args.spelling_table) if args.spelling_table else ())
+    for i, letter in enumerate(LETTERS):
+        previous = 0.0
+        row = []
+        for replacement, cumulative in zip(table.replacement_lists[i], table.cumulative_lists[i]):
+            if cumulative > previous:
+                row.append('{}:{:.3f}'.format(replacement, cumulative - previous))
+            previous = cumulative
+        print('{}\t{}'.format(letter, ' '.join(row)))
+    sys.exit(0)
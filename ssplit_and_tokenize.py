@@ -1,26 +1,62 @@
 # -*- coding: utf-8 -*-
 """
+sentence split and tokenize large gzipped corpora
 
+    python ssplit_and_tokenize.py -i corpus.gz -o out_dir
+    python ssplit_and_tokenize.py -i corpus.*.gz -o out_dir --pipe --batch_size 1000 --n_process 4
+    python ssplit_and_tokenize.py -i corpus.*.gz -o out_dir --pipe --jobs 8
+
+Inputs may be plain, gzip, xz or zstd files and each output is compressed
+like its input (see corpus_io.py); `--checkpoint_every` needs gzip files.
+`--pipe` streams sentences through `nlp.pipe` with a tokenizer-only pipeline
+loaded once; its output is the same as the per-sentence path token for token.
+With `--checkpoint_every N`, a killed run can be continued with `--resume`.
 """
 import argparse
 import gzip
 import os
+import queue
+import threading
+from multiprocessing import Pool
 from pathlib import Path
 
 import spacy
 from blingfire import text_to_sentences
 from logzero import logger
 
+from checkpoint import ResumableOutput, checkpoint_path, load_checkpoint, save_checkpoint
+from corpus_io import BlockWriter
+from corpus_io import iter_lines as iter_text_lines
+from line_index import count_input_lines
+from run_stats import RunStats, add_stats_args
+
 SPACY_MODEL = 'en_core_web_sm'
+# number of input lines (documents) buffered between the reader thread and the tokenizer
+QUEUE_SIZE = 10000
 
 
 def get_args():
     parser = argparse.ArgumentParser(description='sentence split and tokenize large corpus')
-    parser.add_argument('--input', '-i', required=True, type=os.path.abspath,
-                        help='path to input file')
+    parser.add_argument('--input', '-i', required=True, type=os.path.abspath, nargs='+',
+                        help='path to input file(s)')
     parser.add_argument('--output', '-o', required=True, type=os.path.abspath,
                         help='path to output dir')
+    parser.add_argument('--pipe', action='store_true',
+                        help='tokenize with nlp.pipe and a tokenizer-only pipeline (throughput mode)')
+    parser.add_argument('--batch_size', type=int, default=1000,
+                        help='batch size of nlp.pipe')
+    parser.add_argument('--n_process', type=int, default=1,
+                        help='number of processes of nlp.pipe')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of input files processed concurrently (with --pipe)')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='write a checkpoint to DEST.ckpt every this many input lines')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue every output from its checkpoint')
+    add_stats_args(parser)
     args = parser.parse_args()
+    if args.jobs > 1 and args.n_process > 1:
+        parser.error('use either --jobs or --n_process for parallelism, not both')
     return args
 
 
@@ -35,21 +71,189 @@ def tokenize(text, nlp):
     return tokens
 
 
-def main(args):
+def load_tokenizer():
+    """Load the model once and disable every component.
+
+    Only the tokenizer decides the tokens, so the output is the same as
+    calling `tokenize` sentence by sentence.
+    """
+    nlp = spacy.load(SPACY_MODEL)
+    nlp.disable_pipes(*nlp.pipe_names)
+    return nlp
+
+
+def get_dest(path, output):
+    return Path(output, *Path(path).parts[-2:])
+
+
+def iter_lines(fi):
+    """Yield (line, number of bytes) from binary `fi` with universal newlines, like text mode.
+
+    The byte count of a raw line is attributed to its last text line, so that
+    summing them gives an offset at which the input can be resumed.
+    """
+    for raw in fi:
+        text = raw.decode('utf-8')
+        if '\r' in text:
+            parts = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+            if parts[-1] == '':
+                parts.pop()
+                parts = [part + '\n' for part in parts]
+            else:
+                parts = [part + '\n' for part in parts[:-1]] + [parts[-1]]
+            for part in parts[:-1]:
+                yield part, 0
+            yield parts[-1], len(raw)
+        else:
+            yield text, len(raw)
+
+
+def tokenize_lines(lines, nlp):
+    """per-sentence path: yield (output bytes, number of input bytes) for each input line"""
+    for line, n_bytes in lines:
+        out = []
+        sentences = ssplit(line)
+        for sent in sentences:
+            tokens = tokenize(sent, nlp)
+            out.append(' '.join(tokens) + '\n')
+        yield ''.join(out).encode('utf-8'), n_bytes
+
+
+def read_sentences(lines, q):
+    """reader thread: put the sentences of each input line into a bounded queue, then None
+
+    An exception of the reader (e.g. a corrupt compressed file) is put instead of None and raised by `iter_queue`.
+    """
+    try:
+        for line, n_bytes in lines:
+            q.put(([sent.strip() for sent in ssplit(line)], n_bytes))
+    except BaseException as e:
+        q.put(e)
+    else:
+        q.put(None)
+
+
+def iter_queue(q):
+    """yield (sentence, context); the context of the last sentence of a line is its byte count"""
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        sentences, n_bytes = item
+        for sent in sentences[:-1]:
+            yield sent, None
+        yield sentences[-1], n_bytes
+
+
+def pipe_lines(lines, nlp, batch_size=1000, n_process=1):
+    """nlp.pipe path: yield (output bytes, number of input bytes) for each input line"""
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    reader = threading.Thread(target=read_sentences, args=(lines, q), daemon=True)
+    reader.start()
+    out = []
+    for doc, n_bytes in nlp.pipe(iter_queue(q), batch_size=batch_size, n_process=n_process, as_tuples=True):
+        out.append(' '.join([token.text for token in doc]) + '\n')
+        if n_bytes is not None:
+            yield ''.join(out).encode('utf-8'), n_bytes
+            out = []
+    reader.join()
+
+
+def process_file(path, dest, process_lines, checkpoint_every=0, resume=False, stats=None):
+    """ssplit and tokenize one file.
+
+    `process_lines` maps (line, number of bytes) to (output bytes, number of bytes).
+    With `checkpoint_every`, DEST.ckpt is written every this many input lines
+    and `resume` continues from it. `stats` (a run_stats.RunStats) counts the
+    input lines and the output tokens.
+    """
+    logger.info('Processing: {}'.format(path))
+    n_lines = 0
+    if not (checkpoint_every or resume):
+        with BlockWriter(str(dest)) as fo:
+            for out, _ in process_lines((line, 0) for line in iter_text_lines(path, universal=True)):
+                fo.write(out)
+                n_lines += 1
+                if stats is not None:
+                    stats.update(1, len(out.split()))
+        return n_lines
+
+    ckpt = checkpoint_path(dest)
+    state = load_checkpoint(ckpt) if resume else None
+    if state is not None and state['done']:
+        logger.info('Already done: {}'.format(dest))
+        return state['lines']
+    in_offset = state['in_offset'] if state else 0
+    n_lines = last_checkpoint = state['lines'] if state else 0
+    fo = ResumableOutput(str(dest), offset=state['out_offset'] if state else None, compress=True)
+    with gzip.open(path, 'rb') as fi:
+        fi.seek(in_offset)
+        for out, n_bytes in process_lines(iter_lines(fi)):
+            fo.write(out)
+            in_offset += n_bytes
+            if n_bytes:
+                n_lines += 1
+            if stats is not None:
+                stats.update(1 if n_bytes else 0, len(out.split()))
+            if checkpoint_every and n_lines - last_checkpoint >= checkpoint_every and n_bytes:
+                save_checkpoint(ckpt, in_offset=in_offset, lines=n_lines, out_offset=fo.sync(), done=False)
+                last_checkpoint = n_lines
+    save_checkpoint(ckpt, in_offset=in_offset, lines=n_lines, out_offset=fo.sync(), done=True)
+    fo.close()
+    return n_lines
+
+
+_nlp = None
+
+
+def _init_worker():
+    global _nlp
+    _nlp = load_tokenizer()
+
+
+def _process_job(job):
+    """process a file in a worker, which logs its own progress; return its statistics"""
+    path, dest, batch_size, checkpoint_every, resume, progress_every = job
+    stats = RunStats('ssplit_and_tokenize {}'.format(os.path.basename(path)), progress_every)
+    process_file(path, dest, lambda lines: pipe_lines(lines, _nlp, batch_size=batch_size),
+                 checkpoint_every=checkpoint_every, resume=resume, stats=stats)
+    return stats.lines, stats.tokens
+
+
+def main(args, stats=None):
     nlp = spacy.load(SPACY_MODEL)
 
-    logger.info('Processing: {}'.format(args.input))
-    dest = Path(args.output, *Path(args.input).parts[-2:])
-    with gzip.open(args.input, 'rt') as fi, \
-            gzip.open(dest, 'wb') as fo:
-        for line in fi:
-            sentences = ssplit(line)
-            for sent in sentences:
-                tokens = tokenize(sent, nlp)
-                out = ' '.join(tokens) + '\n'
-                fo.write(out.encode('utf-8'))
+    for path in args.input:
+        dest = get_dest(path, args.output)
+        process_file(path, dest, lambda lines: tokenize_lines(lines, nlp),
+                     checkpoint_every=args.checkpoint_every, resume=args.resume, stats=stats)
+
+
+def main_pipe(args, stats=None):
+    jobs = [(path, get_dest(path, args.output), args.batch_size, args.checkpoint_every, args.resume,
+             args.progress_every) for path in args.input]
+    if args.jobs > 1:
+        with Pool(args.jobs, initializer=_init_worker) as pool:
+            for n_lines, n_tokens in pool.imap_unordered(_process_job, jobs):
+                if stats is not None:
+                    stats.update(n_lines, n_tokens)
+    else:
+        nlp = load_tokenizer()
+        for path, dest, batch_size, checkpoint_every, resume, _ in jobs:
+            n_sentences = process_file(
+                path, dest, lambda lines: pipe_lines(lines, nlp, batch_size=batch_size, n_process=args.n_process),
+                checkpoint_every=checkpoint_every, resume=resume, stats=stats)
+            logger.info('Done: {} ({} lines)'.format(dest, n_sentences))
 
 
 if __name__ == "__main__":
     args = get_args()
-    main(args)
+    stats = RunStats('ssplit_and_tokenize', args.progress_every,
+                     count_input_lines(args.input[0]) if len(args.input) == 1 else None)
+    if args.pipe:
+        main_pipe(args, stats)
+    else:
+        main(args, stats)
+    stats.finish(args.stats)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import synthetic_corpus  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory):
+    """(corpus path, normalized unigram frequency path) of a small synthetic corpus"""
+    directory = tmp_path_factory.mktemp('corpus')
+    rng = random.Random(0)
+    vocab = synthetic_corpus.make_vocab(2000, rng)
+    corpus_path = directory / 'corpus.txt'
+    freq_path = directory / 'freq.txt'
+    with open(corpus_path, 'w') as fo:
+        for line in synthetic_corpus.generate_corpus(3000, vocab, rng, mean_length=15, dirty_ratio=0.0):
+            fo.write(line + '\n')
+    synthetic_corpus.write_unigram_freq(freq_path, vocab, 20000)
+    return corpus_path, freq_path
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from conftest import ROOT
+from noise_server import NoiseClient
+
+
+def start_server(freq_path, address, *options):
+    process = subprocess.Popen([sys.executable, str(ROOT / 'generate_pseudo_samples.py'), '-uf', str(freq_path),
+                                '--serve', address] + list(options), stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while not os.path.exists(address):
+        assert process.poll() is None and time.time() < deadline, 'the server did not start'
+        time.sleep(0.1)
+    # the signal handlers are installed right after the socket
+    time.sleep(0.5)
+    return process
+
+
+def test_sigterm_answers_accepted_requests(corpus, tmp_path):
+    corpus_path, freq_path = corpus
+    address = str(tmp_path / 'noise.sock')
+    stats_path = tmp_path / 'stats.json'
+    lines = corpus_path.read_text().splitlines() * 10
+    process = start_server(freq_path, address, '--stats', str(stats_path))
+    try:
+        with NoiseClient(address, timeout=60) as client:
+            for seed in range(2):
+                client.send(client.request(lines, seed=seed))
+            time.sleep(0.2)
+            process.send_signal(signal.SIGTERM)
+            responses = [client.receive() for _ in range(2)]
+        assert [len(pairs) for pairs in responses] == [len(lines), len(lines)]
+        assert process.wait(timeout=60) == 0
+        assert not os.path.exists(address)
+        stats = json.loads(stats_path.read_text())
+        assert stats['lines'] == 2 * len(lines)
+        assert stats['tokens'] == 2 * sum(len(line.split()) for line in lines)
+    finally:
+        process.kill()
+
+
+def test_seeded_request_matches_generate_pseudo_samples(corpus, tmp_path):
+    corpus_path, freq_path = corpus
+    address = str(tmp_path / 'noise.sock')
+    lines = corpus_path.read_text().splitlines()[:200]
+    expected = subprocess.run([sys.executable, str(ROOT / 'generate_pseudo_samples.py'), '-uf', str(freq_path),
+                               '--seed', '5'], input='\n'.join(lines) + '\n', stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout
+    process = start_server(freq_path, address)
+    try:
+        with NoiseClient(address, timeout=60) as client:
+            assert client.corrupt(lines, seed=5) == expected.splitlines()
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
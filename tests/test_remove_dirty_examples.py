@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+import synthetic_corpus
+from remove_dirty_examples import FILTERS, check_line, check_line_bytes, filter_blocks, new_counts
+
+EDGE_CASES = [
+    'a b',
+    'a b c',
+    ' '.join(['w'] * 80),
+    ' '.join(['w'] * 81),
+    # 2 of 10 tokens are punctuation: the ratio is exactly 0.20
+    'a b c d e f g h , .',
+    'a b c d e f g h i , .',
+    'a b  c d',
+    'a b   c d',
+    'a b \t c d',
+    'a b\x0b\x0c\tc d',
+    'a\tb\tc d e',
+    'I have 3 pens and 20 pencils today in the office of mine .',
+    'I have 3 pens .',
+    'call 555/1234 , 12,000 or 3 times 4 5 6 .',
+    '12 34',
+    'the café is open today',
+    'the café is open , really , truly . . .',
+    'a b c　d',
+]
+
+
+def dirty_lines(n_lines=3000, seed=0):
+    rng = random.Random(seed)
+    vocab = synthetic_corpus.make_vocab(500, rng)
+    return list(synthetic_corpus.generate_corpus(n_lines, vocab, rng, mean_length=12, dirty_ratio=0.5))
+
+
+@pytest.mark.parametrize('line', EDGE_CASES)
+def test_check_line_bytes_edge_cases(line):
+    if line.isascii():
+        assert check_line_bytes(line.encode('ascii')) == check_line(line)
+
+
+def test_check_line_bytes_matches_check_line():
+    lines = [line for line in dirty_lines() if line.isascii()]
+    reasons = [check_line(line) for line in lines]
+    assert [check_line_bytes(line.encode('ascii')) for line in lines] == reasons
+    # every filter of the ascii lines is exercised
+    assert set(reasons) >= {None, 'long', 'short', 'puncts', 'digits'}
+
+
+def test_filter_blocks_matches_check_line():
+    lines = dirty_lines() + EDGE_CASES + ['', '   ', '　']
+    block = ''.join(line + '\n' for line in lines).encode('utf-8')
+    counts = new_counts()
+    kept = b''.join(filter_blocks([block], counts)).decode('utf-8').splitlines()
+
+    expected_counts = dict.fromkeys(FILTERS, 0)
+    expected_kept = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        reason = check_line(line)
+        if reason is None:
+            expected_kept.append(line)
+        else:
+            expected_counts[reason] += 1
+    assert kept == expected_kept
+    assert {name: counts[name] for name in FILTERS} == expected_counts
+    assert counts['total'] == len(expected_kept) + sum(expected_counts.values())
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from score_m2 import corpus_counts, f_score, parse_m2, precision, recall, score_systems, sentence_counts
+
+GOLD = '''S The cat sat on mat .
+A 4 4|||ArtOrDet|||the|||REQUIRED|||-NONE-|||0
+
+S He go to school yesterday .
+A 1 2|||Vt|||goes|||REQUIRED|||-NONE-|||1
+A 1 2|||Vt|||went|||REQUIRED|||-NONE-|||0
+
+S It is fine .
+A 3 3|||Mec|||,|||REQUIRED|||-NONE-|||0
+A -1 -1|||noop|||-NONE-|||REQUIRED|||-NONE-|||1
+'''
+
+
+@pytest.fixture(scope='module')
+def gold():
+    return parse_m2(GOLD)
+
+
+@pytest.mark.parametrize('n, hypothesis, expected', [
+    # the missing article is inserted
+    (0, 'The cat sat on the mat .', [(1, 1, 1)]),
+    (0, 'The cat sat on mat .', [(0, 0, 1)]),
+    # a wrong edit and a missed one
+    (0, 'The dog sat on mat .', [(0, 1, 1)]),
+    (0, 'The dog sat on the mat .', [(1, 2, 1)]),
+    # annotators 0 and 1, in the order of their IDs and not of the file
+    (1, 'He went to school yesterday .', [(1, 1, 1), (0, 1, 1)]),
+    (1, 'He goes to school yesterday .', [(0, 1, 1), (1, 1, 1)]),
+    # the noop annotation has no gold edit
+    (2, 'It is fine .', [(0, 0, 1), (0, 0, 0)]),
+])
+def test_sentence_counts(gold, n, hypothesis, expected):
+    sources, gold_edits = gold
+    assert sentence_counts(sources[n], hypothesis, gold_edits[n]) == expected
+
+
+def test_annotator_f_tie_prefers_fewer_edits():
+    # both have F0.5 = 1.25 / 3.25 exactly with the reference formula; P/R rounds them apart
+    assert corpus_counts([[(1, 1, 9), (1, 2, 5)]]) == (1, 2, 5)
+    assert corpus_counts([[(1, 2, 5), (1, 1, 9)]]) == (1, 2, 5)
+
+
+def test_corpus_counts_choose_annotators_with_the_running_counts():
+    # a noop annotator is chosen whenever it keeps the F score of the counts so far higher
+    assert corpus_counts([[(0, 0, 1), (0, 0, 0)]]) == (0, 0, 0)
+    assert corpus_counts([[(1, 1, 1)], [(0, 0, 1), (0, 0, 0)]]) == (1, 1, 1)
+    assert corpus_counts([[(0, 1, 1)], [(1, 1, 1), (0, 1, 1)]]) == (1, 2, 2)
+
+
+def test_score_systems(gold, tmp_path):
+    gold_path = tmp_path / 'gold.m2'
+    gold_path.write_text(GOLD)
+    system = tmp_path / 'system.out'
+    system.write_text('The dog sat on the mat .\nHe goes to school yesterday .\nIt is fine .\n')
+    (path, (correct, proposed, gold_count)), = score_systems(gold, [str(system)]).items()
+    # 1 of 2 edits right, then the annotator with "goes", then the noop annotator
+    assert (correct, proposed, gold_count) == (2, 3, 2)
+    assert precision(correct, proposed) == pytest.approx(2 / 3)
+    assert recall(correct, gold_count) == 1.0
+    assert f_score(correct, proposed, gold_count) == pytest.approx(1.25 * 2 / 3 / (0.25 * 2 / 3 + 1))
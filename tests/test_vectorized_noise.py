@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import math
+import random
+
+import numpy as np
+import pytest
+
+from generate_pseudo_samples import make_mistakes, make_single_mistake
+from unigram_sampler import build_sampler, read_unigram_freq
+from vectorized_noise import DELETE, INSERT, KEEP, MASK, PAD, as_vocab_array, corrupt_batch, iter_batches, output_stats
+
+PROB_MASK = 0.5
+PROB_ORIG = 0.2
+CONFIGS = [
+    {'use_insertion': 1, 'use_deletion': 1, 'single_mistake': 0},
+    {'use_insertion': 0, 'use_deletion': 1, 'single_mistake': 0},
+    {'use_insertion': 1, 'use_deletion': 0, 'single_mistake': 0},
+    {'use_insertion': 1, 'use_deletion': 1, 'single_mistake': 1},
+]
+# tolerance of a rate in standard deviations of its binomial estimate
+MAX_Z = 5.0
+
+
+def expected_rates(use_insertion, use_deletion, single_mistake):
+    """probabilities of keep/mask/insert/delete of a token, or of the corrupted token of a line with single_mistake"""
+    insert = (1.0 - PROB_MASK) / 2 if use_insertion or single_mistake else 0.0
+    delete = (1.0 - PROB_MASK) / 2 if use_deletion or single_mistake else 0.0
+    mask = PROB_MASK - PROB_ORIG
+    return {KEEP: 1.0 - mask - insert - delete, MASK: mask, INSERT: insert, DELETE: delete}
+
+
+def run_engine(engine, lines, index2word, sampler, config, seed=1):
+    counts = [0] * (PAD + 1)
+    options = dict(prob_mask=PROB_MASK, prob_orig=PROB_ORIG)
+    if engine == 'python':
+        rng = random.Random(seed)
+        if config['single_mistake']:
+            outputs = [make_single_mistake(line, rng, index2word, sampler, counts=counts, **options)
+                       for line in lines]
+        else:
+            outputs = [make_mistakes(line, rng, index2word, sampler, use_insertion=config['use_insertion'],
+                                     use_deletion=config['use_deletion'], counts=counts, **options)
+                       for line in lines]
+    else:
+        rng = np.random.default_rng(seed)
+        vocab = as_vocab_array(index2word)
+        outputs = []
+        for batch in iter_batches(lines, 1000):
+            text = corrupt_batch(batch, rng, vocab, sampler, counts=counts, **dict(options, **config))
+            outputs += text.splitlines(True)
+    return outputs, counts
+
+
+@pytest.fixture(scope='module')
+def noise_inputs(corpus):
+    corpus_path, freq_path = corpus
+    index2word, freqs = read_unigram_freq(str(freq_path))
+    with open(corpus_path) as fi:
+        lines = fi.readlines()
+    return lines, index2word, build_sampler(freqs)
+
+
+@pytest.mark.parametrize('config', CONFIGS, ids=['default', 'no_insertion', 'no_deletion', 'single_mistake'])
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+def test_operation_rates(noise_inputs, engine, config):
+    lines, index2word, sampler = noise_inputs
+    outputs, counts = run_engine(engine, lines, index2word, sampler, config)
+    n_tokens = sum(len(line.split()) for line in lines)
+    assert len(outputs) == len(lines)
+    assert sum(counts[:PAD]) == n_tokens
+
+    # the operations are those of the output: masks in the sources, and the length changes of the pairs
+    stats = output_stats(outputs)
+    assert stats['n_mask'].sum() == counts[MASK]
+    assert stats['length_change'].sum() == counts[INSERT] - counts[DELETE]
+    assert stats['pad_rate'].sum() == counts[PAD]
+
+    expected = expected_rates(**config)
+    if config['single_mistake']:
+        # one token per line goes through the draw, the others are kept
+        n_draws = len(lines)
+        counts[KEEP] -= n_tokens - n_draws
+    else:
+        n_draws = n_tokens
+    for op in [KEEP, MASK, INSERT, DELETE]:
+        p = expected[op]
+        rate = counts[op] / n_draws
+        tolerance = MAX_Z * math.sqrt(p * (1.0 - p) / n_draws)
+        assert abs(rate - p) <= tolerance, 'rate of operation {} is {:.4f}, expected {:.4f}'.format(op, rate, p)
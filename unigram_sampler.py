@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+compact samplers over a unigram frequency table
+
+Both samplers store one entry per vocabulary item, so memory grows with the
+size of the vocabulary rather than with the total frequency mass.
+
+- CumulativeSampler draws with a binary search over cumulative frequencies.
+  It consumes the random stream exactly like `random.choice(word_index_list)`
+  over the old expanded list, so existing seeds reproduce the same corpora.
+- AliasSampler draws in O(1) with Walker's alias method, but consumes the
+  random stream differently.
+
+Building the tables means parsing the whole frequency file, which is paid
+again by every run. `load_sampler` instead memory-maps a compiled cache
+FREQ_FILE.METHOD.cache (the tokens as one string table plus the sampler
+arrays) that is written on first use and rebuilt whenever the size or mtime
+of the frequency file changes. To compile it in advance:
+
+    python unigram_sampler.py -uf norm_freq_file --sampler cumsum
+"""
+import argparse
+import mmap
+import os
+import random
+import struct
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+from logzero import logger
+
+CACHE_MAGIC = b'GECSMP1\n'
+CACHE_VERSION = 1
+# version, size and mtime (ns) of the frequency file, number of tokens, total frequency, bytes of the strings
+CACHE_HEADER = struct.Struct('<QQQQQQ8s')
+
+
+class CumulativeSampler(object):
+    """sample index `n` with probability freqs[n] / sum(freqs)"""
+
+    name = 'cumsum'
+
+    def __init__(self, freqs):
+        self.cum_freqs = array('q')
+        total = 0
+        for freq in freqs:
+            total += freq
+            self.cum_freqs.append(total)
+        self.total = total
+
+    @classmethod
+    def from_tables(cls, total, cum_freqs):
+        sampler = cls.__new__(cls)
+        sampler.cum_freqs = cum_freqs
+        sampler.total = total
+        return sampler
+
+    def tables(self):
+        """int64 buffers of the sampler, in the order of `from_tables`"""
+        return [self.cum_freqs]
+
+    def __len__(self):
+        return len(self.cum_freqs)
+
+    def sample(self, rng=random):
+        # `random.choice(seq)` is `seq[rng._randbelow(len(seq))]`, and so is
+        # `rng.randrange(len(seq))`: the k-th element of the expanded list is
+        # the first index whose cumulative frequency exceeds k.
+        return bisect_right(self.cum_freqs, rng.randrange(self.total))
+
+    def sample_array(self, rng, size):
+        """draw `size` indices at once with a `numpy.random.Generator`"""
+        import numpy as np
+        cum_freqs = np.frombuffer(self.cum_freqs, dtype=np.int64)
+        return np.searchsorted(cum_freqs, rng.integers(self.total, size=size), side='right')
+
+
+class AliasSampler(object):
+    """sample index `n` with probability freqs[n] / sum(freqs) in O(1)"""
+
+    name = 'alias'
+
+    def __init__(self, freqs):
+        freqs = list(freqs)
+        size = len(freqs)
+        total = float(sum(freqs))
+        scaled = [f * size / total for f in freqs]
+        self.prob = array('d', [1.0] * size)
+        self.alias = array('l', range(size))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            g = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = g
+            scaled[g] = (scaled[g] + scaled[s]) - 1.0
+            if scaled[g] < 1.0:
+                small.append(g)
+            else:
+                large.append(g)
+        # leftovers are numerically 1.0
+        self.total = int(total)
+
+    @classmethod
+    def from_tables(cls, total, prob, alias):
+        sampler = cls.__new__(cls)
+        sampler.prob = prob
+        sampler.alias = alias
+        sampler.total = total
+        return sampler
+
+    def tables(self):
+        """8-byte buffers of the sampler, in the order of `from_tables`"""
+        return [self.prob, array('q', self.alias)]
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, rng=random):
+        u = rng.random() * len(self.prob)
+        i = int(u)
+        if u - i < self.prob[i]:
+            return i
+        return self.alias[i]
+
+    def sample_array(self, rng, size):
+        """draw `size` indices at once with a `numpy.random.Generator`"""
+        import numpy as np
+        prob = np.frombuffer(self.prob, dtype=np.float64)
+        alias = np.asarray(self.alias)
+        u = rng.random(size) * len(prob)
+        i = u.astype(np.int64)
+        return np.where(u - i < prob[i], i, alias[i])
+
+
+SAMPLERS = {
+    CumulativeSampler.name: CumulativeSampler,
+    AliasSampler.name: AliasSampler,
+}
+
+
+def read_unigram_freq(path_to_unigram_freq):
+    """read `token\\tfreq` lines and return (tokens, freqs)"""
+    tokens = []
+    freqs = array('q')
+    with open(path_to_unigram_freq, 'r') as fi:
+        for line in fi:
+            token, freq = line.strip().split('\t')
+            tokens.append(token)
+            freqs.append(int(freq))
+    return tokens, freqs
+
+
+def build_sampler(freqs, method=CumulativeSampler.name):
+    return SAMPLERS[method](freqs)
+
+
+class StringTable(object):
+    """Read-only list of str stored as newline-terminated UTF-8 bytes and their offsets.
+
+    Items are decoded on access; `tolist` decodes all of them at once.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        return str(self.data[self.offsets[n]:self.offsets[n + 1] - 1], 'utf-8')
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        return str(self.data, 'utf-8').split('\n')[:-1]
+
+
+def cache_path(path_to_unigram_freq, method):
+    return '{}.{}.cache'.format(path_to_unigram_freq, method)
+
+
+def source_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _padding(n):
+    return b'\0' * (-n % 8)
+
+
+def compile_sampler(path_to_unigram_freq, method=CumulativeSampler.name, dest=None):
+    """Build the sampler of a frequency file and write it to a cache; return (tokens, sampler)."""
+    dest = dest or cache_path(path_to_unigram_freq, method)
+    size, mtime = source_stamp(path_to_unigram_freq)
+    tokens, freqs = read_unigram_freq(path_to_unigram_freq)
+    sampler = build_sampler(freqs, method)
+    # a token never contains a newline, since the frequency file has one token per line
+    encoded = [token.encode('utf-8') + b'\n' for token in tokens]
+    offsets = array('q', accumulate(map(len, encoded), initial=0))
+    strings = b''.join(encoded)
+    # concurrent runs may compile the same cache; each writes its own file and renames it
+    tmp = '{}.{}.tmp'.format(dest, os.getpid())
+    with open(tmp, 'wb') as fo:
+        fo.write(CACHE_MAGIC)
+        fo.write(CACHE_HEADER.pack(CACHE_VERSION, size, mtime, len(tokens), sampler.total, len(strings),
+                                   method.encode('ascii')))
+        fo.write(offsets.tobytes())
+        fo.write(strings + _padding(len(strings)))
+        for table in sampler.tables():
+            fo.write(table.tobytes())
+    os.replace(tmp, dest)
+    logger.info('compiled {} tokens of {} into {}'.format(len(tokens), path_to_unigram_freq, dest))
+    return tokens, sampler
+
+
+def load_cached_sampler(path, path_to_unigram_freq, method=CumulativeSampler.name):
+    """Memory-map a cache written by `compile_sampler`.
+
+    Returns (StringTable of the tokens, sampler), or None if the cache is
+    missing, of another version or older than the frequency file.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fi:
+        if fi.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        version, size, mtime, n_tokens, total, n_bytes, cached_method = CACHE_HEADER.unpack(
+            fi.read(CACHE_HEADER.size))
+        if (version != CACHE_VERSION or (size, mtime) != source_stamp(path_to_unigram_freq)
+                or cached_method.rstrip(b'\0') != method.encode('ascii')):
+            return None
+        data = memoryview(mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ))
+    position = len(CACHE_MAGIC) + CACHE_HEADER.size
+
+    def take(n, fmt):
+        nonlocal position
+        view = data[position:position + 8 * n].cast(fmt)
+        position += 8 * n
+        return view
+
+    offsets = take(n_tokens + 1, 'q')
+    strings = data[position:position + n_bytes]
+    position += n_bytes + len(_padding(n_bytes))
+    if method == CumulativeSampler.name:
+        sampler = CumulativeSampler.from_tables(total, take(n_tokens, 'q'))
+    else:
+        sampler = AliasSampler.from_tables(total, take(n_tokens, 'd'), take(n_tokens, 'q'))
+    return StringTable(strings, offsets), sampler
+
+
+def load_sampler(path_to_unigram_freq, method=CumulativeSampler.name, use_cache=True):
+    """(tokens, sampler) of a frequency file, through its compiled cache if `use_cache`"""
+    if not use_cache:
+        tokens, freqs = read_unigram_freq(path_to_unigram_freq)
+        return tokens, build_sampler(freqs, method)
+    path = cache_path(path_to_unigram_freq, method)
+    cached = load_cached_sampler(path, path_to_unigram_freq, method)
+    if cached is not None:
+        logger.info('loaded the compiled sampler {}'.format(path))
+        return cached
+    try:
+        compile_sampler(path_to_unigram_freq, method, path)
+    except OSError as e:
+        # e.g. a read-only directory; build the tables in memory as without the cache
+        logger.warning('cannot write the sampler cache {}: {}'.format(path, e))
+        return load_sampler(path_to_unigram_freq, method, use_cache=False)
+    return load_cached_sampler(path, path_to_unigram_freq, method)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compile the sampler cache of a unigram frequency file')
+    parser.add_argument('--unigram_freq', '-uf', required=True, nargs='+', help='normalized frequency file(s)')
+    parser.add_argument('--sampler', choices=sorted(SAMPLERS), default=CumulativeSampler.name,
+                        help='sampler of generate_pseudo_samples.py (default: %(default)s)')
+    args = parser.parse_args()
+    for freq_path in args.unigram_freq:
+        compile_sampler(freq_path, args.sampler)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+bounded-memory approximate unigram counting
+
+`SketchCounter` keeps the `top_k` most frequent tokens in a space-saving
+summary and every count in a Count-Min sketch of `depth` x `width` int64
+cells, so memory does not grow with the number of distinct tokens. The count
+of a tracked token is the smaller of both estimates; both only overestimate,
+and a token that was never evicted from the summary is counted exactly.
+Tokens that are not in the summary at the end are not listed in the output,
+so they get probability 0 in the insertion distribution of
+generate_pseudo_samples.py; on a long-tailed corpus this can be a large part
+of the normalized mass. The summary should hold every token that matters.
+
+Sketches of different parts of a corpus can be merged (with the same width,
+depth and seed). Running this file reports how much a frequency file counted
+this way differs from the exact one after normalization, and warns if the
+tokens it lacks carry more than --max_missing_mass of the exact mass:
+
+    python unigram_sketch.py --exact freq_file --approx approx_freq_file --norm 300
+"""
+import argparse
+import hashlib
+import heapq
+import struct
+
+from logzero import logger
+
+SKETCH_MAGIC = b'GECSKT1\n'
+# top_k, width, depth, seed, part, number of tracked tokens
+SKETCH_HEADER = struct.Struct('<QQQQIQ')
+# byte length of the token, count, error
+SKETCH_RECORD = struct.Struct('<IQQ')
+
+
+def token_hash(token):
+    """stable 64-bit hash of a str token, the same in every process and on every machine"""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class CountMinSketch(object):
+    """`depth` rows of `width` counters indexed by double hashing of a 64-bit token hash"""
+
+    def __init__(self, width=1 << 20, depth=4, seed=0):
+        import numpy as np
+        self.np = np
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _indices(self, tokens):
+        np = self.np
+        hashes = np.array([token_hash(token) ^ self.seed for token in tokens], dtype=np.uint64)
+        h1 = hashes & np.uint64(0xffffffff)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((h1[None, :] + rows * h2[None, :]) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, tokens, counts):
+        idx = self._indices(tokens)
+        counts = self.np.asarray(counts, dtype=self.np.int64)
+        for row in range(self.depth):
+            self.np.add.at(self.table[row], idx[row], counts)
+
+    def query(self, tokens):
+        idx = self._indices(tokens)
+        return self.table[self.np.arange(self.depth)[:, None], idx].min(axis=0)
+
+    def merge(self, other):
+        if (self.width, self.depth, self.seed) != (other.width, other.depth, other.seed):
+            raise ValueError('cannot merge sketches of different width, depth or seed')
+        self.table += other.table
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class SketchCounter(object):
+    """space-saving summary of the `top_k` heaviest tokens plus a Count-Min sketch of all counts"""
+
+    def __init__(self, top_k=100000, width=1 << 20, depth=4, seed=0):
+        self.top_k = top_k
+        self.sketch = CountMinSketch(width, depth, seed)
+        # insertion-ordered, so ties keep the order in which tokens entered the summary
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+
+    def _pop_min(self):
+        # the heap holds stale entries of tokens whose count has grown or that were evicted
+        while True:
+            count, token = heapq.heappop(self.heap)
+            if self.counts.get(token) == count:
+                return token, count
+
+    def _push(self, token, count):
+        heapq.heappush(self.heap, (count, token))
+        if len(self.heap) > 4 * self.top_k:
+            self.heap = [(c, t) for t, c in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def update(self, counter):
+        """add a {token: count} mapping, e.g. the Counter of one chunk"""
+        if not counter:
+            return
+        self.sketch.add(list(counter.keys()), list(counter.values()))
+        counts, errors = self.counts, self.errors
+        for token, count in counter.items():
+            self.total += count
+            if token in counts:
+                counts[token] += count
+            elif len(counts) < self.top_k:
+                counts[token] = count
+                errors[token] = 0
+            else:
+                # space-saving: the new token takes over the smallest counter
+                evicted, min_count = self._pop_min()
+                del counts[evicted], errors[evicted]
+                counts[token] = min_count + count
+                errors[token] = min_count
+            self._push(token, counts[token])
+
+    def min_count(self):
+        """upper bound of the count of an untracked token: the smallest tracked count once the summary is full"""
+        return min(self.counts.values()) if len(self.counts) >= self.top_k else 0
+
+    def merge(self, other):
+        """add the counts of another sketch; the summary keeps the `top_k` largest sums
+
+        A token tracked on one side only may have been evicted from the other,
+        so it gets the other side's `min_count` added to its count and error.
+        """
+        self.sketch.merge(other.sketch)
+        self.total += other.total
+        own_min, other_min = self.min_count(), other.min_count()
+        counts, errors = self.counts, self.errors
+        for token in counts:
+            if token not in other.counts:
+                counts[token] += other_min
+                errors[token] += other_min
+        for token, count in other.counts.items():
+            if token in counts:
+                counts[token] += count
+                errors[token] += other.errors[token]
+            else:
+                counts[token] = own_min + count
+                errors[token] = own_min + other.errors[token]
+        if len(self.counts) > self.top_k:
+            keep = set(heapq.nlargest(self.top_k, self.counts, key=self.counts.get))
+            self.counts = {t: c for t, c in self.counts.items() if t in keep}
+            self.errors = {t: e for t, e in self.errors.items() if t in keep}
+        self.heap = [(c, t) for t, c in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def items(self):
+        """(token, estimated count) of the tracked tokens in summary order"""
+        tokens = list(self.counts)
+        if not tokens:
+            return []
+        estimates = self.sketch.query(tokens).tolist()
+        return [(t, min(self.counts[t], e)) for t, e in zip(tokens, estimates)]
+
+    @property
+    def nbytes(self):
+        """rough memory of the summary and the sketch"""
+        return self.sketch.nbytes + 200 * self.top_k
+
+    def save(self, path, part=0):
+        with open(path, 'wb') as fo:
+            fo.write(SKETCH_MAGIC)
+            fo.write(SKETCH_HEADER.pack(self.top_k, self.sketch.width, self.sketch.depth, self.sketch.seed, part,
+                                        len(self.counts)))
+            fo.write(struct.pack('<Q', self.total))
+            fo.write(self.sketch.table.tobytes())
+            for token, count in self.counts.items():
+                encoded = token.encode('utf-8')
+                fo.write(SKETCH_RECORD.pack(len(encoded), count, self.errors[token]))
+                fo.write(encoded)
+        logger.info('wrote a sketch of {} tokens to {}'.format(len(self.counts), path))
+
+    @classmethod
+    def load(cls, path):
+        """return (sketch, part)"""
+        with open(path, 'rb') as fi:
+            if fi.read(len(SKETCH_MAGIC)) != SKETCH_MAGIC:
+                raise ValueError('{} is not a unigram count sketch'.format(path))
+            top_k, width, depth, seed, part, n_tokens = SKETCH_HEADER.unpack(fi.read(SKETCH_HEADER.size))
+            counter = cls(top_k, width, depth, seed)
+            counter.total, = struct.unpack('<Q', fi.read(8))
+            np = counter.sketch.np
+            counter.sketch.table = np.frombuffer(fi.read(8 * width * depth), dtype=np.int64).reshape(
+                depth, width).copy()
+            for _ in range(n_tokens):
+                length, count, error = SKETCH_RECORD.unpack(fi.read(SKETCH_RECORD.size))
+                token = fi.read(length).decode('utf-8')
+                counter.counts[token] = count
+                counter.errors[token] = error
+        counter.heap = [(c, t) for t, c in counter.counts.items()]
+        heapq.heapify(counter.heap)
+        return counter, part
+
+
+def is_sketch(path):
+    with open(path, 'rb') as fi:
+        return fi.read(len(SKETCH_MAGIC)) == SKETCH_MAGIC
+
+
+def merge_sketches(paths):
+    """merge sketch files in the order of their part"""
+    sketches = sorted((SketchCounter.load(path) for path in paths), key=lambda x: x[1])
+    merged = sketches[0][0]
+    for sketch, _ in sketches[1:]:
+        merged.merge(sketch)
+    return merged
+
+
+def read_freq(path):
+    freqs = {}
+    with open(path, 'r', encoding='utf-8') as fi:
+        for line in fi:
+            token, freq = line.rstrip('\n').split('\t')
+            freqs[token] = int(freq)
+    return freqs
+
+
+def compare(exact, approx, norm):
+    """Compare two raw frequency files after `normalize_unigram_freq.py --norm`.
+
+    The insertion distribution of generate_pseudo_samples.py draws a token with
+    probability proportional to its normalized frequency, so the total
+    variation distance between both distributions bounds how differently any
+    set of inserted tokens is drawn.
+    """
+    exact_norm = {t: max(f // norm, 1) for t, f in exact.items()}
+    approx_norm = {t: max(f // norm, 1) for t, f in approx.items()}
+    exact_total = float(sum(exact_norm.values()))
+    approx_total = float(sum(approx_norm.values()))
+    tokens = set(exact_norm) | set(approx_norm)
+    tvd = 0.5 * sum(abs(exact_norm.get(t, 0) / exact_total - approx_norm.get(t, 0) / approx_total) for t in tokens)
+    missing = [t for t in exact_norm if t not in approx_norm]
+    shared = [t for t in exact if t in approx]
+    return {
+        'exact_types': len(exact),
+        'approx_types': len(approx),
+        'missing_types': len(missing),
+        'missing_mass': sum(exact_norm[t] for t in missing) / exact_total,
+        'extra_types': sum(1 for t in approx if t not in exact),
+        'changed_normalized': sum(1 for t in shared if exact_norm[t] != approx_norm[t]),
+        'max_count_error': max([approx[t] - exact[t] for t in shared] or [0]),
+        'total_variation': tvd,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare an approximate frequency file with the exact one')
+    parser.add_argument('--exact', required=True, help='output of count_unigram_freq.py')
+    parser.add_argument('--approx', required=True, help='output of count_unigram_freq.py --approx')
+    parser.add_argument('--norm', default=300, type=int, help='--norm of normalize_unigram_freq.py')
+    parser.add_argument('--max_missing_mass', default=0.01, type=float,
+                        help='warn if the tokens missing from --approx carry more of the normalized mass than this')
+    args = parser.parse_args()
+    result = compare(read_freq(args.exact), read_freq(args.approx), args.norm)
+    for key, value in result.items():
+        print('{}\t{}'.format(key, value))
+    if result['missing_mass'] > args.max_missing_mass:
+        logger.warning('{} tokens missing from {} carry {:.1%} of the normalized mass; they are never inserted. '
+                       'Use a larger --approx'.format(result['missing_types'], args.approx, result['missing_mass']))
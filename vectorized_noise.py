@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+vectorized DirectNoise engine
+
+Reads sentences in batches and draws every keep/mask/insert/delete decision
+and every inserted token of the batch with a few NumPy calls, then builds the
+output of the whole batch with a single join. The semantics of `--prob_orig`, `--prob_mask`,
+`--use_insertion`, `--use_deletion` and `--single_mistake` are the same as in
+generate_pseudo_samples.py, but the random stream is different, so the two
+engines do not produce the same corpus for the same seed.
+
+Running this file compares the operation rates of both engines:
+    python vectorized_noise.py -uf norm_freq_file < corpus
+"""
+import argparse
+import math
+import random
+import sys
+from collections import namedtuple
+
+import numpy as np
+from logzero import logger
+
+KEEP, MASK, INSERT, DELETE = 0, 1, 2, 3
+# index of the number of identical pairs (with a padded target) in the `counts` of corrupt_parsed
+PAD = 4
+
+
+def draw_operations(rng, n_tokens, prob_mask, prob_orig):
+    """draw one operation per token with the same thresholds as make_mistakes"""
+    rnd = rng.random(n_tokens)
+    rnd2 = rng.random(n_tokens)
+    ops = np.where(rnd2 < 0.5, INSERT, DELETE)
+    ops[rnd < prob_mask] = MASK
+    ops[rnd < prob_orig] = KEEP
+    return ops
+
+
+def draw_line_operations(rng, lengths, offsets, prob_mask=0.3, prob_orig=0.2, use_insertion=1, use_deletion=1,
+                         single_mistake=0):
+    """the operation of every token of sentences of `lengths` tokens, flattened at `offsets`"""
+    n_lines = len(lengths)
+    n_tokens = int(offsets[-1])
+    if single_mistake:
+        # every token is kept except one per sentence, which goes through the usual draw
+        ops = np.full(n_tokens, KEEP)
+        mistake_idx = offsets[:-1] + (rng.random(n_lines) * lengths).astype(np.int64)
+        mistakes = draw_operations(rng, n_lines, prob_mask, prob_orig)
+        # a sentence without tokens has no token to corrupt
+        has_tokens = lengths > 0
+        ops[mistake_idx[has_tokens]] = mistakes[has_tokens]
+    else:
+        ops = draw_operations(rng, n_tokens, prob_mask, prob_orig)
+        if not use_insertion:
+            ops[ops == INSERT] = KEEP
+        if not use_deletion:
+            ops[ops == DELETE] = KEEP
+    return ops
+
+
+Batch = namedtuple('Batch', ['lines', 'lengths', 'offsets', 'tokens'])
+
+
+def parse_batch(lines):
+    """split a batch of lines into one flat token array; it is only read by `corrupt_parsed`"""
+    n_lines = len(lines)
+    wlists = [line.strip('\r\n ').split(' ') for line in lines]
+    lengths = np.fromiter((len(w) for w in wlists), dtype=np.int64, count=n_lines)
+    offsets = np.zeros(n_lines + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.empty(int(offsets[-1]), dtype=object)
+    tokens[:] = [t for w in wlists for t in w]
+    return Batch(lines, lengths, offsets, tokens)
+
+
+def corrupt_batch(lines, rng, vocab, sampler, **kwargs):
+    """Corrupt a batch of lines and return the `src ||| trg` pairs as one string.
+
+    :param lines: input lines (with or without trailing newline)
+    :param rng: numpy.random.Generator
+    :param vocab: numpy object array mapping sampler index to token
+    :param sampler: CumulativeSampler or AliasSampler
+    """
+    return corrupt_parsed(parse_batch(lines), rng, vocab, sampler, **kwargs)
+
+
+def corrupt_parsed(batch, rng, vocab, sampler, prob_mask=0.3, prob_orig=0.2, use_insertion=1, use_deletion=1,
+                   single_mistake=0, counts=None, speller=None):
+    """`corrupt_batch` on a batch from `parse_batch`, which can be corrupted many times
+
+    `counts` (a list indexed by KEEP, MASK, INSERT, DELETE and PAD) is incremented
+    by the operations applied to the tokens and the number of padded pairs.
+    `speller` (a spelling_noise.Speller) misspells words of the sources first.
+    """
+    if speller is not None:
+        batch = speller.misspell_parsed(batch, rng, counts)
+    lines, lengths, offsets, tokens = batch
+    n_lines = len(lines)
+    n_tokens = len(tokens)
+    ops = draw_line_operations(rng, lengths, offsets, prob_mask, prob_orig, use_insertion, use_deletion,
+                               single_mistake)
+
+    # token i becomes pieces[2 * i] followed by the separator pieces[2 * i + 1]
+    pieces = np.empty(2 * n_tokens, dtype=object)
+    pieces[0::2] = tokens
+    pieces[1::2] = ' '
+    is_mask = ops == MASK
+    pieces[0::2][is_mask] = '|'
+    is_delete = ops == DELETE
+    pieces[0::2][is_delete] = ''
+    pieces[1::2][is_delete] = ''
+    is_insert = ops == INSERT
+    insert_at = 2 * np.flatnonzero(is_insert) + 2
+    n_insert = len(insert_at)
+    inserted = np.empty(2 * n_insert, dtype=object)
+    inserted[0::2] = vocab[sampler.sample_array(rng, n_insert)] if n_insert else []
+    inserted[1::2] = ' '
+    pads = rng.integers(1, 9, size=n_lines).tolist()
+
+    targets = np.empty(n_lines, dtype=object)
+    targets[:] = lines
+    tails = np.empty(2 * n_lines, dtype=object)
+    tails[0::2] = '||| '
+    tails[1::2] = targets
+    tail_at = 2 * np.repeat(offsets[1:], 2)
+    # np.insert keeps the order of values for equal positions, so a word inserted
+    # after the last token of a line comes before the `||| target` tail
+    pieces = np.insert(pieces, np.concatenate([np.repeat(insert_at, 2), tail_at]),
+                       np.concatenate([inserted, tails])).tolist()
+
+    # a pair can only be identical if as many tokens were inserted as deleted,
+    # so only those lines have to be compared with the original
+    line_of = np.repeat(np.arange(n_lines), lengths)
+    n_inserts = np.bincount(line_of[is_insert], minlength=n_lines)
+    n_deletes = np.bincount(line_of[is_delete], minlength=n_lines)
+    starts = np.zeros(n_lines + 1, dtype=np.int64)
+    np.cumsum(2 * lengths + 2 * n_inserts + 2, out=starts[1:])
+    n_pad = 0
+    for n in np.flatnonzero(n_inserts == n_deletes).tolist():
+        separator_at = int(starts[n + 1]) - 2
+        t_out = ''.join(pieces[starts[n]:separator_at])
+        if t_out.strip('\r\n ') == lines[n].strip('\r\n '):
+            # 元の文と同じになった場合はtarget側にpadを付ける
+            pieces[separator_at] = '||| ' + '| ' * pads[n]
+            n_pad += 1
+    if counts is not None:
+        for op, n in enumerate(np.bincount(ops, minlength=4).tolist()):
+            counts[op] += n
+        counts[PAD] += n_pad
+    return ''.join(pieces)
+
+
+def chunk_generator(r_seed, chunk_index, variant=0):
+    """generator of the `chunk_index`-th chunk; independent of the number of workers
+
+    Variant 0 is the stream of a run without --num_variants.
+    """
+    if variant == 0:
+        return np.random.default_rng([r_seed, chunk_index])
+    return np.random.default_rng([r_seed, chunk_index, variant])
+
+
+def iter_batches(fi, batch_size):
+    batch = []
+    for line in fi:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(fi, fo, rng, vocab, sampler, batch_size=1000, stats=None, **kwargs):
+    """corrupt `fi` into `fo` batch by batch; `stats` (a run_stats.RunStats) is updated per batch"""
+    proceed = 0
+    for batch in iter_batches(fi, batch_size):
+        proceed += len(batch)
+        fo.write(corrupt_batch(batch, rng, vocab, sampler, **kwargs))
+        if stats is not None:
+            stats.update(len(batch))
+    return proceed
+
+
+def as_vocab_array(index2word):
+    vocab = np.empty(len(index2word), dtype=object)
+    if hasattr(index2word, 'tolist'):
+        # a StringTable of a compiled sampler cache decodes all tokens at once
+        vocab[:] = index2word.tolist()
+    else:
+        vocab[:] = [index2word[i] for i in range(len(index2word))]
+    return vocab
+
+
+def output_stats(outputs):
+    """per-line statistics that both engines must agree on in distribution"""
+    length_change = np.empty(len(outputs))
+    n_mask = np.empty(len(outputs))
+    is_pad = np.empty(len(outputs))
+    for n, out in enumerate(outputs):
+        src, trg = out.rstrip('\n').split('||| ', 1)
+        src_tokens = src.split()
+        trg_tokens = trg.split()
+        is_pad[n] = trg.startswith('| ') and src.strip() == trg.lstrip('| ').strip()
+        length_change[n] = 0 if is_pad[n] else len(src_tokens) - len(trg_tokens)
+        n_mask[n] = src_tokens.count('|') - (0 if is_pad[n] else trg_tokens.count('|'))
+    return {'length_change': length_change, 'n_mask': n_mask, 'pad_rate': is_pad}
+
+
+def check_rates(lines, index2word, sampler, r_seed=1, **kwargs):
+    """Compare the rates achieved by the python engine and this engine.
+
+    Returns a list of (config, statistic, python mean, numpy mean, z-score).
+    """
+    from generate_pseudo_samples import make_mistakes, make_single_mistake
+
+    vocab = as_vocab_array(index2word)
+    configs = [
+        {'use_insertion': 1, 'use_deletion': 1, 'single_mistake': 0},
+        {'use_insertion': 0, 'use_deletion': 1, 'single_mistake': 0},
+        {'use_insertion': 1, 'use_deletion': 0, 'single_mistake': 0},
+        {'use_insertion': 1, 'use_deletion': 1, 'single_mistake': 1},
+    ]
+    results = []
+    for config in configs:
+        py_rng = random.Random(r_seed)
+        if config['single_mistake']:
+            py_out = [make_single_mistake(line, py_rng, index2word, sampler, **kwargs) for line in lines]
+        else:
+            py_out = [make_mistakes(line, py_rng, index2word, sampler, use_insertion=config['use_insertion'],
+                                    use_deletion=config['use_deletion'], **kwargs) for line in lines]
+        np_out = []
+        np_rng = np.random.default_rng(r_seed)
+        for batch in iter_batches(lines, 1000):
+            np_out += corrupt_batch(batch, np_rng, vocab, sampler, **dict(kwargs, **config)).splitlines(True)
+        py_stats = output_stats(py_out)
+        np_stats = output_stats(np_out)
+        for key in sorted(py_stats):
+            a, b = py_stats[key], np_stats[key]
+            # Welch's z-score of the difference of the per-line means
+            se = math.sqrt(a.var(ddof=1) / len(a) + b.var(ddof=1) / len(b))
+            z = (a.mean() - b.mean()) / se if se > 0 else 0.0
+            results.append((config, key, a.mean(), b.mean(), z))
+    return results
+
+
+if __name__ == '__main__':
+    from unigram_sampler import build_sampler, read_unigram_freq
+
+    parser = argparse.ArgumentParser(description='compare operation rates of the python and numpy engines')
+    parser.add_argument('--unigram_freq', '-uf', required=True, help='normalized unigram frequency file')
+    parser.add_argument('--prob_mask', '-pm', type=float, default=0.5)
+    parser.add_argument('--prob_orig', '-po', type=float, default=0.2)
+    parser.add_argument('--seed', '-s', type=int, default=1)
+    parser.add_argument('--max_z', type=float, default=4.0, help='fail if any |z| exceeds this')
+    args = parser.parse_args()
+
+    index2word, freqs = read_unigram_freq(args.unigram_freq)
+    sampler = build_sampler(freqs)
+    lines = sys.stdin.readlines()
+    logger.info('comparing engines on {} lines'.format(len(lines)))
+    failed = False
+    for config, key, p, q, z in check_rates(lines, index2word, sampler, r_seed=args.seed,
+                                            prob_mask=args.prob_mask, prob_orig=args.prob_orig):
+        status = 'ok' if abs(z) <= args.max_z else 'MISMATCH'
+        failed |= abs(z) > args.max_z
+        print('{}\t{}\tpython={:.5f}\tnumpy={:.5f}\tz={:+.2f}\t{}'.format(
+            ' '.join('{}={}'.format(k, v) for k, v in sorted(config.items())), key, p, q, z, status))
+    sys.exit(1 if failed else 0)